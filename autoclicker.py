@@ -1,43 +1,150 @@
 #!/usr/bin/env python3
 """Автокликер для игры - автоматически кликает по кнопке "Надеть" в правой части экрана"""
 
-import pyautogui
 import time
+import argparse
+import cProfile
+import ctypes
+import ctypes.util
+import json
 import os
+import queue
+import sqlite3
+import sys
 import threading
+import tracemalloc
+from collections import deque, namedtuple
+from concurrent.futures import CancelledError, ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from typing import Callable, NamedTuple
+import cv2
+import numpy as np
 from PIL import Image, ImageDraw
-import pystray
+
+# GUI-зависимости нужны только для работы с реальным экраном и треем;
+# без дисплея (например, бенчмарк на Linux-сервере) модуль все равно импортируется
+try:
+    import pyautogui
+except Exception:
+    pyautogui = None
+try:
+    import pystray
+except Exception:
+    pystray = None
+try:
+    import mss
+except Exception:
+    mss = None
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 # Настройки
-BUTTON_IMAGE_PATH = "btn.png"  # Путь к изображению первой кнопки
-BUTTON2_IMAGE_PATH = "btn2.png"  # Путь к изображению второй кнопки
-BUTTON3_IMAGE_PATH = "btn3.png"  # Триггер (картинка 3)
-BUTTON4_IMAGE_PATH = "btn4.png"  # Цель (картинка 4) — нажать, когда виден триггер
-BUTTON5_IMAGE_PATH = "btn5.png"  # Картинка 5 — кликнуть по ней при появлении
-BUTTON5_ALT_IMAGE_PATH = "bt5.2.png"  # Вариация картинки 5 — тоже считать "кнопкой 5"
-BUTTON6_IMAGE_PATH = "btn6.png"  # Картинка 6 — кликнуть по ней при появлении
-BUTTON7_IMAGE_PATH = "btn7.png"  # Триггер 7 (по всему экрану)
-BUTTON8_IMAGE_PATH = "btn8.png"  # Цель 8 — нажать, когда виден триггер 7 (по всему экрану)
-BUTTON9_IMAGE_PATH = "btn9.png"  # Триггер 9
-BUTTON10_IMAGE_PATH = "btn10.png"  # Шаг 1 (по триггеру 9)
-BUTTON11_IMAGE_PATH = "btn11.png"  # Шаг 2 (по триггеру 9)
-BUTTON12_IMAGE_PATH = "btn12.png"  # Шаг 3 (по триггеру 9)
-BUTTON13_IMAGE_PATH = "btn13.png"  # Картинка 13 — кликнуть, но не чаще 1 раза в 30 сек
-CHECK_INTERVAL = 0.1  # Интервал проверки в секундах (0.1 = 100мс, очень быстро)
+RULES_PATH = "rules.json"  # Файл с правилами: какие кнопки искать и что по ним делать
+CHECK_INTERVAL = 0.1  # Целевой интервал проверки в секундах (0.1 = 100мс, очень быстро)
+IDLE_CHECK_INTERVAL = 0.5  # Интервал проверки, когда экран долго не меняется
+BURST_CHECK_INTERVAL = 0.03  # Интервал проверки сразу после срабатывания правила
+IDLE_AFTER = 5.0  # Через сколько секунд без изменений экрана переходить на IDLE_CHECK_INTERVAL
+BURST_DURATION = 2.0  # Сколько секунд держать BURST_CHECK_INTERVAL после срабатывания правила
 CONFIDENCE = 0.8  # Точность поиска (0.8 = 80%, можно снизить до 0.7 если не находит)
 CLICK_DELAY = 0.01  # Минимальная задержка после клика для мгновенного возврата
-DOUBLE_CLICK_DELAY = 1.0  # Задержка между кликами для второй кнопки (1 секунда)
-SEQ_CLICK_DELAY = 0.5  # Задержка между шагами в последовательности (0.5 сек)
-BTN13_MIN_INTERVAL = 30.0  # минимальный интервал между кликами по btn13 (в секундах)
+DOUBLE_CLICK_DELAY = 1.0  # Наибольшая задержка между кликами двойного клика по умолчанию (1 секунда)
+SEQ_CLICK_DELAY = 0.5  # Задержка между шагами последовательности, если CONFIRM_CLICKS выключен
+CONFIRM_CLICKS = True  # после клика ждать реакции интерфейса вместо фиксированной паузы
+WAIT_POLL_INTERVAL = 0.02  # как часто опрашивать область, пока ждем реакции (сек)
+WAIT_TIMEOUT = 3.0  # сколько ждать реакции на клик, прежде чем считать шаг несостоявшимся (сек)
+ACTION_QUEUE_SIZE = 32  # максимальная длина очереди кликов для исполнителя
+CLICK_MAX_AGE = 0.1  # клик, который ждал в очереди дольше (сек), делается только после перепроверки кнопки
+CLICK_REPEAT_INTERVAL = 0.1  # повторный клик по кнопке, которая остается видна, не раньше чем через столько секунд
+TEMPLATE_SCALES = (1.0, 0.5)  # Масштабы, для которых шаблоны готовятся заранее (0.5 — для грубого поиска)
+
+# Масштаб интерфейса (окно другого размера, другой DPI): шаблоны готовятся в нескольких
+# масштабах, рабочий масштаб один раз определяется по первому уверенному совпадению
+SCALE_CALIBRATION = True
+TEMPLATE_PYRAMID = (0.6, 0.7, 0.8, 0.9, 1.0, 1.1, 1.25, 1.4, 1.6)  # масштабы, среди которых ищется рабочий
+SCALE_CALIBRATION_CONFIDENCE = 0.85  # насколько уверенным должно быть совпадение, чтобы принять его масштаб
+SCALE_RECALIBRATE_AFTER = 50  # после стольких промахов подряд (см. ScaleCalibration) масштаб ищется заново
+
+# Поиск coarse-to-fine: сначала в уменьшенном кадре, затем уточнение в полном разрешении
+COARSE_TO_FINE = True
+COARSE_SCALE = 0.5  # масштаб грубого поиска
+COARSE_MIN_TEMPLATE_SIDE = 36  # шаблоны меньше этого (в пикселях) ищутся сразу в полном разрешении
+COARSE_MARGIN = 0.15  # насколько грубая оценка может быть ниже порога, чтобы кандидат уточнялся
+COARSE_CANDIDATES = 3  # сколько лучших кандидатов уточнять
+COARSE_REFINE_PADDING = 4  # запас вокруг кандидата при уточнении (в пикселях)
+
+# Поиск изменений между кадрами: сопоставление повторяется только там, где экран изменился
+DIFF_TILE_SIZE = 64  # размер тайла (в пикселях)
+DIFF_CELL = 8  # размер ячейки уменьшенной копии кадра для сравнения (делитель DIFF_TILE_SIZE)
+DIFF_THRESHOLD = 6  # на сколько уровней яркости должна измениться ячейка, чтобы считаться изменившейся
+
+# Память позиций: сначала проверяем шаблон там, где он был найден раньше
+LOCATION_MEMORY_ENABLED = True
+LOCATION_HISTORY = 5  # сколько последних позиций помнить для каждого шаблона
+LOCATION_ROI_PADDING = 8  # запас вокруг запомненной позиции (в пикселях)
+
+# Параллельное сопоставление шаблонов одного кадра
+MATCH_POOL = "thread"  # "thread" (по умолчанию), "process" или "none" (последовательно)
+MATCH_WORKERS = min(4, os.cpu_count() or 1)  # число воркеров (1 = последовательно)
+
+# Метрики и профилирование
+METRICS_WINDOW = 500  # сколько последних измерений хранить для перцентилей
+METRICS_TPS_WINDOW = 5.0  # окно (сек) для подсчета тиков в секунду
+METRICS_PORT = 0  # порт HTTP-эндпоинта метрик на 127.0.0.1 (0 = выключен, см. --metrics-port)
+PROFILE_TICKS = 0  # сколько тиков профилировать через cProfile (0 = выключено, см. --profile-ticks)
+PROFILE_OUTPUT = "autoclicker.prof"  # куда сохранить профиль (открывается snakeviz/flameprof)
+
+# Нажатия
+INPUT_BACKEND = "auto"  # "auto" (xtest на Linux/X11, иначе pyautogui), "win32", "xtest", "pyautogui" или "mock"
+SEQUENCE_BATCH = True  # шаги последовательности, которые уже видны вместе, отправлять одной пачкой
 
-# Отдельные настройки распознавания для проблемных шаблонов
-BTN5_CONFIDENCE = 0.65
-BTN5_GRAYSCALE = True
-BTN5_FALLBACK_FULL_SCREEN = True
+# Захват экрана
+CAPTURE_BACKEND = "auto"  # "auto" (самый быстрый из доступных), "xshm", "mss" или "pyautogui"
+CAPTURE_PROBE_FRAMES = 10  # сколько кадров снять каждым способом при выборе на старте
+CAPTURE_BUFFERS = 2  # сколько заранее выделенных буферов кадра переиспользуется по кругу (на поток)
+
+# Окно игры (задается секцией "window" в файле правил)
+WINDOW_REVALIDATE_INTERVAL = 3.0  # как часто проверять, что окно игры не сдвинулось (сек)
+WINDOW_ANCHOR_PADDING = 16  # запас вокруг якоря при быстрой проверке (в пикселях)
+
+# Подобранные настройки шаблонов (команда tune): разрешение грубого поиска, grayscale,
+# область, порог и нужны ли запасные варианты шаблона
+TUNING_PATH = "tuning.json"  # файл, который пишет tune и загружает цикл ("" = не использовать)
+TUNE_RECALL = 0.95  # какая доля размеченных кнопок должна находиться
+TUNE_PRECISION = 0.99  # какая доля срабатываний должна быть верной
+TUNE_COARSE_SCALES = (0.25, 0.5)  # уменьшения кадра для грубого поиска, которые пробует tune (кроме полного разрешения)
+TUNE_REGION_PADDING = 32  # запас вокруг размеченных позиций кнопки, из которых строится область поиска (в пикселях)
+
+# Состояние между запусками (SQLite): счетчики, rate-limit, prev_visible, память позиций и журнал кликов
+STATE_PATH = "autoclicker.state.sqlite"  # файл состояния ("" = не сохранять, см. --state)
+STATE_FLUSH_INTERVAL = 2.0  # как часто фоновый поток записывает накопленное (сек)
+STATE_CLICK_RETENTION = 30 * 24 * 3600  # сколько хранить журнал кликов (сек)
+
+# Горячая перезагрузка: правки файла правил и картинок шаблонов подхватываются без перезапуска
+HOT_RELOAD = True
+RELOAD_CHECK_INTERVAL = 1.0  # как часто проверять время изменения файлов (сек)
+# Настройки, которые можно задать в секции "settings" файла правил (ключи в нижнем регистре)
+# и менять на ходу — они читаются при каждом использовании
+RELOADABLE_SETTINGS = (
+    "CONFIDENCE", "CHECK_INTERVAL", "IDLE_CHECK_INTERVAL", "BURST_CHECK_INTERVAL", "IDLE_AFTER",
+    "BURST_DURATION", "CLICK_DELAY", "DOUBLE_CLICK_DELAY", "SEQ_CLICK_DELAY", "CONFIRM_CLICKS",
+    "CLICK_REPEAT_INTERVAL", "WAIT_POLL_INTERVAL", "WAIT_TIMEOUT", "SEQUENCE_BATCH", "COARSE_TO_FINE",
+    "COARSE_MARGIN", "COARSE_CANDIDATES", "LOCATION_MEMORY_ENABLED", "WINDOW_REVALIDATE_INTERVAL",
+)
+
+# Журнал событий (JSON-строки, пишется в фоне)
+LOG_LEVEL = "info"  # что выводить в консоль: "debug", "info", "warning", "error"
+LOG_FILE_LEVEL = "debug"  # что писать в файл
+LOG_PATH = "autoclicker.log.jsonl"  # файл журнала ("" = не писать в файл)
+LOG_MAX_BYTES = 5 * 1024 * 1024  # размер файла, после которого он ротируется
+LOG_BACKUP_COUNT = 3  # сколько старых файлов журнала хранить
+LOG_QUEUE_SIZE = 10000  # размер очереди событий (при переполнении события отбрасываются)
 
 # Безопасность: отключить fail-safe (чтобы не было проблем при движении мыши)
-pyautogui.FAILSAFE = False
+if pyautogui is not None:
+    pyautogui.FAILSAFE = False
 
 # Глобальные переменные для управления треем и автокликером
 is_running = False  # Флаг состояния автокликера (включен/выключен)
@@ -62,252 +169,3331 @@ def create_tray_icon(enabled: bool) -> Image.Image:
     return image
 
 # Автоматическое определение области поиска (правая половина экрана)
-def get_search_region():
+def get_search_region(screen_size: tuple = None):
     """Определяет правую половину экрана для поиска кнопки"""
-    screen_width, screen_height = pyautogui.size()
+    screen_width, screen_height = screen_size or pyautogui.size()
     # Правая половина экрана: (x, y, width, height)
     region = (screen_width // 2, 0, screen_width // 2, screen_height)
     return region
 
-def find_and_click_button(
-    button_image_path: str,
-    confidence: float = 0.8,
-    region: tuple = None,
-    grayscale: bool = False,
-):
+class Metrics:
+    """
+    Метрики цикла: скользящие окна длительностей (захват, сопоставление по
+    шаблонам, правила, действия, сон), тики в секунду и пропущенные дедлайны.
+
+    Гистограммы ключуются парой (метрика, метка): ("stage", "capture"),
+    ("match", "btn.png"), ("action", "btn13") и т.д.
+    """
+
+    # Метрика -> имя метки в Prometheus
+    LABELS = {"stage": "stage", "match": "template", "action": "rule", "wait": "rule", "click": "backend"}
+
+    def __init__(self, window: int = None):
+        self.window = window or METRICS_WINDOW
+        self._lock = threading.Lock()
+        self._histograms: dict[tuple, deque] = {}
+        self._totals: dict[tuple, list] = {}  # (метрика, метка) -> [count, sum]
+        self._ticks = deque(maxlen=self.window)
+        self.ticks_total = 0
+        self.missed_deadlines = 0
+
+    def observe(self, metric: str, label: str, seconds: float):
+        key = (metric, label)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = deque(maxlen=self.window)
+                self._totals[key] = [0, 0.0]
+            self._histograms[key].append(seconds)
+            totals = self._totals[key]
+            totals[0] += 1
+            totals[1] += seconds
+
+    def tick(self, missed_deadlines: int = None):
+        """Отмечает завершенный тик цикла"""
+        with self._lock:
+            self._ticks.append(time.monotonic())
+            self.ticks_total += 1
+            if missed_deadlines is not None:
+                self.missed_deadlines = missed_deadlines
+
+    def ticks_per_second(self) -> float:
+        with self._lock:
+            ticks = list(self._ticks)
+        if len(ticks) < 2 or time.monotonic() - ticks[-1] > METRICS_TPS_WINDOW:
+            return 0.0
+        ticks = [t for t in ticks if ticks[-1] - t <= METRICS_TPS_WINDOW]
+        return (len(ticks) - 1) / (ticks[-1] - ticks[0]) if ticks[-1] > ticks[0] else 0.0
+
+    def snapshot(self) -> dict:
+        """Все метрики одним словарем (для JSON и трея)"""
+        with self._lock:
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+            totals = {key: list(values) for key, values in self._totals.items()}
+            ticks_total, missed = self.ticks_total, self.missed_deadlines
+
+        data = {
+            "ticks_total": ticks_total,
+            "ticks_per_second": self.ticks_per_second(),
+            "missed_deadlines_total": missed,
+            "location_cache": get_location_cache_stats(),
+            "input": input_backend.stats(),
+        }
+        for (metric, label), values in histograms.items():
+            p50, p90, p99 = np.percentile(values, [50, 90, 99]) if values else (0.0, 0.0, 0.0)
+            count, total = totals[(metric, label)]
+            data.setdefault(metric, {})[label] = {
+                "p50_ms": float(p50) * 1000,
+                "p90_ms": float(p90) * 1000,
+                "p99_ms": float(p99) * 1000,
+                "count": count,
+                "sum_seconds": total,
+            }
+        if targets:
+            rules = [rule for target in targets for rule in target.engine.rules]
+            data["clicks"] = {rule.name: rule.count for rule in rules}
+            data["failed"] = {rule.name: rule.failed for rule in rules}
+            data["targets"] = {target.name or "default": target.stats() for target in targets}
+        return data
+
+    def prometheus(self) -> str:
+        """Метрики в текстовом формате Prometheus"""
+        data = self.snapshot()
+        lines = [
+            "# TYPE autoclicker_ticks_total counter",
+            f"autoclicker_ticks_total {data['ticks_total']}",
+            "# TYPE autoclicker_ticks_per_second gauge",
+            f"autoclicker_ticks_per_second {data['ticks_per_second']:.3f}",
+            "# TYPE autoclicker_missed_deadlines_total counter",
+            f"autoclicker_missed_deadlines_total {data['missed_deadlines_total']}",
+            "# TYPE autoclicker_location_cache_hits_total counter",
+            f"autoclicker_location_cache_hits_total {data['location_cache']['hits']}",
+            "# TYPE autoclicker_location_cache_misses_total counter",
+            f"autoclicker_location_cache_misses_total {data['location_cache']['misses']}",
+            "# TYPE autoclicker_input_clicks_total counter",
+            f'autoclicker_input_clicks_total{{backend="{data["input"]["backend"]}"}} {data["input"]["clicks"]}',
+            "# TYPE autoclicker_input_cursor_moves_total counter",
+            f'autoclicker_input_cursor_moves_total{{backend="{data["input"]["backend"]}"}} {data["input"]["cursor_moves"]}',
+        ]
+        for metric, label_name in self.LABELS.items():
+            if metric not in data:
+                continue
+            name = f"autoclicker_{metric}_seconds"
+            lines.append(f"# TYPE {name} summary")
+            for label, values in data[metric].items():
+                for quantile in ("50", "90", "99"):
+                    value = values[f"p{quantile}_ms"] / 1000
+                    lines.append(f'{name}{{{label_name}="{label}",quantile="0.{quantile}"}} {value:.6f}')
+                lines.append(f'{name}_sum{{{label_name}="{label}"}} {values["sum_seconds"]:.6f}')
+                lines.append(f'{name}_count{{{label_name}="{label}"}} {values["count"]}')
+        if "clicks" in data:
+            lines.append("# TYPE autoclicker_clicks_total counter")
+            for rule, count in data["clicks"].items():
+                lines.append(f'autoclicker_clicks_total{{rule="{rule}"}} {count}')
+            lines.append("# TYPE autoclicker_failed_actions_total counter")
+            for rule, count in data["failed"].items():
+                lines.append(f'autoclicker_failed_actions_total{{rule="{rule}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Короткая сводка для консоли/трея"""
+        data = self.snapshot()
+        lines = [
+            f"Тиков/с: {data['ticks_per_second']:.1f}, всего тиков: {data['ticks_total']}, "
+            f"пропущено дедлайнов: {data['missed_deadlines_total']}"
+        ]
+        for stage, values in data.get("stage", {}).items():
+            lines.append(f"{stage}: p50 {values['p50_ms']:.1f} мс, p90 {values['p90_ms']:.1f} мс")
+        clicks = data["input"]
+        if clicks["clicks"]:
+            latency = data.get("click", {}).get(clicks["backend"], {})
+            lines.append(
+                f"Клики ({clicks['backend']}): {clicks['clicks']}, p50 {latency.get('p50_ms', 0.0):.1f} мс, "
+                f"перемещений курсора на клик: {clicks['cursor_moves_per_click']:.1f}"
+            )
+        cache = data["location_cache"]
+        lines.append(f"Кэш позиций: {cache['hits']} попаданий, {cache['misses']} промахов")
+        return "\n".join(lines)
+
+# Общие метрики процесса
+METRICS = Metrics()
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """/metrics — формат Prometheus, /metrics.json — JSON"""
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = METRICS.prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/metrics.json":
+            body = json.dumps(METRICS.snapshot(), ensure_ascii=False).encode("utf-8")
+            content_type = "application/json; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # не засоряем консоль запросами
+
+def start_metrics_server(port: int, host: str = "127.0.0.1"):
+    """Запускает HTTP-сервер метрик в фоновом потоке (только локальный адрес)"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[INFO] Метрики: http://{host}:{server.server_port}/metrics (и /metrics.json)")
+    return server
+
+class EventLog:
+    """
+    Структурированный журнал событий: JSON-строки (время, событие, шаблон,
+    оценка, координаты, задержка) в файл с ротацией по размеру плюс
+    короткие строки в консоль.
+
+    Запись идет в фоновом потоке через ограниченную очередь: горячий путь
+    только кладет событие в очередь и никогда не ждет ввода-вывода. Если
+    очередь переполнена, событие отбрасывается (считается в dropped).
+    """
+
+    LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+    # Тег события в консоли (как в прежних print): [OK], [CLICK], [STATS]...
+    TAGS = {"found": "OK", "click": "CLICK", "stats": "STATS", "reload": "RELOAD", "error": "ERROR", "warning": "!"}
+
+    def __init__(self, path: str = None, console_level: str = None, file_level: str = None,
+                 max_bytes: int = None, backup_count: int = None, queue_size: int = None):
+        self.path = path if path is not None else LOG_PATH
+        self.console_level = self.LEVELS[console_level or LOG_LEVEL]
+        self.file_level = self.LEVELS[file_level or LOG_FILE_LEVEL]
+        self.max_bytes = max_bytes or LOG_MAX_BYTES
+        self.backup_count = LOG_BACKUP_COUNT if backup_count is None else backup_count
+        self._queue = queue.Queue(maxsize=queue_size or LOG_QUEUE_SIZE)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._file = None
+        self.dropped = 0
+
+    @property
+    def min_level(self) -> int:
+        return min(self.console_level, self.file_level if self.path else self.console_level)
+
+    def log(self, event: str, message: str, level: str = "info", **fields):
+        """Ставит событие в очередь записи (не блокирует)"""
+        level_no = self.LEVELS[level]
+        if level_no < self.min_level:
+            return
+        if self._thread is None:
+            self._start()
+        record = {"ts": time.time(), "level": level, "event": event, "msg": message, **fields}
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="event-log", daemon=True)
+                self._thread.start()
+
+    def flush(self, timeout: float = 1.0):
+        """Ждет, пока фоновый поток запишет все события из очереди (не дольше timeout)"""
+        deadline = time.monotonic() + timeout
+        while self._thread is not None and self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # Забираем все, что накопилось, и пишем одной пачкой
+            while len(batch) < 256:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                print(f"[ERROR] Не удалось записать журнал событий: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch: list[dict]):
+        console = []
+        lines = []
+        for record in batch:
+            level_no = self.LEVELS[record["level"]]
+            if level_no >= self.console_level:
+                tag = self.TAGS.get(record["event"], self.TAGS.get(record["level"], "INFO"))
+                console.append(f"[{tag}] {record['msg']}")
+            if self.path and level_no >= self.file_level:
+                lines.append(json.dumps(record, ensure_ascii=False))
+        if console:
+            sys.stdout.write("\n".join(console) + "\n")
+            sys.stdout.flush()
+        if lines:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write("\n".join(lines) + "\n")
+            self._file.flush()
+            if self._file.tell() >= self.max_bytes:
+                self._rotate()
+
+    def _rotate(self):
+        """Ротация по размеру: log -> log.1 -> log.2 ... (хранится backup_count файлов)"""
+        self._file.close()
+        self._file = None
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+# Общий журнал событий процесса
+EVENT_LOG = EventLog()
+
+def log_event(event: str, message: str, level: str = "info", **fields):
+    """Записывает событие в EVENT_LOG (не блокирует вызывающий поток)"""
+    EVENT_LOG.log(event, message, level, **fields)
+
+class Frame:
+    """
+    Кадр экрана, снятый один раз за тик и общий для всех проверок шаблонов.
+
+    Хранит BGR-массив (как у OpenCV) и смещение кадра на экране, чтобы
+    переводить координаты области поиска в координаты массива.
+    """
+
+    def __init__(self, image: np.ndarray, left: int = 0, top: int = 0):
+        self.image = image
+        self.left = left
+        self.top = top
+        self._gray = None
+        self._downscaled = {}
+
+    @property
+    def width(self) -> int:
+        return self.image.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.image.shape[0]
+
+    @property
+    def gray(self) -> np.ndarray:
+        """Grayscale-версия кадра (считается один раз на кадр)."""
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    def downscaled(self, grayscale: bool = False, scale: float = None) -> np.ndarray:
+        """Уменьшенная в scale (по умолчанию COARSE_SCALE) раз версия кадра для грубого поиска (кэшируется)"""
+        scale = COARSE_SCALE if scale is None else scale
+        key = ("gray" if grayscale else "color", scale)
+        if key not in self._downscaled:
+            image = self.gray if grayscale else self.image
+            self._downscaled[key] = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return self._downscaled[key]
+
+    def crop(self, region: tuple = None, grayscale: bool = False):
+        """
+        Вырезает область поиска из кадра без копирования (view на массив кадра)
+
+        Args:
+            region: Область (x, y, width, height) в координатах экрана или None для всего кадра
+            grayscale: Вернуть view на grayscale-версию кадра
+
+        Returns:
+            tuple: (view: np.ndarray, (left, top) — экранные координаты левого верхнего угла view)
+        """
+        image = self.gray if grayscale else self.image
+        if region is None:
+            return image, (self.left, self.top)
+
+        x, y, w, h = region
+        # Обрезаем область по границам кадра
+        x0 = max(x - self.left, 0)
+        y0 = max(y - self.top, 0)
+        x1 = min(x - self.left + w, self.width)
+        y1 = min(y - self.top + h, self.height)
+        x1 = max(x1, x0)
+        y1 = max(y1, y0)
+        return image[y0:y1, x0:x1], (self.left + x0, self.top + y0)
+
+class CaptureBackend:
+    """
+    Способ захвата экрана. grab(region) снимает только нужную область
+    (x, y, width, height) в заранее выделенный буфер и возвращает Frame
+    со смещением области на экране.
+
+    Буферы переиспользуются по кругу (CAPTURE_BUFFERS штук на поток и размер
+    области), поэтому кадр действителен, пока не сняты следующие
+    CAPTURE_BUFFERS кадров в том же потоке.
+    """
+
+    name = "base"
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @classmethod
+    def available(cls) -> bool:
+        """Можно ли использовать этот способ в текущем окружении"""
+        return True
+
+    def screen_size(self) -> tuple:
+        raise NotImplementedError
+
+    def grab(self, region: tuple = None) -> Frame:
+        left, top, width, height = self._clip(region)
+        buffer = self._next_buffer(width, height)
+        image = self._grab_into(buffer, left, top, width, height)
+        return Frame(image, left, top)
+
+    def _grab_into(self, buffer: np.ndarray, left: int, top: int, width: int, height: int) -> np.ndarray:
+        """Снимает область в buffer (BGR) и возвращает получившийся массив"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def _clip(self, region: tuple):
+        """Обрезает область по границам экрана; None — весь экран"""
+        screen = (0, 0, *self.screen_size())
+        if region is None:
+            return screen
+        clipped = intersect_regions(region, screen)
+        if clipped is None:
+            raise ValueError(f"Область захвата {region} вне экрана {screen[2]}x{screen[3]}")
+        return clipped
+
+    def _next_buffer(self, width: int, height: int) -> np.ndarray:
+        rings = getattr(self._local, "buffers", None)
+        if rings is None:
+            rings = self._local.buffers = {}
+        ring = rings.get((width, height))
+        if ring is None:
+            ring = rings[(width, height)] = deque(
+                np.empty((height, width, 3), dtype=np.uint8) for _ in range(CAPTURE_BUFFERS)
+            )
+        ring.rotate(-1)
+        return ring[0]
+
+class PyAutoGUICapture(CaptureBackend):
+    """Захват через pyautogui.screenshot (PIL) — самый медленный, но работает везде"""
+
+    name = "pyautogui"
+
+    @classmethod
+    def available(cls) -> bool:
+        return pyautogui is not None
+
+    def screen_size(self) -> tuple:
+        return tuple(pyautogui.size())
+
+    def _grab_into(self, buffer, left, top, width, height):
+        screenshot = pyautogui.screenshot(region=(left, top, width, height))
+        return cv2.cvtColor(np.asarray(screenshot), cv2.COLOR_RGB2BGR, dst=buffer)
+
+class MSSCapture(CaptureBackend):
+    """Захват через mss (BitBlt на Windows, XGetImage на Linux, CoreGraphics на macOS)"""
+
+    name = "mss"
+
+    @classmethod
+    def available(cls) -> bool:
+        if mss is None:
+            return False
+        try:
+            with mss.mss() as sct:
+                return len(sct.monitors) > 1
+        except Exception:
+            return False
+
+    def __init__(self):
+        super().__init__()
+        self._instances = []
+        self._lock = threading.Lock()
+
+    def _sct(self):
+        # Экземпляр mss нельзя использовать из другого потока — у каждого потока свой
+        sct = getattr(self._local, "sct", None)
+        if sct is None:
+            sct = self._local.sct = mss.mss()
+            with self._lock:
+                self._instances.append(sct)
+        return sct
+
+    def screen_size(self) -> tuple:
+        monitor = self._sct().monitors[1]  # основной монитор, как у pyautogui
+        return monitor["width"], monitor["height"]
+
+    def _grab_into(self, buffer, left, top, width, height):
+        monitor = self._sct().monitors[1]
+        shot = self._sct().grab({
+            "left": monitor["left"] + left, "top": monitor["top"] + top, "width": width, "height": height,
+        })
+        bgra = np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+        return cv2.cvtColor(bgra, cv2.COLOR_BGRA2BGR, dst=buffer)
+
+    def close(self):
+        with self._lock:
+            instances, self._instances = self._instances, []
+        for sct in instances:
+            sct.close()
+
+class _XImage(ctypes.Structure):
+    # Начало struct XImage из Xlib.h (остальные поля не нужны)
+    _fields_ = [
+        ("width", ctypes.c_int), ("height", ctypes.c_int), ("xoffset", ctypes.c_int),
+        ("format", ctypes.c_int), ("data", ctypes.c_void_p), ("byte_order", ctypes.c_int),
+        ("bitmap_unit", ctypes.c_int), ("bitmap_bit_order", ctypes.c_int), ("bitmap_pad", ctypes.c_int),
+        ("depth", ctypes.c_int), ("bytes_per_line", ctypes.c_int), ("bits_per_pixel", ctypes.c_int),
+    ]
+
+class _XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [
+        ("shmseg", ctypes.c_ulong), ("shmid", ctypes.c_int),
+        ("shmaddr", ctypes.c_void_p), ("readOnly", ctypes.c_int),
+    ]
+
+_xshm_libs = None
+
+def _load_xshm_libs():
+    """Загружает libX11, libXext и libc с сигнатурами нужных функций (один раз)"""
+    global _xshm_libs
+    if _xshm_libs is None:
+        paths = [ctypes.util.find_library(name) for name in ("X11", "Xext", "c")]
+        if not all(paths):
+            raise OSError("Не найдены libX11/libXext")
+        x11, xext, libc = (ctypes.CDLL(path) for path in paths)
+        display, image_p, shminfo_p = ctypes.c_void_p, ctypes.POINTER(_XImage), ctypes.POINTER(_XShmSegmentInfo)
+
+        def sig(func, restype, *argtypes):
+            func.restype, func.argtypes = restype, list(argtypes)
+
+        sig(x11.XOpenDisplay, display, ctypes.c_char_p)
+        sig(x11.XCloseDisplay, ctypes.c_int, display)
+        sig(x11.XDefaultScreen, ctypes.c_int, display)
+        sig(x11.XDefaultRootWindow, ctypes.c_ulong, display)
+        sig(x11.XDefaultVisual, ctypes.c_void_p, display, ctypes.c_int)
+        sig(x11.XDefaultDepth, ctypes.c_int, display, ctypes.c_int)
+        sig(x11.XDisplayWidth, ctypes.c_int, display, ctypes.c_int)
+        sig(x11.XDisplayHeight, ctypes.c_int, display, ctypes.c_int)
+        sig(x11.XSync, ctypes.c_int, display, ctypes.c_int)
+        sig(x11.XDestroyImage, ctypes.c_int, image_p)
+        sig(xext.XShmQueryExtension, ctypes.c_int, display)
+        sig(xext.XShmCreateImage, image_p, display, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+            ctypes.c_char_p, shminfo_p, ctypes.c_uint, ctypes.c_uint)
+        sig(xext.XShmAttach, ctypes.c_int, display, shminfo_p)
+        sig(xext.XShmDetach, ctypes.c_int, display, shminfo_p)
+        sig(xext.XShmGetImage, ctypes.c_int, display, ctypes.c_ulong, image_p,
+            ctypes.c_int, ctypes.c_int, ctypes.c_ulong)
+        sig(libc.shmget, ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_int)
+        sig(libc.shmat, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_int)
+        sig(libc.shmdt, ctypes.c_int, ctypes.c_void_p)
+        sig(libc.shmctl, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_void_p)
+        _xshm_libs = (x11, xext, libc)
+    return _xshm_libs
+
+class XShmCapture(CaptureBackend):
+    """
+    Захват на Linux/X11 через расширение MIT-SHM: X-сервер копирует область
+    прямо в разделяемую память (XShmGetImage), без передачи кадра по сокету.
+    Сегмент разделяемой памяти создается один раз на поток и размер области.
+    """
+
+    name = "xshm"
+
+    ZPIXMAP = 2
+    ALL_PLANES = 0xFFFFFFFF
+    IPC_PRIVATE, IPC_CREAT, IPC_RMID = 0, 0o1000, 0
+
+    @classmethod
+    def available(cls) -> bool:
+        if not sys.platform.startswith("linux"):
+            return False
+        try:
+            x11, xext, _libc = _load_xshm_libs()
+        except OSError:
+            return False
+        display = x11.XOpenDisplay(None)
+        if not display:
+            return False
+        try:
+            return bool(xext.XShmQueryExtension(display))
+        finally:
+            x11.XCloseDisplay(display)
+
+    def __init__(self):
+        super().__init__()
+        self._x11, self._xext, self._libc = _load_xshm_libs()
+        self._segments = []  # (display, image, shminfo) — для освобождения в close()
+        self._displays = []
+        self._lock = threading.Lock()
+
+    def _display(self):
+        # Отдельное соединение с X-сервером на поток (Xlib не потокобезопасен без XInitThreads)
+        display = getattr(self._local, "display", None)
+        if display is None:
+            display = self._x11.XOpenDisplay(None)
+            if not display:
+                raise OSError("Не удалось подключиться к X-серверу")
+            self._local.display = display
+            self._local.images = {}
+            with self._lock:
+                self._displays.append(display)
+        return display
+
+    def screen_size(self) -> tuple:
+        display = self._display()
+        screen = self._x11.XDefaultScreen(display)
+        return self._x11.XDisplayWidth(display, screen), self._x11.XDisplayHeight(display, screen)
+
+    def _image(self, display, width: int, height: int):
+        """XImage в разделяемой памяти для области width x height и numpy-view на нее (BGRA)"""
+        cached = self._local.images.get((width, height))
+        if cached is not None:
+            return cached
+
+        x11, xext, libc = self._x11, self._xext, self._libc
+        screen = x11.XDefaultScreen(display)
+        shminfo = _XShmSegmentInfo()
+        image = xext.XShmCreateImage(
+            display, x11.XDefaultVisual(display, screen), x11.XDefaultDepth(display, screen),
+            self.ZPIXMAP, None, ctypes.byref(shminfo), width, height,
+        )
+        if not image:
+            raise OSError("XShmCreateImage не удался")
+        if image.contents.bits_per_pixel != 32:
+            x11.XDestroyImage(image)
+            raise OSError(f"Неподдерживаемый формат экрана: {image.contents.bits_per_pixel} бит на пиксель")
+
+        stride = image.contents.bytes_per_line
+        size = stride * height
+        shminfo.shmid = libc.shmget(self.IPC_PRIVATE, size, self.IPC_CREAT | 0o600)
+        if shminfo.shmid < 0:
+            x11.XDestroyImage(image)
+            raise OSError("shmget не удался")
+        address = libc.shmat(shminfo.shmid, None, 0)
+        if address in (None, ctypes.c_void_p(-1).value):
+            libc.shmctl(shminfo.shmid, self.IPC_RMID, None)
+            x11.XDestroyImage(image)
+            raise OSError("shmat не удался")
+        shminfo.shmaddr = image.contents.data = address
+        shminfo.readOnly = 0
+        xext.XShmAttach(display, ctypes.byref(shminfo))
+        x11.XSync(display, 0)
+        # Сегмент удалится сам, когда от него отсоединятся процесс и X-сервер
+        libc.shmctl(shminfo.shmid, self.IPC_RMID, None)
+
+        raw = np.ctypeslib.as_array((ctypes.c_ubyte * size).from_address(address))
+        view = raw.reshape(height, stride // 4, 4)[:, :width]
+        cached = self._local.images[(width, height)] = (image, view)
+        with self._lock:
+            self._segments.append((display, image, shminfo))
+        return cached
+
+    def _grab_into(self, buffer, left, top, width, height):
+        display = self._display()
+        image, view = self._image(display, width, height)
+        if not self._xext.XShmGetImage(display, self._x11.XDefaultRootWindow(display), image, left, top, self.ALL_PLANES):
+            raise OSError("XShmGetImage не удался")
+        return cv2.cvtColor(view, cv2.COLOR_BGRA2BGR, dst=buffer)
+
+    def close(self):
+        with self._lock:
+            segments, self._segments = self._segments, []
+            displays, self._displays = self._displays, []
+        for display, image, shminfo in segments:
+            self._xext.XShmDetach(display, ctypes.byref(shminfo))
+            self._libc.shmdt(shminfo.shmaddr)
+            image.contents.data = None  # память не из malloc — XDestroyImage не должен ее освобождать
+            self._x11.XDestroyImage(image)
+        for display in displays:
+            self._x11.XCloseDisplay(display)
+
+# Способы захвата в порядке предпочтения (при равной скорости выбирается более ранний)
+CAPTURE_BACKENDS = {cls.name: cls for cls in (XShmCapture, MSSCapture, PyAutoGUICapture)}
+
+def select_capture_backend(region: tuple = None, name: str = None, frames: int = None):
+    """
+    Выбирает способ захвата: заданный по имени или (для "auto") самый быстрый
+    из доступных — каждый снимает frames кадров области region.
+
+    Returns:
+        tuple: (CaptureBackend, {имя: кадров в секунду})
+    """
+    name = name or CAPTURE_BACKEND
+    frames = frames or CAPTURE_PROBE_FRAMES
+    if name != "auto" and name not in CAPTURE_BACKENDS:
+        raise ValueError(f"Неизвестный способ захвата: {name} (есть: auto, {', '.join(CAPTURE_BACKENDS)})")
+    candidates = list(CAPTURE_BACKENDS) if name == "auto" else [name]
+
+    best, throughput = None, {}
+    for candidate in candidates:
+        cls = CAPTURE_BACKENDS[candidate]
+        if not cls.available():
+            continue
+        backend = None
+        try:
+            backend = cls()
+            backend.grab(region)  # прогрев: буферы и сегменты выделяются здесь
+            start = time.perf_counter()
+            for _ in range(frames):
+                backend.grab(region)
+            elapsed = time.perf_counter() - start
+        except Exception as e:
+            log_event("warning", f"Захват через {candidate} не работает: {e}", level="warning")
+            if backend is not None:
+                backend.close()
+            continue
+        throughput[candidate] = frames / elapsed if elapsed > 0 else float("inf")
+        if best is None or throughput[candidate] > throughput[best.name]:
+            if best is not None:
+                best.close()
+            best = backend
+        else:
+            backend.close()
+
+    if best is None:
+        raise OSError(f"Нет доступного способа захвата экрана ({name})")
+    return best, throughput
+
+# Источник кадров: выбранный CaptureBackend (или ReplayScreenSource для бенчмарка);
+# None — pyautogui без выбора
+screen_source = None
+_default_capture = PyAutoGUICapture()
+
+def grab_frame(region: tuple = None) -> Frame:
+    """Снимает область экрана (x, y, width, height; None — весь экран) и возвращает Frame (BGR)"""
+    source = screen_source if screen_source is not None else _default_capture
+    return source.grab(region)
+
+def load_image_bgr(image_path: str, grayscale: bool = False) -> np.ndarray:
+    """Загружает изображение с диска (через imdecode, чтобы работали пути с кириллицей)"""
+    data = np.fromfile(image_path, dtype=np.uint8)
+    flags = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+    image = cv2.imdecode(data, flags)
+    if image is None:
+        raise ValueError(f"Не удалось декодировать изображение: {image_path}")
+    return image
+
+class Template:
+    """
+    Шаблон кнопки, загруженный и подготовленный один раз при старте.
+
+    Хранит цветную (BGR) и grayscale-версии, а также уменьшенные/увеличенные
+    варианты для каждого масштаба из TEMPLATE_SCALES и пирамиды TEMPLATE_PYRAMID
+    (вместе с их уменьшенными копиями для грубого поиска).
+    """
+
+    def __init__(self, path: str, color: np.ndarray):
+        self.path = path
+        self.name = Path(path).stem
+        self.color = color
+        self.gray = cv2.cvtColor(color, cv2.COLOR_BGR2GRAY)
+        self.scaled = {1.0: (self.color, self.gray)}
+        scales = set(TEMPLATE_SCALES)
+        if SCALE_CALIBRATION:
+            scales.update(TEMPLATE_PYRAMID)
+            scales.update(scale * COARSE_SCALE for scale in TEMPLATE_PYRAMID)
+        for scale in scales:
+            self.image(scale=scale)
+
+    @property
+    def width(self) -> int:
+        return self.color.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.color.shape[0]
+
+    def _resize(self, scale: float):
+        size = (max(1, round(self.width * scale)), max(1, round(self.height * scale)))
+        interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR
+        color = cv2.resize(self.color, size, interpolation=interpolation)
+        return color, cv2.cvtColor(color, cv2.COLOR_BGR2GRAY)
+
+    def image(self, grayscale: bool = False, scale: float = 1.0) -> np.ndarray:
+        """Готовый массив шаблона нужного типа и масштаба"""
+        scale = round(scale, 3)
+        if scale not in self.scaled:
+            self.scaled[scale] = self._resize(scale)
+        color, gray = self.scaled[scale]
+        return gray if grayscale else color
+
+    def size(self, scale: float = 1.0) -> tuple:
+        """(ширина, высота) шаблона в масштабе scale"""
+        height, width = self.image(scale=scale).shape[:2]
+        return width, height
+
+    def __repr__(self):
+        return f"Template({self.path!r}, {self.width}x{self.height})"
+
+# Реестр шаблонов: путь -> Template. Заполняется один раз в load_templates()
+TEMPLATES: dict[str, Template] = {}
+
+# Подобранные командой tune настройки: "templates" — путь шаблона -> настройки,
+# "rules" — имя правила -> поля, которые заменяют поля правила. Загружается в load_tuning()
+TUNING: dict = {"templates": {}, "rules": {}}
+
+def load_templates(image_paths: list[str], registry: dict = None) -> dict[str, Template]:
+    """
+    Загружает и подготавливает все шаблоны кнопок (один раз при старте).
+
+    Если каких-то файлов нет — сразу бросает FileNotFoundError со списком,
+    вместо того чтобы печатать ошибку на каждом тике. registry — куда
+    складывать шаблоны (по умолчанию общий реестр TEMPLATES).
+    """
+    registry = TEMPLATES if registry is None else registry
+    missing = [p for p in image_paths if not os.path.exists(p)]
+    if missing:
+        raise FileNotFoundError(f"Файлы изображений не найдены: {', '.join(missing)}")
+
+    for p in image_paths:
+        registry[p] = Template(p, load_image_bgr(p))
+    return registry
+
+def get_template(template) -> Template:
+    """Возвращает Template из реестра (принимает путь или уже готовый Template)"""
+    if isinstance(template, Template):
+        return template
+    try:
+        return TEMPLATES[template]
+    except KeyError:
+        raise KeyError(f"Шаблон не загружен: {template} (нужно вызвать load_templates())") from None
+
+# Описание одной проверки для движка сопоставления:
+# template — путь-ключ реестра, region — область поиска (None = весь кадр)
+MatchSpec = namedtuple("MatchSpec", "template region grayscale confidence")
+
+class Match(NamedTuple):
+    """Лучшее совпадение шаблона в области: координаты (left, top, width, height) и оценка"""
+    template: str
+    box: tuple
+    score: float
+
+    @property
+    def center(self) -> tuple:
+        return box_center(self.box)
+
+class MatchResult:
+    """
+    Результат одного прохода движка по кадру: лучшее совпадение для каждой
+    пары (шаблон, область, grayscale). Проверки в цикле — это просто поиск
+    в словаре, без повторного сканирования экрана.
+    """
+
+    def __init__(self, frame: Frame, scale: float = 1.0):
+        self.frame = frame
+        self.scale = scale  # масштаб шаблонов, в котором сделано сопоставление
+        self.matches: dict[tuple, Match] = {}
+        self.confidence: dict[tuple, float] = {}
+        self.evaluated: set[tuple] = set()
+        # Сколько проверок сделано заново / частично / взято из прошлого тика
+        self.stats = {"full": 0, "partial": 0, "reused": 0}
+
+    def best(self, template, region: tuple = None, grayscale: bool = False):
+        """Лучшее совпадение (независимо от порога) или None"""
+        return self.matches.get((get_template(template).path, region, grayscale))
+
+    def find(self, template, confidence: float = 0.8, region: tuple = None, grayscale: bool = False):
+        """Совпадение с оценкой не ниже confidence или None"""
+        match = self.best(template, region, grayscale)
+        if match is None or match.score < confidence:
+            return None
+        return match
+
+    def find_any(self, templates: list, confidence: float = 0.8, region: tuple = None, grayscale: bool = False):
+        """Первое найденное совпадение из списка вариантов шаблона"""
+        for t in templates:
+            match = self.find(t, confidence, region, grayscale)
+            if match:
+                return match
+        return None
+
+    def visible(self, template, confidence: float = 0.8, region: tuple = None, grayscale: bool = False) -> bool:
+        return self.find(template, confidence, region, grayscale) is not None
+
+    def hits(self) -> list[Match]:
+        """Все совпадения, прошедшие порог своей проверки"""
+        return [m for key, m in self.matches.items() if m.score >= self.confidence[key]]
+
+    def discard(self, paths):
+        """Забывает результаты для шаблонов paths (например, после их перезагрузки) — они ищутся заново"""
+        paths = set(paths)
+        for key in [key for key in self.evaluated if key[0] in paths]:
+            self.evaluated.discard(key)
+            self.matches.pop(key, None)
+
+def intersect_regions(a: tuple, b: tuple):
+    """Пересечение двух областей (x, y, width, height); None если не пересекаются"""
+    x0 = max(a[0], b[0])
+    y0 = max(a[1], b[1])
+    x1 = min(a[0] + a[2], b[0] + b[2])
+    y1 = min(a[1] + a[3], b[1] + b[3])
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return (x0, y0, x1 - x0, y1 - y0)
+
+def union_regions(regions) -> tuple:
+    """Наименьшая область, покрывающая все области; None (весь экран), если среди них есть None"""
+    regions = list(regions)
+    if not regions or any(region is None for region in regions):
+        return None
+    x0 = min(r[0] for r in regions)
+    y0 = min(r[1] for r in regions)
+    x1 = max(r[0] + r[2] for r in regions)
+    y1 = max(r[1] + r[3] for r in regions)
+    return (x0, y0, x1 - x0, y1 - y0)
+
+def _match_full(frame: Frame, template: Template, region: tuple, grayscale: bool, scale: float = 1.0):
+    """Полное сопоставление шаблона (в масштабе scale) в области кадра. Возвращает Match или None"""
+    needle = template.image(grayscale, scale=scale)
+    haystack, (left, top) = frame.crop(region, grayscale=grayscale)
+
+    needle_h, needle_w = needle.shape[:2]
+    if haystack.shape[0] < needle_h or haystack.shape[1] < needle_w:
+        return None
+
+    result = cv2.matchTemplate(haystack, needle, cv2.TM_CCOEFF_NORMED)
+    _min_val, max_val, _min_loc, max_loc = cv2.minMaxLoc(result)
+    return Match(template.path, (left + max_loc[0], top + max_loc[1], needle_w, needle_h), float(max_val))
+
+def _match_coarse_to_fine(frame: Frame, template: Template, region: tuple, grayscale: bool, confidence: float,
+                          template_scale: float = 1.0, coarse_scale: float = None):
+    """
+    Сначала ищет уменьшенный шаблон в уменьшенном кадре (при COARSE_SCALE = 0.5 —
+    в 4 раза меньше пикселей), затем уточняет лучшие кандидаты в полном разрешении
+    в маленьком окне вокруг них.
+    """
+    scale = COARSE_SCALE if coarse_scale is None else coarse_scale
+    needle = template.image(grayscale, scale=template_scale * scale)
+    small = frame.downscaled(grayscale, scale)
+
+    if region is None:
+        region = (frame.left, frame.top, frame.width, frame.height)
+    # Область в координатах уменьшенного кадра
+    x0 = max(int((region[0] - frame.left) * scale), 0)
+    y0 = max(int((region[1] - frame.top) * scale), 0)
+    x1 = min(int((region[0] - frame.left + region[2]) * scale), small.shape[1])
+    y1 = min(int((region[1] - frame.top + region[3]) * scale), small.shape[0])
+    haystack = small[y0:y1, x0:x1]
+
+    needle_h, needle_w = needle.shape[:2]
+    if haystack.shape[0] < needle_h or haystack.shape[1] < needle_w:
+        return _match_full(frame, template, region, grayscale, template_scale)
+
+    result = cv2.matchTemplate(haystack, needle, cv2.TM_CCOEFF_NORMED)
+    threshold = confidence - COARSE_MARGIN
+    pad = COARSE_REFINE_PADDING
+    width, height = template.size(template_scale)
+    best = None
+    for _ in range(COARSE_CANDIDATES):
+        _min_val, max_val, _min_loc, (cx, cy) = cv2.minMaxLoc(result)
+        if max_val < threshold:
+            break
+        # Уточняем кандидата в полном разрешении
+        roi = (
+            frame.left + int((x0 + cx) / scale) - pad,
+            frame.top + int((y0 + cy) / scale) - pad,
+            width + 2 * pad,
+            height + 2 * pad,
+        )
+        roi = intersect_regions(roi, region)
+        if roi is not None:
+            match = _match_full(frame, template, roi, grayscale, template_scale)
+            if match and (best is None or match.score > best.score):
+                best = match
+            if best and best.score >= confidence:
+                break
+        # Гасим окрестность кандидата, чтобы следующий максимум был в другом месте
+        cv2.rectangle(
+            result,
+            (cx - needle_w // 2, cy - needle_h // 2),
+            (cx + needle_w // 2, cy + needle_h // 2),
+            -1.0,
+            thickness=-1,
+        )
+    return best
+
+class DirtyMap:
+    """
+    Карта изменившихся тайлов кадра относительно предыдущего.
+    mask=None означает «изменилось всё» (первый кадр, другой размер кадра).
+    """
+
+    def __init__(self, mask, frame: Frame, tile: int):
+        self.mask = mask
+        self.frame = frame
+        self.tile = tile
+
+    @property
+    def changed_fraction(self) -> float:
+        return 1.0 if self.mask is None else float(self.mask.mean())
+
+    def dirty_box(self, region: tuple, margin_w: int = 0, margin_h: int = 0):
+        """
+        Ограничивающий прямоугольник изменившихся тайлов внутри region,
+        расширенный на margin (размер шаблона), в координатах экрана.
+        None — в области ничего не изменилось.
+        """
+        frame = self.frame
+        if region is None:
+            region = (frame.left, frame.top, frame.width, frame.height)
+        if self.mask is None:
+            return region
+
+        t = self.tile
+        c0 = max((region[0] - frame.left) // t, 0)
+        r0 = max((region[1] - frame.top) // t, 0)
+        c1 = min(-(-(region[0] - frame.left + region[2]) // t), self.mask.shape[1])
+        r1 = min(-(-(region[1] - frame.top + region[3]) // t), self.mask.shape[0])
+        sub = self.mask[r0:r1, c0:c1]
+        if not sub.any():
+            return None
+
+        rows, cols = np.nonzero(sub)
+        box = (
+            frame.left + (c0 + int(cols.min())) * t - margin_w,
+            frame.top + (r0 + int(rows.min())) * t - margin_h,
+            (int(cols.max()) - int(cols.min()) + 1) * t + 2 * margin_w,
+            (int(rows.max()) - int(rows.min()) + 1) * t + 2 * margin_h,
+        )
+        return intersect_regions(box, region)
+
+class FrameDiff:
+    """
+    Сравнивает новый кадр с предыдущим по уменьшенной grayscale-копии
+    (одна ячейка = DIFF_CELL пикселей) и отмечает изменившиеся тайлы DIFF_TILE_SIZE.
+    """
+
+    def __init__(self, tile: int = None, cell: int = None, threshold: float = None):
+        self.tile = tile or DIFF_TILE_SIZE
+        self.cell = cell or DIFF_CELL
+        self.threshold = DIFF_THRESHOLD if threshold is None else threshold
+        self._prev = None
+        self._prev_geometry = None
+
+    def reset(self):
+        self._prev = None
+        self._prev_geometry = None
+
+    def update(self, frame: Frame) -> DirtyMap:
+        """Запоминает кадр и возвращает карту изменений относительно предыдущего"""
+        geometry = (frame.left, frame.top, frame.width, frame.height)
+        cells_w = -(-frame.width // self.cell)
+        cells_h = -(-frame.height // self.cell)
+        signature = cv2.resize(frame.gray, (cells_w, cells_h), interpolation=cv2.INTER_AREA)
+
+        prev, prev_geometry = self._prev, self._prev_geometry
+        self._prev, self._prev_geometry = signature, geometry
+        if prev is None or prev_geometry != geometry:
+            return DirtyMap(None, frame, self.tile)
+
+        changed = cv2.absdiff(signature, prev) > self.threshold
+        # Сворачиваем ячейки в тайлы: тайл «грязный», если изменилась хоть одна его ячейка
+        per_tile = self.tile // self.cell
+        tiles_h = -(-cells_h // per_tile)
+        tiles_w = -(-cells_w // per_tile)
+        padded = np.zeros((tiles_h * per_tile, tiles_w * per_tile), dtype=bool)
+        padded[:cells_h, :cells_w] = changed
+        mask = padded.reshape(tiles_h, per_tile, tiles_w, per_tile).any(axis=(1, 3))
+        return DirtyMap(mask, frame, self.tile)
+
+class LocationMemory:
+    """
+    Память позиций шаблонов: где каждый шаблон был найден в последний раз
+    (плюс короткая история). Перед полным поиском шаблон дешево проверяется
+    в маленьком окне вокруг запомненных позиций.
+    """
+
+    def __init__(self, history: int = None, padding: int = None):
+        self.history = history or LOCATION_HISTORY
+        self.padding = LOCATION_ROI_PADDING if padding is None else padding
+        self._positions: dict[str, deque] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.per_template: dict[str, list[int]] = {}  # path -> [hits, misses]
+
+    def positions(self, path: str) -> list[tuple]:
+        with self._lock:
+            return list(self._positions.get(path, ()))
+
+    def remember(self, path: str, box: tuple):
+        """Запоминает позицию (left, top) совпадения; последняя — первой в истории"""
+        pos = (box[0], box[1])
+        with self._lock:
+            positions = self._positions.setdefault(path, deque(maxlen=self.history))
+            if pos in positions:
+                positions.remove(pos)
+            positions.appendleft(pos)
+
+    def forget(self, path: str = None):
+        with self._lock:
+            if path is None:
+                self._positions.clear()
+            else:
+                self._positions.pop(path, None)
+
+    def restore(self, path: str, positions: list, hits: int = 0, misses: int = 0):
+        """Позиции (последняя — первой) и счетчики шаблона из прошлого запуска"""
+        with self._lock:
+            self._positions[path] = deque((tuple(pos) for pos in positions), maxlen=self.history)
+            counters = self.per_template.setdefault(path, [0, 0])
+            counters[0] += hits
+            counters[1] += misses
+            self.hits += hits
+            self.misses += misses
+
+    def check(self, frame: Frame, template: Template, region: tuple, grayscale: bool, confidence: float,
+              scale: float = 1.0):
+        """Проверяет шаблон в окнах вокруг запомненных позиций. Возвращает Match или None"""
+        positions = self.positions(template.path)
+        if not positions:
+            return None
+
+        if region is None:
+            region = (frame.left, frame.top, frame.width, frame.height)
+        pad = self.padding
+        width, height = template.size(scale)
+        match = None
+        for x, y in positions:
+            roi = intersect_regions((x - pad, y - pad, width + 2 * pad, height + 2 * pad), region)
+            if roi is None:
+                continue
+            candidate = _match_full(frame, template, roi, grayscale, scale)
+            if candidate is not None and candidate.score >= confidence:
+                match = candidate
+                break
+
+        with self._lock:
+            counters = self.per_template.setdefault(template.path, [0, 0])
+            if match is not None:
+                self.hits += 1
+                counters[0] += 1
+            else:
+                self.misses += 1
+                counters[1] += 1
+        return match
+
+    def stats(self) -> dict:
+        """Счетчики попаданий/промахов кэша позиций"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "templates": {p: {"hits": h, "misses": m} for p, (h, m) in self.per_template.items()},
+            }
+
+# Общая память позиций для всех проверок (find_and_click_button, is_image_visible, цикл)
+LOCATION_MEMORY = LocationMemory()
+
+def get_location_cache_stats() -> dict:
+    """Статистика попаданий/промахов памяти позиций"""
+    return LOCATION_MEMORY.stats()
+
+class ScaleCalibration:
+    """
+    Рабочий масштаб шаблонов (окно игры другого размера, другой DPI).
+
+    Пока масштаб не определен, после прохода без уверенного совпадения
+    проверяется пирамида TEMPLATE_PYRAMID — по одному масштабу за проход,
+    чтобы ни один тик не ждал поиска во всех масштабах сразу. Первый масштаб
+    с уверенным совпадением (SCALE_CALIBRATION_CONFIDENCE) становится рабочим,
+    остальные уже не проверяются, и дальше шаблоны ищутся только в нем.
+
+    Промах — проход без совпадений, в котором есть признак смены масштаба:
+    шаблон, уже находившийся в рабочем масштабе, уверенно находится в другом
+    масштабе на месте, где он запомнен в LOCATION_MEMORY, — кнопка на месте,
+    но другого размера (за проход проверяется один масштаб в маленьких окнах).
+    Кнопка, которую нажали и которая пропала, промахом не считается. Пока
+    масштаб не определен, промах — любой проход без совпадений. После
+    SCALE_RECALIBRATE_AFTER промахов подряд пирамида проверяется снова.
+    """
+
+    def __init__(self, scales: tuple = None, confidence: float = None, recalibrate_after: int = None):
+        self.scales = tuple(scales or TEMPLATE_PYRAMID)
+        self.confidence = confidence or SCALE_CALIBRATION_CONFIDENCE
+        self.recalibrate_after = recalibrate_after or SCALE_RECALIBRATE_AFTER
+        self.scale = 1.0
+        self.calibrated = False
+        self.pending = True  # нужно ли проверить пирамиду
+        self.misses = 0
+        self.calibrations = 0
+        self.probes = 0  # сколько масштабов пирамиды проверено (по одному за проход)
+        self._found: set[str] = set()  # шаблоны, найденные в рабочем масштабе
+        self._probe: list[float] = []  # масштабы пирамиды, которые еще осталось проверить
+        self._suspect = None  # масштаб, в котором кнопка нашлась на запомненном месте (признак смены)
+        self._rotation = 0  # какой масштаб проверять на запомненных местах следующим
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.scale, self.calibrated, self.pending, self.misses = 1.0, False, True, 0
+            self._found.clear()
+            self._probe, self._suspect = [], None
+
+    def _scale_evidence(self, frame: Frame, result: "MatchResult"):
+        """
+        Признак того, что кнопки стали другого размера: шаблон, уже находившийся
+        в рабочем масштабе, уверенно находится в другом масштабе пирамиды на месте,
+        где он запомнен в LOCATION_MEMORY. За проход проверяется один масштаб (по кругу,
+        а пока признак есть — тот же). Возвращает этот масштаб или None.
+        """
+        candidates = [s for s in self.scales if s != result.scale]
+        checks = [(path, region, grayscale, confidence)
+                  for (path, region, grayscale), confidence in result.confidence.items() if path in self._found]
+        if not candidates or not checks:
+            return None
+        scale = self._suspect if self._suspect in candidates else candidates[self._rotation % len(candidates)]
+        for path, region, grayscale, confidence in checks:
+            template = TEMPLATES[path]
+            width, height = template.size(result.scale)
+            # Окно с запасом на новый размер, куда бы кнопка ни выросла (от угла или от центра)
+            scaled_width, scaled_height = template.size(scale)
+            grow = max(abs(scaled_width - width), abs(scaled_height - height))
+            area = region if region is not None else (frame.left, frame.top, frame.width, frame.height)
+            for x, y in LOCATION_MEMORY.positions(path):
+                roi = intersect_regions(padded_box((x, y, width, height), LOCATION_ROI_PADDING + grow), area)
+                if roi is None:
+                    continue
+                match = _match_full(frame, template, roi, grayscale, scale)
+                if match is not None and match.score >= max(confidence, self.confidence):
+                    self._suspect = scale
+                    return scale
+        self._suspect = None
+        self._rotation += 1
+        return None
+
+    def update(self, frame: Frame, result: "MatchResult", rematched: bool = True):
+        """
+        Учитывает результат прохода; при необходимости проверяет следующий масштаб пирамиды.
+        Возвращает новый рабочий масштаб, если он изменился, иначе None.
+        """
+        hits = result.hits()
+        if hits or not rematched:
+            missed = False
+        elif not self.calibrated:
+            missed = True  # пока масштаб не определен, промах — любой пересканированный проход без совпадений
+        else:
+            missed = self._scale_evidence(frame, result) is not None
+        with self._lock:
+            if hits:
+                self.misses = 0
+                if result.scale == self.scale:
+                    self._found.update(match.template for match in hits)
+            elif missed:
+                self.misses += 1
+                if self.misses >= self.recalibrate_after:
+                    # Ищем заново один раз; следующий раз — только после новых промахов
+                    self.pending, self.misses = True, 0
+            elif rematched:
+                self.misses = 0  # признак пропал — промахи считаются подряд
+            if not self.pending and not self._probe:
+                return None
+            if any(match.score >= self.confidence for match in hits):
+                self.pending, self._probe = False, []
+                self._accept(result.scale)
+                return None
+            if self.pending:
+                self.pending = False
+                # Масштаб, в котором кнопка уже нашлась на своем месте, проверяется первым
+                self._probe = sorted((s for s in self.scales if s != result.scale), key=lambda s: s != self._suspect)
+            if not self._probe:
+                return None
+            scale = self._probe.pop(0)
+            self.probes += 1
+
+        if not self._probe_scale(frame, result, scale):
+            return None
+        # Первый масштаб с уверенным совпадением — рабочий, остальные не проверяем
+        with self._lock:
+            self._probe = []
+            self._accept(scale)
+        return scale if scale != result.scale else None
+
+    def _accept(self, scale: float):
+        if not self.calibrated or scale != self.scale:
+            self.calibrations += 1
+            self._found.clear()
+            log_event("scale", f"Рабочий масштаб шаблонов: {scale:g}", scale=scale)
+        self.scale, self.calibrated = scale, True
+
+    def _probe_scale(self, frame: Frame, result: "MatchResult", scale: float) -> float:
+        """Оценка самого уверенного совпадения проверок прохода в масштабе scale (0 — ничего)"""
+        jobs = [
+            (TEMPLATES[path], region, grayscale, max(confidence, self.confidence), scale)
+            for (path, region, grayscale), confidence in result.confidence.items()
+        ]
+        best = 0.0
+        for job, match in zip(jobs, _run_match_jobs(frame, jobs)):
+            if match is not None and match.score >= job[3]:
+                best = max(best, match.score)
+        return best
+
+    def calibrate(self, frame: Frame, result: "MatchResult"):
+        """
+        Проверяет всю пирамиду сразу (для команд без реального времени, например tune).
+        Возвращает найденный масштаб или None.
+        """
+        scores = {scale: self._probe_scale(frame, result, scale) for scale in self.scales}
+        best = max(scores, key=scores.get)
+        if not scores[best]:
+            return None
+        with self._lock:
+            self.pending, self._probe = False, []
+            self._accept(best)
+        return best
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"scale": self.scale, "calibrated": self.calibrated, "calibrations": self.calibrations,
+                    "probes": self.probes}
+
+def _coarse_scale(template: Template, scale: float = 1.0) -> float:
+    """
+    Во сколько раз уменьшать кадр для грубого поиска шаблона (0 — искать сразу
+    в полном разрешении): подобранное командой tune или COARSE_SCALE для крупных шаблонов
+    """
+    if not COARSE_TO_FINE:
+        return 0.0
+    tuned = TUNING["templates"].get(template.path, {}).get("coarse_scale")
+    if tuned is not None:
+        return tuned
+    return COARSE_SCALE if min(template.size(scale)) >= COARSE_MIN_TEMPLATE_SIDE else 0.0
+
+def _search_template(frame: Frame, template: Template, region: tuple, grayscale: bool, confidence: float,
+                     scale: float = 1.0, coarse_scale: float = None):
+    """Поиск шаблона (в масштабе scale) по всей области — coarse-to-fine для крупных шаблонов"""
+    coarse_scale = _coarse_scale(template, scale) if coarse_scale is None else coarse_scale
+    if coarse_scale:
+        return _match_coarse_to_fine(frame, template, region, grayscale, confidence, scale, coarse_scale)
+    return _match_full(frame, template, region, grayscale, scale)
+
+def _match_spec(frame: Frame, template: Template, region: tuple, grayscale: bool, confidence: float,
+                scale: float = 1.0):
+    """
+    Одна проверка шаблона в области: сначала окна вокруг запомненных позиций,
+    затем (при промахе) поиск по всей области — coarse-to-fine для крупных шаблонов.
+    """
+    start = time.perf_counter()
+    if LOCATION_MEMORY_ENABLED:
+        match = LOCATION_MEMORY.check(frame, template, region, grayscale, confidence, scale)
+        if match is not None:
+            LOCATION_MEMORY.remember(template.path, match.box)
+            METRICS.observe("match", template.path, time.perf_counter() - start)
+            return match
+
+    match = _search_template(frame, template, region, grayscale, confidence, scale)
+
+    if LOCATION_MEMORY_ENABLED and match is not None and match.score >= confidence:
+        LOCATION_MEMORY.remember(template.path, match.box)
+    METRICS.observe("match", template.path, time.perf_counter() - start)
+    return match
+
+# Пул для параллельного сопоставления (создается при первом использовании).
+# Его берут и цикл, и поток исполнителя кликов (ожидание шагов последовательности),
+# а перезагрузка может его закрыть — создание и закрытие идут под блокировкой
+_match_pool = None
+_match_pool_lock = threading.Lock()
+
+def _init_match_worker(image_paths: list[str], tuning: dict):
+    """Инициализация процесса-воркера: свой реестр шаблонов и подобранные настройки"""
+    global TUNING
+    TUNING = tuning
+    load_templates(image_paths)
+
+def _search_in_worker(frame: Frame, path: str, grayscale: bool, confidence: float, scale: float):
+    """Поиск в процессе-воркере: frame — это уже вырезанная область поиска"""
+    return _search_template(frame, TEMPLATES[path], None, grayscale, confidence, scale)
+
+def get_match_pool():
+    """
+    Пул воркеров для сопоставления (MATCH_POOL = "thread" / "process") или None,
+    если параллельность выключена. cv2.matchTemplate отпускает GIL, поэтому
+    потоков обычно достаточно.
+    """
+    global _match_pool
+    with _match_pool_lock:
+        if _match_pool is None and MATCH_POOL != "none" and MATCH_WORKERS > 1:
+            if MATCH_POOL == "process":
+                _match_pool = ProcessPoolExecutor(
+                    max_workers=MATCH_WORKERS,
+                    initializer=_init_match_worker,
+                    initargs=(list(TEMPLATES), TUNING),
+                )
+            elif MATCH_POOL == "thread":
+                _match_pool = ThreadPoolExecutor(max_workers=MATCH_WORKERS, thread_name_prefix="match")
+            else:
+                raise ValueError(f"Неизвестный MATCH_POOL: {MATCH_POOL!r}")
+        return _match_pool
+
+def shutdown_match_pool():
+    global _match_pool
+    with _match_pool_lock:
+        pool, _match_pool = _match_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def retire_match_pool():
+    """
+    Подменяет пул: следующий get_match_pool() создаст новый, а старый закрывается
+    в фоне, дождавшись уже отправленных заданий — их результатов может ждать
+    поток исполнителя посреди последовательности (wait_until).
+    """
+    global _match_pool
+    with _match_pool_lock:
+        pool, _match_pool = _match_pool, None
+    if pool is not None:
+        threading.Thread(target=pool.shutdown, kwargs={"wait": True}, name="match-pool-retire", daemon=True).start()
+
+def _run_match_jobs(frame: Frame, jobs: list) -> list:
+    """
+    Выполняет поиск для списка (template, region, grayscale, confidence, scale)
+    последовательно или в пуле; порядок jobs — это порядок отправки в пул
+    (сначала шаблоны с большим приоритетом).
+    """
+    pool = get_match_pool() if len(jobs) > 1 else None
+    if pool is None:
+        return [_match_spec(frame, *job) for job in jobs]
+    try:
+        return _run_in_pool(pool, frame, jobs)
+    except (RuntimeError, CancelledError):
+        # Пул подменили (перезагрузка) между get_match_pool() и отправкой заданий — повторяем в новом
+        pool = get_match_pool()
+        if pool is None:
+            return [_match_spec(frame, *job) for job in jobs]
+        return _run_in_pool(pool, frame, jobs)
+
+def _run_in_pool(pool, frame: Frame, jobs: list) -> list:
+    """Отправляет jobs в пул pool и собирает результаты в том же порядке"""
+    if isinstance(pool, ProcessPoolExecutor):
+        # Память позиций живет в этом процессе: проверяем ее здесь, а в воркеры
+        # отправляем только вырезанные области для полного поиска
+        results = [None] * len(jobs)
+        futures = {}
+        for i, (template, region, grayscale, confidence, scale) in enumerate(jobs):
+            if LOCATION_MEMORY_ENABLED:
+                match = LOCATION_MEMORY.check(frame, template, region, grayscale, confidence, scale)
+                if match is not None:
+                    LOCATION_MEMORY.remember(template.path, match.box)
+                    results[i] = match
+                    continue
+            haystack, (left, top) = frame.crop(region)
+            crop = Frame(np.ascontiguousarray(haystack), left, top)
+            futures[i] = (
+                pool.submit(_search_in_worker, crop, template.path, grayscale, confidence, scale),
+                time.perf_counter(),
+            )
+        for i, (future, submitted) in futures.items():
+            match = future.result()
+            template, _region, _grayscale, confidence, _scale = jobs[i]
+            METRICS.observe("match", template.path, time.perf_counter() - submitted)
+            if LOCATION_MEMORY_ENABLED and match is not None and match.score >= confidence:
+                LOCATION_MEMORY.remember(template.path, match.box)
+            results[i] = match
+        return results
+
+    # Потоки работают с общим кадром: заранее считаем его grayscale/уменьшенные
+    # версии, чтобы воркеры не делали это одновременно
+    if any(job[2] for job in jobs):
+        frame.gray
+        if COARSE_TO_FINE:
+            frame.downscaled(grayscale=True)
+    if COARSE_TO_FINE and not all(job[2] for job in jobs):
+        frame.downscaled(grayscale=False)
+    futures = [pool.submit(_match_spec, frame, *job) for job in jobs]
+    return [future.result() for future in futures]
+
+def match_templates(
+    frame: Frame,
+    specs: list[MatchSpec],
+    previous: MatchResult = None,
+    dirty: DirtyMap = None,
+    calibrator: ScaleCalibration = None,
+    scale: float = None,
+) -> MatchResult:
+    """
+    Сопоставляет с кадром весь набор шаблонов за один вызов.
+
+    Одинаковые проверки (шаблон, область, grayscale) выполняются один раз;
+    grayscale- и уменьшенная версии кадра считаются один раз на кадр.
+    Крупные шаблоны ищутся по схеме coarse-to-fine (см. COARSE_TO_FINE).
+    Если включен пул (MATCH_POOL/MATCH_WORKERS), проверки выполняются
+    параллельно в порядке specs, а результаты собираются до возврата.
+
+    Если переданы previous (результат прошлого тика) и dirty (карта изменений
+    от FrameDiff), то:
+    - в области без изменений результат берется из previous без сопоставления;
+    - если изменилась только часть области — ищем только в изменившихся
+      тайлах (с запасом на размер шаблона) и объединяем с прошлым результатом;
+    - если изменилось место прошлого видимого совпадения (оценка не ниже порога) —
+      область сканируется целиком; совпадение ниже порога просто отбрасывается.
+
+    Шаблоны ищутся в масштабе scale или в рабочем масштабе calibrator (у каждой
+    цели свой, см. Target), и тогда результат прохода используется для его
+    калибровки; без них — в исходном размере.
+    """
+    if scale is None:
+        scale = calibrator.scale if calibrator is not None and SCALE_CALIBRATION else 1.0
+    result = MatchResult(frame, scale)
+    # Дедупликация: для одинаковых проверок берем минимальный порог
+    for spec in specs:
+        key = (get_template(spec.template).path, spec.region, spec.grayscale)
+        result.confidence[key] = min(result.confidence.get(key, 1.0), spec.confidence)
+
+    # Сначала решаем, что можно взять из прошлого тика, а что нужно искать
+    keys = []
+    jobs = []
+    merge_with = []  # прошлое совпадение, с которым объединяется частичный поиск
+    for key, confidence in result.confidence.items():
+        path, region, grayscale = key
+        template = TEMPLATES[path]
+        result.evaluated.add(key)
+
+        if previous is None or dirty is None or key not in previous.evaluated or previous.scale != scale:
+            search_region, prev_match = region, None
+            result.stats["full"] += 1
+        else:
+            prev_match = previous.matches.get(key)
+            changed = dirty.dirty_box(region, *template.size(scale))
+            if changed is None:
+                # В области ничего не изменилось — прошлый результат по-прежнему верен
+                if prev_match is not None:
+                    result.matches[key] = prev_match
+                result.stats["reused"] += 1
+                continue
+            elif prev_match is not None and intersect_regions(prev_match.box, changed) is not None:
+                if prev_match.score >= confidence:
+                    # Изменилось место видимой кнопки — пересканируем всю область
+                    search_region = region
+                    result.stats["full"] += 1
+                else:
+                    # Лучшая оценка невидимого шаблона часто попадает на анимацию: в остальной
+                    # области все равно нет ничего выше порога, ищем только в изменившейся части
+                    search_region = changed
+                    result.stats["partial"] += 1
+                prev_match = None
+            else:
+                # Ищем только в изменившейся части; неизменная часть дает прошлый результат
+                search_region = changed
+                result.stats["partial"] += 1
+
+        keys.append(key)
+        jobs.append((template, search_region, grayscale, confidence, scale))
+        merge_with.append(prev_match)
+
+    for key, match, prev_match in zip(keys, _run_match_jobs(frame, jobs), merge_with):
+        if prev_match is not None and (match is None or prev_match.score > match.score):
+            match = prev_match
+        if match is not None:
+            result.matches[key] = match
+
+    if calibrator is not None and SCALE_CALIBRATION and calibrator.update(frame, result, rematched=bool(jobs)) is not None:
+        # Масштаб сменился — пересчитываем проход уже в новом масштабе
+        return match_templates(frame, specs, scale=calibrator.scale)
+    return result
+
+def locate_on_frame(
+    template,
+    frame: Frame,
+    confidence: float = 0.8,
+    region: tuple = None,
+    grayscale: bool = False,
+    scale: float = 1.0,
+):
+    """
+    Ищет шаблон в уже снятом кадре (аналог pyautogui.locateOnScreen, но без нового скриншота)
+
+    Args:
+        template: Template из реестра (или путь к нему)
+        scale: Масштаб шаблона (рабочий масштаб цели, см. ScaleCalibration)
+
+    Returns:
+        tuple: (left, top, width, height) в координатах экрана или None
+    """
+    spec = MatchSpec(template, region, grayscale, confidence)
+    match = match_templates(frame, [spec], scale=scale).find(template, confidence, region, grayscale)
+    return match.box if match else None
+
+def box_center(box: tuple) -> tuple:
+    """Центр найденной области (left, top, width, height)"""
+    return box[0] + int(box[2] / 2), box[1] + int(box[3] / 2)
+
+def wait_until(check: Callable, region: tuple = None, timeout: float = None, poll: float = None, label: str = None):
+    """
+    Опрашивает область экрана region (обычно маленькую) каждые poll секунд,
+    пока check(frame) не вернет истинное значение.
+
+    Returns:
+        Значение check или None, если за timeout секунд не дождались
+    """
+    timeout = WAIT_TIMEOUT if timeout is None else timeout
+    poll = WAIT_POLL_INTERVAL if poll is None else poll
+    start = time.monotonic()
+    deadline = start + timeout
+    while True:
+        polled = time.monotonic()
+        value = check(grab_frame(region))
+        if value or polled >= deadline:
+            if label is not None:
+                METRICS.observe("wait", label, time.monotonic() - start)
+            return value or None
+        time.sleep(max(0.0, min(polled + poll, deadline) - time.monotonic()))
+
+def appeared(templates: list, region: tuple, confidence: float, grayscale: bool = False,
+             scale: float = 1.0) -> Callable:
+    """Условие для wait_until: появился один из шаблонов (возвращает Match)"""
+    specs = [MatchSpec(t, region, grayscale, confidence) for t in templates]
+    return lambda frame: match_templates(frame, specs, scale=scale).find_any(templates, confidence, region, grayscale)
+
+def disappeared(match: Match, confidence: float, grayscale: bool = False, scale: float = 1.0) -> Callable:
+    """Условие для wait_until: кнопки match больше нет на ее месте"""
+    region = padded_box(match.box, LOCATION_ROI_PADDING)
+    spec = MatchSpec(match.template, region, grayscale, confidence)
+    return lambda frame: (
+        match_templates(frame, [spec], scale=scale).find(match.template, confidence, region, grayscale) is None
+    )
+
+def settled(baseline: Frame) -> Callable:
+    """
+    Условие для wait_until: область изменилась по сравнению с baseline и
+    перестала меняться (интерфейс отреагировал и анимация закончилась)
+    """
+    state = {"changed": False, "previous": baseline.gray}
+
+    def check(frame: Frame):
+        gray = frame.gray
+        if gray.shape != state["previous"].shape:
+            return False
+        moved = float(cv2.absdiff(gray, state["previous"]).mean()) > DIFF_THRESHOLD
+        state["previous"] = gray.copy()
+        if not state["changed"]:
+            state["changed"] = moved
+            return False
+        return not moved
+
+    return check
+
+def padded_box(box: tuple, padding: int) -> tuple:
+    """Область box (left, top, width, height), расширенная на padding со всех сторон"""
+    return (box[0] - padding, box[1] - padding, box[2] + 2 * padding, box[3] + 2 * padding)
+
+def wait_region(templates: list, region: tuple, scale: float = 1.0) -> tuple:
+    """
+    Где ждать появления шаблонов: окна вокруг их запомненных позиций
+    (если все они уже где-то находились), иначе вся область region
+    """
+    boxes = []
+    for path in templates:
+        template = get_template(path)
+        positions = LOCATION_MEMORY.positions(template.path)
+        if not positions:
+            return region
+        width, height = template.size(scale)
+        boxes += [padded_box((x, y, width, height), LOCATION_ROI_PADDING) for x, y in positions]
+    roi = union_regions(boxes)
+    return roi if region is None else (intersect_regions(roi, region) or region)
+
+class InputBackend:
+    """
+    Способ нажимать кнопки. click(x, y) — один клик в точке экрана (вместе
+    с возвратом курсора, если он двигался), click_batch(points) — несколько
+    кликов подряд (у пакетных способов — одной отправкой).
+
+    Считает клики и перемещения курсора, чтобы в метриках было видно, сколько
+    раз на клик дергается курсор пользователя.
+    """
+
+    name = "base"
+    batched = False  # умеет ли click_batch отправлять клики одной пачкой
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clicks = 0
+        self.cursor_moves = 0
+
+    @classmethod
+    def available(cls) -> bool:
+        return True
+
+    def click(self, x: int, y: int):
+        self.click_batch([(x, y)])
+
+    def click_batch(self, points: list[tuple]):
+        for x, y in points:
+            self.click(x, y)
+
+    def _count(self, clicks: int, cursor_moves: int):
+        with self._lock:
+            self.clicks += clicks
+            self.cursor_moves += cursor_moves
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": self.name,
+                "clicks": self.clicks,
+                "cursor_moves": self.cursor_moves,
+                "cursor_moves_per_click": self.cursor_moves / self.clicks if self.clicks else 0.0,
+            }
+
+    def close(self):
+        pass
+
+class PyAutoGUIInput(InputBackend):
+    """
+    Клик через pyautogui: запомнить позицию курсора, кликнуть, подождать
+    CLICK_DELAY и вернуть курсор — два перемещения курсора на клик.
+    mouse — объект с интерфейсом pyautogui (position/click/moveTo).
+    """
+
+    name = "pyautogui"
+
+    def __init__(self, mouse=None):
+        super().__init__()
+        self.mouse = mouse
+
+    @classmethod
+    def available(cls) -> bool:
+        return pyautogui is not None
+
+    def click(self, x: int, y: int):
+        mouse = self.mouse or pyautogui
+        # Сохраняем текущую позицию курсора
+        original_pos = mouse.position()
+        
+        # Мгновенный клик по кнопке
+        mouse.click(x, y)
+        time.sleep(CLICK_DELAY)
+        
+        # Возвращаем курсор точно на исходное место
+        mouse.moveTo(original_pos.x, original_pos.y)
+        self._count(1, 2)
+
+class Win32MessageInput(InputBackend):
+    """
+    Клик сообщениями WM_LBUTTONDOWN/WM_LBUTTONUP прямо в окно под точкой
+    (PostMessage) — курсор не двигается и не мешает пользователю.
+    Не все игры принимают такие клики (DirectX-окна часто читают «сырую» мышь),
+    поэтому этот способ включается только явно.
+    """
+
+    name = "win32"
+
+    WM_LBUTTONDOWN, WM_LBUTTONUP, MK_LBUTTON = 0x0201, 0x0202, 0x0001
+
+    @classmethod
+    def available(cls) -> bool:
+        return sys.platform == "win32"
+
+    def __init__(self):
+        super().__init__()
+        from ctypes import wintypes
+
+        self._wintypes = wintypes
+        self._user32 = ctypes.windll.user32
+        self._user32.WindowFromPoint.argtypes = [wintypes.POINT]
+        self._user32.WindowFromPoint.restype = wintypes.HWND
+        self._user32.PostMessageW.argtypes = [wintypes.HWND, wintypes.UINT, wintypes.WPARAM, wintypes.LPARAM]
+
+    def click_batch(self, points: list[tuple]):
+        for x, y in points:
+            point = self._wintypes.POINT(x, y)
+            hwnd = self._user32.WindowFromPoint(point)
+            if not hwnd or not self._user32.ScreenToClient(hwnd, ctypes.byref(point)):
+                raise OSError(f"Нет окна в точке ({x}, {y})")
+            lparam = ((point.y & 0xFFFF) << 16) | (point.x & 0xFFFF)
+            self._user32.PostMessageW(hwnd, self.WM_LBUTTONDOWN, self.MK_LBUTTON, lparam)
+            self._user32.PostMessageW(hwnd, self.WM_LBUTTONUP, 0, lparam)
+        self._count(len(points), 0)
+
+class XTestInput(InputBackend):
+    """
+    Клик на Linux/X11 через расширение XTest: перемещения и нажатия
+    ставятся в очередь X-сервера и отправляются одним XFlush. Пачка кликов
+    (click_batch) — это N перемещений + одно возвращение курсора за один
+    обмен с сервером вместо нескольких синхронных вызовов на каждый клик.
+    """
+
+    name = "xtest"
+    batched = True
+
+    @classmethod
+    def available(cls) -> bool:
+        if not sys.platform.startswith("linux"):
+            return False
+        try:
+            x11, xtst = _load_xtest_libs()
+        except OSError:
+            return False
+        display = x11.XOpenDisplay(None)
+        if not display:
+            return False
+        try:
+            return bool(xtst.XTestQueryExtension(display, *(ctypes.byref(ctypes.c_int()) for _ in range(4))))
+        finally:
+            x11.XCloseDisplay(display)
+
+    def __init__(self):
+        super().__init__()
+        self._x11, self._xtst = _load_xtest_libs()
+        self._display = self._x11.XOpenDisplay(None)
+        if not self._display:
+            raise OSError("Не удалось подключиться к X-серверу")
+        self._root = self._x11.XDefaultRootWindow(self._display)
+        self._send_lock = threading.Lock()
+
+    def _pointer(self) -> tuple:
+        root, child = ctypes.c_ulong(), ctypes.c_ulong()
+        root_x, root_y, win_x, win_y = (ctypes.c_int() for _ in range(4))
+        mask = ctypes.c_uint()
+        self._x11.XQueryPointer(
+            self._display, self._root, ctypes.byref(root), ctypes.byref(child),
+            ctypes.byref(root_x), ctypes.byref(root_y), ctypes.byref(win_x), ctypes.byref(win_y), ctypes.byref(mask),
+        )
+        return root_x.value, root_y.value
+
+    def click_batch(self, points: list[tuple]):
+        with self._send_lock:
+            original_x, original_y = self._pointer()
+            for x, y in points:
+                self._xtst.XTestFakeMotionEvent(self._display, -1, x, y, 0)
+                self._xtst.XTestFakeButtonEvent(self._display, 1, True, 0)
+                self._xtst.XTestFakeButtonEvent(self._display, 1, False, 0)
+            # Возвращаем курсор один раз на всю пачку
+            self._xtst.XTestFakeMotionEvent(self._display, -1, original_x, original_y, 0)
+            self._x11.XFlush(self._display)
+        self._count(len(points), len(points) + 1)
+
+    def close(self):
+        if self._display:
+            self._x11.XCloseDisplay(self._display)
+            self._display = None
+
+_xtest_libs = None
+
+def _load_xtest_libs():
+    """Загружает libX11 и libXtst с сигнатурами нужных функций (один раз)"""
+    global _xtest_libs
+    if _xtest_libs is None:
+        paths = [ctypes.util.find_library(name) for name in ("X11", "Xtst")]
+        if not all(paths):
+            raise OSError("Не найдены libX11/libXtst")
+        x11, xtst = (ctypes.CDLL(path) for path in paths)
+        display, int_p = ctypes.c_void_p, ctypes.POINTER(ctypes.c_int)
+        x11.XOpenDisplay.restype, x11.XOpenDisplay.argtypes = display, [ctypes.c_char_p]
+        x11.XCloseDisplay.argtypes = [display]
+        x11.XDefaultRootWindow.restype, x11.XDefaultRootWindow.argtypes = ctypes.c_ulong, [display]
+        x11.XFlush.argtypes = [display]
+        x11.XQueryPointer.argtypes = [
+            display, ctypes.c_ulong, ctypes.POINTER(ctypes.c_ulong), ctypes.POINTER(ctypes.c_ulong),
+            int_p, int_p, int_p, int_p, ctypes.POINTER(ctypes.c_uint),
+        ]
+        xtst.XTestQueryExtension.argtypes = [display, int_p, int_p, int_p, int_p]
+        xtst.XTestFakeMotionEvent.argtypes = [display, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_ulong]
+        xtst.XTestFakeButtonEvent.argtypes = [display, ctypes.c_uint, ctypes.c_int, ctypes.c_ulong]
+        _xtest_libs = (x11, xtst)
+    return _xtest_libs
+
+class RecordingInput(InputBackend):
+    """Ничего не нажимает, только записывает клики (для бенчмарка и тестов)"""
+
+    name = "mock"
+    batched = True
+
+    def __init__(self):
+        super().__init__()
+        self.events = []  # (время, x, y, номер пачки)
+        self.batches = 0
+
+    def click_batch(self, points: list[tuple]):
+        now = time.monotonic()
+        with self._lock:
+            self.batches += 1
+            self.events += [(now, x, y, self.batches) for x, y in points]
+        self._count(len(points), 0)
+
+# Способы нажатия (для "auto" выбирается первый доступный из xtest и pyautogui)
+INPUT_BACKENDS = {cls.name: cls for cls in (PyAutoGUIInput, Win32MessageInput, XTestInput, RecordingInput)}
+
+def select_input_backend(name: str = None) -> InputBackend:
+    """Создает способ нажатия по имени; "auto" — xtest на Linux/X11, иначе pyautogui"""
+    name = name or INPUT_BACKEND
+    if name == "auto":
+        name = "xtest" if XTestInput.available() else "pyautogui"
+    if name not in INPUT_BACKENDS:
+        raise ValueError(f"Неизвестный способ нажатия: {name} (есть: auto, {', '.join(INPUT_BACKENDS)})")
+    if not INPUT_BACKENDS[name].available():
+        raise OSError(f"Способ нажатия {name} недоступен в этой системе")
+    return INPUT_BACKENDS[name]()
+
+# Чем кликать (выбирается в main(); бенчмарк подставляет RecordingInput)
+input_backend = PyAutoGUIInput()
+
+def click_many(points: list[tuple]):
+    """Клики по нескольким точкам подряд (у пакетных способов — одной отправкой)"""
+    start = time.perf_counter()
+    input_backend.click_batch(points)
+    latency = time.perf_counter() - start
+    METRICS.observe("click", input_backend.name, latency / len(points))
+    for x, y in points:
+        log_event("click", f"Клик выполнен на ({x}, {y})", x=x, y=y,
+                  latency_ms=latency * 1000 / len(points), batch=len(points))
+    return True
+
+def click_at(x: int, y: int):
+    """Мгновенный клик в точке экрана (курсор, если двигался, возвращается на место)"""
+    start = time.perf_counter()
+    input_backend.click(x, y)
+    latency = time.perf_counter() - start
+    METRICS.observe("click", input_backend.name, latency)
+    log_event("click", f"Клик выполнен на ({x}, {y})", x=x, y=y, latency_ms=latency * 1000)
+    return True
+
+def double_click_at(x: int, y: int, interval: float = None, box: tuple = None):
+    """
+    Клик, пауза, еще один клик на том же месте.
+
+    Если передана рамка кнопки box и включен CONFIRM_CLICKS, второй клик
+    делается, как только область кнопки отреагировала на первый и успокоилась,
+    но не позже interval (по умолчанию DOUBLE_CLICK_DELAY); иначе — ровно через interval.
+    """
+    if interval is None:
+        interval = DOUBLE_CLICK_DELAY
+    start = time.perf_counter()
+    
+    confirm = CONFIRM_CLICKS and box is not None
+    if confirm:
+        roi = padded_box(box, LOCATION_ROI_PADDING)
+        baseline = grab_frame(roi)
+    
+    # Первый клик по кнопке
+    input_backend.click(x, y)
+    log_event("click", f"Первый клик выполнен на ({x}, {y})", x=x, y=y)
+    
+    # Ждем реакции интерфейса (или по умолчанию 1 секунду)
+    if confirm:
+        wait_until(settled(baseline), roi, timeout=interval, label="double_click")
+    else:
+        time.sleep(interval)
+    
+    # Второй клик на том же месте
+    input_backend.click(x, y)
+    
+    log_event(
+        "click", f"Второй клик выполнен на ({x}, {y})",
+        x=x, y=y, latency_ms=(time.perf_counter() - start) * 1000,
+    )
+    return True
+
+def recheck_match(match: Match, confidence: float, grayscale: bool = False, scale: float = 1.0):
+    """Ищет кнопку match заново на свежем снимке рядом с ее прежней рамкой. Возвращает Match или None"""
+    region = padded_box(match.box, LOCATION_ROI_PADDING)
+    try:
+        frame = grab_frame(region)
+    except ValueError:  # область вне экрана
+        return None
+    spec = MatchSpec(match.template, region, grayscale, confidence)
+    return match_templates(frame, [spec], scale=scale).find(match.template, confidence, region, grayscale)
+
+def click_match(match: Match, confidence: float, grayscale: bool = False, scale: float = 1.0,
+                detected: float = None, clicks: int = 1, interval: float = None):
+    """
+    Клик (clicks=2 — двойной клик) по кнопке, найденной циклом в момент detected (time.monotonic()).
+
+    Если задание ждало в очереди дольше CLICK_MAX_AGE (исполнитель был занят
+    последовательностью или двойным кликом), кнопка могла сдвинуться или исчезнуть,
+    а на ее месте оказаться другой элемент. Тогда она сначала ищется заново рядом
+    с прежним местом: клик идет по свежей позиции, а если кнопки там больше нет — пропускается.
+    """
+    age = time.monotonic() - detected if detected is not None else 0.0
+    if age > CLICK_MAX_AGE:
+        fresh = recheck_match(match, confidence, grayscale, scale)
+        if fresh is None:
+            log_event("click_stale", f"{Path(match.template).name} пропала, пока клик ждал очереди ({age:.1f} сек) — пропускаю",
+                      level="warning", template=match.template, age_ms=age * 1000)
+            return False
+        match = fresh
+    if clicks == 2:
+        return double_click_at(*match.center, interval, match.box)
+    return click_at(*match.center)
+
+class ClickJob(NamedTuple):
+    """Задание для исполнителя: действие (клик, двойной клик, последовательность) и его параметры"""
+    key: str  # ключ для дедупликации и rate-limit (обычно путь шаблона)
+    action: Callable
+    args: tuple = ()
+    on_done: Callable = None  # вызывается с результатом действия (в потоке исполнителя)
+
+class ActionExecutor:
+    """
+    Исполнитель кликов в отдельном потоке.
+
+    Цикл распознавания только ставит задания в очередь и сразу продолжает
+    работу, а все паузы (CLICK_DELAY, DOUBLE_CLICK_DELAY, SEQ_CLICK_DELAY),
+    сохранение/возврат курсора и rate-limit выполняются здесь.
+    Задания выполняются строго по одному, поэтому курсор не «дерется».
+    """
+
+    def __init__(self, max_queue: int = None):
+        self._queue = queue.Queue(maxsize=max_queue or ACTION_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._pending: set[str] = set()  # ключи заданий в очереди или в работе
+        self._last_done: dict[str, float] = {}  # ключ -> время последнего успешного действия
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def submit(self, key: str, action, *args, min_interval: float = 0.0, on_done=None) -> bool:
+        """
+        Ставит действие в очередь. Возвращает False, если задание с тем же ключом
+        еще не выполнено, если не прошел min_interval с прошлого успешного
+        действия по этому ключу или если очередь переполнена.
+        """
+        with self._lock:
+            if key in self._pending:
+                return False
+            if min_interval and time.time() - self._last_done.get(key, 0.0) < min_interval:
+                return False
+            self._pending.add(key)
+        try:
+            self._queue.put_nowait(ClickJob(key, action, args, on_done))
+        except queue.Full:
+            with self._lock:
+                self._pending.discard(key)
+            log_event("warning", f"Очередь действий переполнена, пропускаю: {key}", level="warning", rule=key)
+            return False
+        return True
+
+    def is_pending(self, key: str) -> bool:
+        with self._lock:
+            return key in self._pending
+
+    def last_done(self, key: str) -> float:
+        with self._lock:
+            return self._last_done.get(key, 0.0)
+
+    def restore_last_done(self, key: str, ts: float):
+        """Время последнего успешного действия из прошлого запуска (для min_interval)"""
+        with self._lock:
+            self._last_done[key] = max(self._last_done.get(key, 0.0), ts)
+
+    def clear(self):
+        """Отменяет задания, которые еще не начали выполняться"""
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._pending.discard(job.key)
+            self._queue.task_done()
+
+    def join(self):
+        """Ждет, пока все поставленные задания выполнятся"""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            result = False
+            start = time.perf_counter()
+            try:
+                result = job.action(*job.args)
+            except Exception as e:
+                log_event("error", f"Ошибка при выполнении действия {job.key}: {e}", level="error", rule=job.key)
+            finally:
+                METRICS.observe("action", job.key, time.perf_counter() - start)
+                with self._lock:
+                    self._pending.discard(job.key)
+                    if result:
+                        self._last_done[job.key] = time.time()
+            if job.on_done is not None:
+                try:
+                    job.on_done(result)
+                except Exception as e:
+                    log_event("error", f"Ошибка в обработчике действия {job.key}: {e}", level="error", rule=job.key)
+            self._queue.task_done()
+
+# Единственный исполнитель кликов (создается в main)
+action_executor = None
+
+def find_and_click_button(
+    button_image_path: str,
+    confidence: float = 0.8,
+    region: tuple = None,
+    grayscale: bool = False,
+    frame: Frame = None,
+):
+    """
+    Ищет кнопку на экране (в указанной области) и кликает по ней
+    
+    Args:
+        button_image_path: Путь к изображению кнопки (ключ реестра TEMPLATES) или Template
+        confidence: Точность поиска (0.0-1.0)
+        region: Область поиска (x, y, width, height) или None для всего экрана
+        frame: Уже снятый кадр экрана (если None — делается новый снимок)
+    
+    Returns:
+        tuple: (найдено: bool, координаты: tuple или None)
+    """
+    try:
+        if frame is None:
+            frame = grab_frame()
+        
+        # Ищем кнопку в кадре (только в указанной области)
+        location = locate_on_frame(
+            button_image_path,
+            frame,
+            confidence=confidence,
+            region=region,  # Ограничиваем поиск правой половиной экрана
+            grayscale=grayscale  # grayscale=True иногда лучше ловит мелкие/шумные иконки
+        )
+        
+        if location:
+            # Находим центр кнопки
+            x, y = box_center(location)
+            
+            log_event("found", f"Кнопка найдена! Координаты: ({x}, {y})", template=get_template(button_image_path).path, x=x, y=y)
+            click_at(x, y)
+            return True, (x, y)
+        else:
+            return False, None
+    
+    except Exception as e:
+        log_event("error", f"Ошибка: {e}", level="error")
+        return False, None
+
+def is_image_visible(
+    image_path: str,
+    confidence: float = 0.8,
+    region: tuple = None,
+    grayscale: bool = False,
+    frame: Frame = None,
+    scale: float = 1.0,
+) -> bool:
+    """Проверяет, видна ли картинка на экране (в указанной области)."""
+    try:
+        if frame is None:
+            frame = grab_frame()
+
+        location = locate_on_frame(
+            image_path,
+            frame,
+            confidence=confidence,
+            region=region,
+            grayscale=grayscale,
+            scale=scale,
+        )
+        return location is not None
+    except Exception as e:
+        log_event("error", f"Ошибка: {e}", level="error")
+        return False
+
+class SequenceStep(NamedTuple):
+    """Шаг последовательности: какие шаблоны кликнуть, сколько ждать перед шагом и сколько — его появления"""
+    templates: list
+    delay: float = 0.0
+    confidence: float = None
+    grayscale: bool = False
+    timeout: float = None  # по умолчанию WAIT_TIMEOUT
+
+def run_sequence(label: str, steps: list[SequenceStep], region: tuple, confidence: float, matches: MatchResult = None):
+    """
+    Выполняет последовательность кликов по шагам (в потоке исполнителя).
+
+    Первый шаг берется из результата сопоставления тика (matches), если он
+    передан. Если способ нажатия пакетный (SEQUENCE_BATCH), шаги, кнопки
+    которых уже видны на экране, кликаются одной пачкой. После каждого клика
+    (при CONFIRM_CLICKS) маленькая область опрашивается, пока не появится
+    кнопка следующего шага или не исчезнет нажатая, — следующий шаг идет
+    сразу, как только интерфейс готов. Если за
+    timeout шага ничего не произошло, шаг считается несостоявшимся и
+    последовательность прерывается с предупреждением.
+    Шаги ищутся в том же масштабе, что и тик (рабочий масштаб цели).
+    """
+    names = " -> ".join(Path(step.templates[0]).stem for step in steps)
+    log_event("sequence", f"{label}: запускаю последовательность {names}", rule=label)
+
+    match = None
+    scale = matches.scale if matches is not None else 1.0
+    if matches is not None:
+        first = steps[0]
+        match = matches.find_any(
+            first.templates, confidence if first.confidence is None else first.confidence, region, first.grayscale,
+        )
+
+    def step_confidence(step: SequenceStep) -> float:
+        return confidence if step.confidence is None else step.confidence
+
+    i = 0
+    while i < len(steps):
+        step = steps[i]
+        if step.delay:
+            time.sleep(step.delay)
+
+        if match is None:
+            # Кнопку шага еще не видели: ждем ее появления (без CONFIRM_CLICKS — одна проверка)
+            check = appeared(step.templates, region, step_confidence(step), step.grayscale, scale)
+            if CONFIRM_CLICKS:
+                match = wait_until(check, wait_region(step.templates, region, scale), step.timeout, label=label)
+            if match is None:
+                # Могла появиться не там, где была раньше, — последняя проверка по всей области
+                match = check(grab_frame(region))
+        if match is None:
+            log_event("sequence_step_missed", f"{label}: шаг {i + 1}: {Path(step.templates[0]).name} не появился",
+                      level="warning", rule=label, step=i + 1)
+            return False
+
+        # Следующие шаги без паузы, кнопки которых уже видны, уходят одной пачкой с этим
+        batch = [match]
+        if SEQUENCE_BATCH and input_backend.batched and i + 1 < len(steps) and not steps[i + 1].delay:
+            frame = grab_frame(region)
+            for following in steps[i + 1:]:
+                found = appeared(
+                    following.templates, region, step_confidence(following), following.grayscale, scale,
+                )(frame)
+                if following.delay or found is None:
+                    break
+                batch.append(found)
+        for n, clicked in enumerate(batch, start=i + 1):
+            log_event("found", f"Шаг {n}: {clicked.template}", rule=label, step=n, template=clicked.template,
+                      score=clicked.score, x=clicked.center[0], y=clicked.center[1])
+        if len(batch) > 1:
+            click_many([clicked.center for clicked in batch])
+        else:
+            click_at(*match.center)
+        i += len(batch)
+        step, clicked = steps[i - 1], batch[-1]
+
+        if not CONFIRM_CLICKS:
+            match = None
+            continue
+        # Подтверждение клика: появилась следующая кнопка (сразу берем ее) или исчезла нажатая
+        gone = disappeared(clicked, step_confidence(step), step.grayscale, scale)
+        if i < len(steps):
+            following = steps[i]
+            next_region = wait_region(following.templates, region, scale)
+            shown = appeared(following.templates, next_region, step_confidence(following), following.grayscale, scale)
+            roi = union_regions([next_region, padded_box(clicked.box, LOCATION_ROI_PADDING)])
+            check = lambda frame: shown(frame) or gone(frame)
+        else:
+            roi, check = padded_box(clicked.box, LOCATION_ROI_PADDING), gone
+        confirmed = wait_until(check, roi, step.timeout, label=label)
+        if confirmed is None:
+            log_event("sequence_step_failed", f"{label}: шаг {i}: клик по {Path(clicked.template).name} не подтвердился",
+                      level="warning", rule=label, step=i, template=clicked.template)
+            return False
+        match = confirmed if isinstance(confirmed, Match) else None
+
+    log_event("sequence_done", f"Последовательность {names} выполнена", rule=label)
+    return True
+
+# Области поиска, на которые могут ссылаться правила: считаются от окна игры
+# (см. WindowLocator), а если окно не задано или потеряно — от экрана
+REGION_SEARCH = "search"  # правая половина окна (экрана, см. get_search_region)
+REGION_FULL = "full"  # все окно (весь экран — None)
+
+def resolve_region(region, regions: dict):
+    """
+    Переводит область из правила ("search", "full" или [x, y, w, h]) в (x, y, w, h) или None.
+    [x, y, w, h] задается относительно левого верхнего угла окна игры (или экрана).
+    """
+    if isinstance(region, str):
+        try:
+            return regions[region]
+        except KeyError:
+            raise ValueError(f"Неизвестная область: {region}") from None
+    x, y, w, h = region
+    window = regions.get(REGION_FULL)
+    if window is not None:
+        return (window[0] + x, window[1] + y, w, h)
+    return (x, y, w, h)
+
+def window_regions(window: tuple) -> dict:
+    """Области для правил внутри окна (x, y, width, height)"""
+    x, y, w, h = window
+    return {REGION_SEARCH: (x + w // 2, y, w - w // 2, h), REGION_FULL: window}
+
+def _find_window_client_rect(title: str, hwnd: int = None):
+    """
+    Клиентская область окна на Windows: (hwnd, (x, y, width, height)) или (None, None).
+    hwnd — уже найденное окно (проверяется только оно), иначе ищется видимое окно,
+    в заголовке которого есть title.
+    """
+    from ctypes import wintypes
+
+    user32 = ctypes.windll.user32
+    if hwnd is None:
+        found = []
+        needle = title.lower()
+
+        @ctypes.WINFUNCTYPE(wintypes.BOOL, wintypes.HWND, wintypes.LPARAM)
+        def check(candidate, _lparam):
+            if user32.IsWindowVisible(candidate):
+                length = user32.GetWindowTextLengthW(candidate)
+                buffer = ctypes.create_unicode_buffer(length + 1)
+                user32.GetWindowTextW(candidate, buffer, length + 1)
+                if needle in buffer.value.lower():
+                    found.append(candidate)
+                    return False
+            return True
+
+        user32.EnumWindows(check, 0)
+        if not found:
+            return None, None
+        hwnd = found[0]
+
+    if not user32.IsWindow(hwnd) or user32.IsIconic(hwnd):
+        return None, None
+    rect = wintypes.RECT()
+    origin = wintypes.POINT(0, 0)
+    if not user32.GetClientRect(hwnd, ctypes.byref(rect)) or not user32.ClientToScreen(hwnd, ctypes.byref(origin)):
+        return None, None
+    if rect.right <= 0 or rect.bottom <= 0:
+        return None, None
+    return hwnd, (origin.x, origin.y, rect.right, rect.bottom)
+
+class WindowLocator:
+    """
+    Следит за клиентской областью окна игры, чтобы правила искали только в нем.
+
+    Окно находится по заголовку (Windows) или по якорному шаблону — картинке,
+    которая всегда видна в окне, с известным смещением от угла окна и размером
+    окна. Найденный прямоугольник кэшируется и раз в WINDOW_REVALIDATE_INTERVAL
+    секунд дешево проверяется (размер окна по hwnd или якорь в маленькой области
+    вокруг прошлой позиции). Пока окно не найдено, правила ищут по всему экрану.
+    """
+
+    def __init__(self, title: str = None, anchor: str = None, anchor_offset: tuple = (0, 0),
+                 size: tuple = None, confidence: float = None, interval: float = None):
+        if not title and not anchor:
+            raise ValueError("Для окна игры нужен title или anchor")
+        if anchor and not size:
+            raise ValueError("Для поиска окна по якорю нужен size — размер окна [ширина, высота]")
+        self.title = title
+        self.anchor = anchor
+        self.anchor_offset = tuple(anchor_offset)
+        self.size = tuple(size) if size else None
+        self.confidence = confidence or CONFIDENCE
+        self.interval = WINDOW_REVALIDATE_INTERVAL if interval is None else interval
+        # По ключу перезагрузка понимает, что окно задано так же и найденный прямоугольник можно оставить
+        self.key = (title, anchor, self.anchor_offset, self.size, self.confidence, self.interval)
+        self.rect = None
+        self.scale = 1.0  # в каком масштабе искать якорь — рабочий масштаб цели (задает Target.regions)
+        self.lost = 0  # сколько раз окно терялось
+        self._hwnd = None
+        self._anchor_box = None
+        self._checked = None
+        self._screen_regions = None
+        self._regions = None
+        if title and not anchor and sys.platform != "win32":
+            log_event("window", "Поиск окна по заголовку работает только на Windows — нужен anchor", level="warning")
+
+    def templates(self) -> list[str]:
+        return [self.anchor] if self.anchor else []
+
+    def describe(self) -> str:
+        how = f"заголовок {self.title!r}" if self.title else f"якорь {Path(self.anchor).name}"
+        return f"Окно игры: {how}, проверка раз в {self.interval:g} сек"
+
+    def regions(self, now: float = None) -> dict:
+        """
+        Области для правил на этом тике. Пока окно на месте, возвращается один
+        и тот же dict — по нему цикл понимает, что пересчитывать ничего не нужно.
+        """
+        now = time.monotonic() if now is None else now
+        if self._checked is None or now - self._checked >= self.interval:
+            self._checked = now
+            self._update(self._revalidate())
+        if self.rect is None:
+            if self._screen_regions is None:
+                self._screen_regions = {REGION_SEARCH: get_search_region(), REGION_FULL: None}
+            return self._screen_regions
+        return self._regions
+
+    def _update(self, rect: tuple):
+        if rect == self.rect:
+            return
+        if rect is None:
+            self.lost += 1
+            log_event("window", "Окно игры потеряно — поиск по всему экрану", level="warning")
+        else:
+            log_event("window", f"Окно игры: {rect[2]}x{rect[3]} в ({rect[0]}, {rect[1]})",
+                      x=rect[0], y=rect[1], width=rect[2], height=rect[3])
+        self.rect = rect
+        self._regions = window_regions(rect) if rect is not None else None
+
+    def _revalidate(self):
+        """Дешевая проверка кэшированного окна; если оно пропало — поиск заново"""
+        if self.title and sys.platform == "win32":
+            self._hwnd, rect = _find_window_client_rect(self.title, self._hwnd)
+            if rect is None and self._hwnd is None:
+                self._hwnd, rect = _find_window_client_rect(self.title)
+            if rect is not None:
+                return rect
+        if self.anchor:
+            rect = None
+            if self._anchor_box is not None:
+                x, y, w, h = self._anchor_box
+                pad = WINDOW_ANCHOR_PADDING
+                rect = self._locate_by_anchor((x - pad, y - pad, w + 2 * pad, h + 2 * pad))
+            return rect or self._locate_by_anchor(None)
+        return None
+
+    def _locate_by_anchor(self, region: tuple):
+        """Ищет якорь в области экрана (None — весь экран) и пересчитывает из него окно"""
+        try:
+            frame = grab_frame(region)
+        except ValueError:  # область вне экрана
+            return None
+        spec = MatchSpec(self.anchor, region, False, self.confidence)
+        match = match_templates(frame, [spec], scale=self.scale).find(self.anchor, self.confidence, region)
+        if match is None:
+            self._anchor_box = None
+            return None
+        self._anchor_box = match.box
+        # Якорь мог найтись в другом масштабе (окно другого размера) — масштабируем смещение и размер
+        k = match.box[2] / get_template(self.anchor).width
+        dx, dy = self.anchor_offset
+        width, height = self.size
+        return (round(match.box[0] - dx * k), round(match.box[1] - dy * k), round(width * k), round(height * k))
+
+class Rule:
+    """
+    Базовое правило: набор шаблонов, область, точность и grayscale.
+    Хранит свое состояние между тиками (был ли виден триггер, счетчик кликов).
+    """
+
+    def __init__(self, config: dict):
+        self.name = config["name"]
+        self.label = config.get("label", self.name)
+        self.enabled = config.get("enabled", True)
+        self.region = config.get("region", REGION_SEARCH)
+        self.confidence = config.get("confidence", CONFIDENCE)
+        self.grayscale = config.get("grayscale", False)
+        self.poll_interval = float(config.get("poll_interval", 0.0))  # 0 = проверять каждый тик
+        self.priority = config.get("priority", 0)  # правила с большим приоритетом сопоставляются первыми
+        self.prev_visible = False
+        self.count = 0
+        self.failed = 0  # сколько действий не выполнилось (например, шаг последовательности не подтвердился)
+        self.last_evaluated = 0.0
+
+    def is_due(self, now: float, executor: ActionExecutor) -> bool:
+        """Пора ли проверять правило на этом тике (с учетом poll_interval)"""
+        return now - self.last_evaluated >= self.poll_interval
+
+    def templates(self) -> list[str]:
+        """Все шаблоны, на которые ссылается правило"""
+        raise NotImplementedError
+
+    def specs(self, regions: dict) -> list[MatchSpec]:
+        """Проверки, которые нужно сопоставить с кадром для этого правила"""
+        raise NotImplementedError
+
+    def evaluate(self, matches: MatchResult, executor: ActionExecutor, regions: dict) -> bool:
+        """
+        Обрабатывает результат сопоставления тика и ставит клики в очередь.
+        Возвращает True, если правило сработало (клик поставлен в очередь).
+        """
+        raise NotImplementedError
+
+    def lookups(self) -> dict:
+        """Варианты шаблонов, которые правило ищет в кадре цикла, с их областями (по полям конфигурации)"""
+        raise NotImplementedError
+
+    def _spec(self, template: str, region, regions: dict, confidence: float = None) -> MatchSpec:
+        """Проверка шаблона: настройки правила или подобранные для шаблона командой tune"""
+        tuned = TUNING["templates"].get(template, {})
+        return MatchSpec(
+            template,
+            resolve_region(tuned.get("region", region), regions),
+            tuned.get("grayscale", self.grayscale),
+            tuned.get("confidence", self.confidence if confidence is None else confidence),
+        )
+
+    def _spec_list(self, templates: list[str], region, regions: dict, confidence: float = None) -> list[MatchSpec]:
+        return [self._spec(t, region, regions, confidence) for t in templates]
+
+    def _find(self, matches: MatchResult, templates: list[str], region, regions: dict, confidence: float = None):
+        for t in templates:
+            spec = self._spec(t, region, regions, confidence)
+            match = matches.find(t, spec.confidence, spec.region, spec.grayscale)
+            if match:
+                return match
+        return None
+
+    def _submit_click(self, executor: ActionExecutor, matches: MatchResult, match: Match, region, regions: dict,
+                      message: str = "всего кликов", clicks: int = 1, interval: float = None,
+                      min_interval: float = 0.0) -> bool:
+        """Ставит клик по match в очередь; запоздавший клик перед выполнением перепроверяет кнопку (click_match)"""
+        spec = self._spec(match.template, region, regions)
+        return executor.submit(
+            self.name, click_match, match, spec.confidence, spec.grayscale, matches.scale, time.monotonic(),
+            clicks, interval, min_interval=min_interval, on_done=self._count(message),
+        )
+
+    def _count(self, message: str = "всего кликов"):
+        """Обработчик завершения действия: увеличивает счетчик и печатает [STATS]"""
+        def on_done(ok):
+            if STATE_STORE is not None:
+                STATE_STORE.record_click(self.name, ok)
+            if ok:
+                self.count += 1
+                log_event("stats", f"{self.label} - {message}: {self.count}", rule=self.name, count=self.count)
+            else:
+                self.failed += 1
+                log_event("failed", f"{self.label} - не выполнено: {self.failed}", level="warning",
+                          rule=self.name, failed=self.failed)
+        return on_done
+
+    def describe(self) -> str:
+        raise NotImplementedError
+
+class ClickRule(Rule):
+    """
+    Клик по кнопке: пока видна (on_appear=false) или только по появлению (on_appear=true).
+    clicks=2 — двойной клик с паузой click_interval. Повторный клик — не раньше чем
+    через min_interval секунд после прошлого (по умолчанию CLICK_REPEAT_INTERVAL).
+    """
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        self.template_paths = list(config["templates"])
+        self.on_appear = config.get("on_appear", False)
+        self.clicks = config.get("clicks", 1)
+        self.click_interval = config.get("click_interval", DOUBLE_CLICK_DELAY)
+        self.min_interval = float(config.get("min_interval", CLICK_REPEAT_INTERVAL))
+        if self.clicks not in (1, 2):
+            raise ValueError(f"Правило {self.name}: clicks может быть только 1 или 2")
+
+    def templates(self) -> list[str]:
+        return self.template_paths
+
+    def lookups(self) -> dict:
+        return {"templates": (self.template_paths, self.region)}
+
+    def specs(self, regions: dict) -> list[MatchSpec]:
+        return self._spec_list(self.template_paths, self.region, regions)
+
+    def _submit(self, executor: ActionExecutor, matches: MatchResult, match: Match, regions: dict) -> bool:
+        if self.clicks == 2:
+            return self._submit_click(executor, matches, match, self.region, regions, "всего двойных кликов",
+                                      clicks=2, interval=self.click_interval, min_interval=self.min_interval)
+        return self._submit_click(executor, matches, match, self.region, regions, min_interval=self.min_interval)
+
+    def evaluate(self, matches: MatchResult, executor: ActionExecutor, regions: dict) -> bool:
+        match = self._find(matches, self.template_paths, self.region, regions)
+        visible = match is not None
+        fired = False
+        # Кнопка после клика не пропала сразу — на частых тиках (BURST_CHECK_INTERVAL) не кликаем по ней повторно
+        recent = time.time() - executor.last_done(self.name) < self.min_interval
+        if visible and not (self.on_appear and self.prev_visible) and not recent and not executor.is_pending(self.name):
+            x, y = match.center
+            log_event(
+                "found", f"{self.label} найдена! Координаты: ({x}, {y}) (шаблон: {match.template})",
+                rule=self.name, template=match.template, score=match.score, x=x, y=y,
+            )
+            fired = self._submit(executor, matches, match, regions)
+        # Клик не поставлен (прошлый клик правила еще в очереди или очередь полна) —
+        # появление не считается обработанным: on_appear попробует снова на следующем тике
+        if fired or not visible:
+            self.prev_visible = visible
+        return fired
+
+    def describe(self) -> str:
+        mode = "клик по появлению" if self.on_appear else "клик, пока видна"
+        if self.clicks == 2:
+            mode = f"двойной клик с паузой {self.click_interval} сек"
+        return f"{self.label}: {', '.join(self.template_paths)} ({mode})"
+
+class RateLimitedClickRule(ClickRule):
+    """Клик по кнопке, пока она видна, но не чаще 1 раза в min_interval секунд"""
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        self.min_interval = float(config["min_interval"])
+
+    def is_due(self, now: float, executor: ActionExecutor) -> bool:
+        # Пока не прошел min_interval с прошлого клика, искать кнопку незачем
+        if time.time() - executor.last_done(self.name) < self.min_interval:
+            return False
+        return super().is_due(now, executor)
+
+    def evaluate(self, matches: MatchResult, executor: ActionExecutor, regions: dict) -> bool:
+        match = self._find(matches, self.template_paths, self.region, regions)
+        self.prev_visible = match is not None
+        if match is None or time.time() - executor.last_done(self.name) < self.min_interval:
+            return False
+        x, y = match.center
+        if self._submit_click(executor, matches, match, self.region, regions, min_interval=self.min_interval):
+            log_event(
+                "found", f"{self.label} видна -> кликаю (rate-limit {self.min_interval:g} сек)",
+                rule=self.name, template=match.template, score=match.score, x=x, y=y,
+            )
+            return True
+        return False
+
+    def describe(self) -> str:
+        return f"{self.label}: {', '.join(self.template_paths)} (не чаще 1 раза в {self.min_interval:g} сек)"
+
+class TriggerRule(Rule):
+    """Когда появляется trigger — один раз нажать target (ищется в том же кадре)"""
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        self.trigger = list(config["trigger"])
+        self.target = list(config["target"])
+        self.target_region = config.get("target_region", self.region)
+
+    def templates(self) -> list[str]:
+        return self.trigger + self.target
+
+    def lookups(self) -> dict:
+        return {"trigger": (self.trigger, self.region), "target": (self.target, self.target_region)}
+
+    def specs(self, regions: dict) -> list[MatchSpec]:
+        return (
+            self._spec_list(self.trigger, self.region, regions)
+            + self._spec_list(self.target, self.target_region, regions)
+        )
+
+    def evaluate(self, matches: MatchResult, executor: ActionExecutor, regions: dict) -> bool:
+        visible = self._find(matches, self.trigger, self.region, regions) is not None
+        fired = visible and not self.prev_visible
+        if fired and executor.is_pending(self.name):
+            # Прошлый клик правила еще в очереди — появление обработаем на следующем тике
+            return False
+        if fired:
+            target_name = ", ".join(Path(t).stem for t in self.target)
+            log_event("trigger", f"{self.label} появился -> пытаюсь нажать {target_name}", rule=self.name)
+            match = self._find(matches, self.target, self.target_region, regions)
+            if match:
+                log_event(
+                    "found", f"{target_name} найдена (шаблон: {match.template})", level="debug",
+                    rule=self.name, template=match.template, score=match.score, x=match.center[0], y=match.center[1],
+                )
+                if not self._submit_click(executor, matches, match, self.target_region, regions):
+                    log_event("click_skipped", f"{self.label}: клик не поставлен в очередь, повторю на следующем тике",
+                              level="warning", rule=self.name)
+                    return False
+            else:
+                log_event("target_missed", f"{target_name} не найдена, хотя {self.label} виден", rule=self.name)
+        self.prev_visible = visible
+        return fired
+
+    def describe(self) -> str:
+        return f"{self.label}: {', '.join(self.trigger)} -> нажать: {', '.join(self.target)}"
+
+class SequenceRule(Rule):
+    """Когда появляется trigger — выполнить последовательность кликов по шагам"""
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        self.trigger = list(config["trigger"])
+        self.steps = []
+        for i, step in enumerate(config["steps"]):
+            self.steps.append(SequenceStep(
+                templates=list(step["templates"]),
+                delay=step.get("delay", SEQ_CLICK_DELAY if i and not CONFIRM_CLICKS else 0.0),
+                confidence=step.get("confidence"),
+                grayscale=step.get("grayscale", self.grayscale),
+                timeout=step.get("timeout"),
+            ))
+        if not self.steps:
+            raise ValueError(f"Правило {self.name}: пустой список steps")
+
+    def templates(self) -> list[str]:
+        return self.trigger + [t for step in self.steps for t in step.templates]
+
+    def lookups(self) -> dict:
+        # Шаги ищутся исполнителем уже после кликов (run_sequence) — подбирается только триггер
+        return {"trigger": (self.trigger, self.region)}
+
+    def specs(self, regions: dict) -> list[MatchSpec]:
+        # Первый шаг ищется в том же кадре, что и триггер; остальные — после кликов, в новых кадрах
+        first = self.steps[0]
+        region = resolve_region(self.region, regions)
+        confidence = self.confidence if first.confidence is None else first.confidence
+        return self._spec_list(self.trigger, self.region, regions) + [
+            MatchSpec(t, region, first.grayscale, confidence) for t in first.templates
+        ]
+
+    def evaluate(self, matches: MatchResult, executor: ActionExecutor, regions: dict) -> bool:
+        visible = self._find(matches, self.trigger, self.region, regions) is not None
+        fired = visible and not self.prev_visible
+        if fired and executor.is_pending(self.name):
+            # Прошлая последовательность еще выполняется — появление обработаем после нее
+            return False
+        if fired and not executor.submit(
+            self.name, run_sequence,
+            self.label, self.steps, resolve_region(self.region, regions), self.confidence, matches,
+            on_done=self._count("выполнено раз"),
+        ):
+            log_event("click_skipped", f"{self.label}: последовательность не поставлена в очередь, повторю на следующем тике",
+                      level="warning", rule=self.name)
+            return False
+        self.prev_visible = visible
+        return fired
+
+    def describe(self) -> str:
+        steps = " -> ".join(", ".join(step.templates) for step in self.steps)
+        return f"{self.label}: {', '.join(self.trigger)} -> {steps}"
+
+# Типы правил, которые можно использовать в файле правил
+RULE_TYPES = {
+    "click": ClickRule,
+    "rate_limited": RateLimitedClickRule,
+    "trigger": TriggerRule,
+    "sequence": SequenceRule,
+}
+
+def load_rules(path: str = None, target: str = None) -> list[Rule]:
+    """
+    Загружает правила из JSON-файла (по умолчанию RULES_PATH).
+    Поля из секции "rules" подобранных настроек (TUNING) заменяют поля правила.
+    Для цели target (см. Target) имена правил получают префикс "target/",
+    чтобы клики и статистика разных клиентов игры не смешивались.
+    """
+    path = path or RULES_PATH
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+
+    rules = []
+    names = set()
+    for i, rule_config in enumerate(config.get("rules", [])):
+        rule_config = {**rule_config, **TUNING["rules"].get(rule_config.get("name"), {})}
+        rule_type = rule_config.get("type")
+        if rule_type not in RULE_TYPES:
+            raise ValueError(f"{path}: правило #{i + 1}: неизвестный тип {rule_type!r}")
+        try:
+            rule = RULE_TYPES[rule_type](rule_config)
+        except KeyError as e:
+            raise ValueError(f"{path}: правило #{i + 1}: не указано поле {e}") from None
+        if rule.name in names:
+            raise ValueError(f"{path}: повторяется имя правила {rule.name!r}")
+        names.add(rule.name)
+        if target:
+            rule.name = f"{target}/{rule.name}"
+            rule.label = f"[{target}] {rule.label}"
+        rules.append(rule)
+    return rules
+
+def load_window_locator(path: str = None):
+    """
+    Читает секцию "window" файла правил и возвращает WindowLocator
+    (или None, если окно игры не задано — тогда правила ищут по экрану):
+
+        "window": {"title": "Игра", "anchor": "logo.png", "anchor_offset": [10, 5], "size": [1280, 720]}
+    """
+    path = path or RULES_PATH
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f).get("window")
+    if not config:
+        return None
+    return _window_locator(config, path)
+
+def _window_locator(config: dict, source: str) -> WindowLocator:
+    try:
+        return WindowLocator(
+            title=config.get("title"),
+            anchor=config.get("anchor"),
+            anchor_offset=config.get("anchor_offset", (0, 0)),
+            size=config.get("size"),
+            confidence=config.get("confidence"),
+            interval=config.get("revalidate_interval"),
+        )
+    except ValueError as e:
+        raise ValueError(f"{source}: window: {e}") from None
+
+class RuleEngine:
+    """
+    Набор включенных правил. compile() собирает из них один дедуплицированный
+    список проверок на кадр, evaluate() раздает результат сопоставления правилам.
+    Правила с poll_interval проверяются не на каждом тике (см. due_rules()).
+    """
+
+    def __init__(self, rules: list[Rule]):
+        # Порядок правил = порядок проверок в пуле сопоставления (сначала высокий приоритет)
+        self.rules = sorted((r for r in rules if r.enabled), key=lambda r: -r.priority)
+
+    def templates(self) -> list[str]:
+        return list(dict.fromkeys(t for rule in self.rules for t in rule.templates()))
+
+    def due_rules(self, now: float, executor: ActionExecutor) -> list[Rule]:
+        """Правила, которые пора проверять на этом тике"""
+        return [rule for rule in self.rules if rule.is_due(now, executor)]
+
+    def compile(self, regions: dict, rules: list[Rule] = None) -> list[MatchSpec]:
+        rules = self.rules if rules is None else rules
+        return list(dict.fromkeys(spec for rule in rules for spec in rule.specs(regions)))
+
+    def capture_region(self, regions: dict) -> tuple:
+        """Область экрана, которую нужно снимать: объединение областей всех правил (None — весь экран)"""
+        return union_regions(spec.region for spec in self.compile(regions))
+
+    def evaluate(self, matches: MatchResult, executor: ActionExecutor, regions: dict,
+                 rules: list[Rule] = None, now: float = None) -> bool:
+        """Возвращает True, если сработало хотя бы одно правило"""
+        rules = self.rules if rules is None else rules
+        now = time.monotonic() if now is None else now
+        fired = False
+        for rule in rules:
+            fired = rule.evaluate(matches, executor, regions) or fired
+            rule.last_evaluated = now
+        return fired
+
+class Target:
+    """
+    Один клиент игры: своя область на экране (окно или заданный прямоугольник),
+    свои экземпляры правил (prev_visible, счетчики кликов) и статистика.
+    У каждой цели свой рабочий масштаб шаблонов (calibrator): окна клиентов
+    могут быть разного размера. Снимок экрана, кэш шаблонов и исполнитель
+    кликов общие для всех целей.
+
+    exclusive — целей несколько: пока окно цели не найдено, она пропускается
+    (иначе ее правила искали бы по всему экрану и нажимали кнопки чужих окон).
+    """
+
+    def __init__(self, name: str, engine: RuleEngine, locator: WindowLocator = None,
+                 rect: tuple = None, exclusive: bool = False):
+        self.name = name
+        self.engine = engine
+        self.locator = locator
+        self.rect = rect
+        self.exclusive = exclusive
+        self.fired = 0  # сколько тиков у цели срабатывало хотя бы одно правило
+        self.calibrator = ScaleCalibration()
+        self._regions = window_regions(rect) if rect is not None else None
+
+    @property
+    def scale(self) -> float:
+        return self.calibrator.scale if SCALE_CALIBRATION else 1.0
+
+    def regions(self, now: float = None) -> dict:
+        """Области для правил цели на этом тике или None, если цель сейчас неактивна"""
+        if self.locator is not None:
+            self.locator.scale = self.scale
+            regions = self.locator.regions(now)
+            if self.exclusive and self.locator.rect is None:
+                return None
+            return regions
+        if self._regions is None:
+            self._regions = {REGION_SEARCH: get_search_region(), REGION_FULL: None}
+        return self._regions
+
+    def templates(self) -> list[str]:
+        return self.engine.templates() + (self.locator.templates() if self.locator else [])
+
+    def describe(self) -> str:
+        if self.locator is not None:
+            where = self.locator.describe()
+        elif self.rect is not None:
+            where = "область {}x{} в ({}, {})".format(self.rect[2], self.rect[3], *self.rect[:2])
+        else:
+            where = "весь экран"
+        return f"Цель {self.name or 'по умолчанию'}: {where}, правил: {len(self.engine.rules)}"
+
+    def stats(self) -> dict:
+        rules = self.engine.rules
+        return {
+            "clicks": sum(rule.count for rule in rules),
+            "failed": sum(rule.failed for rule in rules),
+            "fired_ticks": self.fired,
+            "window": self.locator.rect if self.locator is not None else self.rect,
+            "scale": self.calibrator.stats(),
+        }
+
+def load_targets(path: str = None) -> list[Target]:
+    """
+    Загружает цели из файла правил. Без секции "targets" — одна цель
+    (окно из секции "window" или весь экран). С ней — по цели на клиент игры,
+    у каждой свое окно или область и свой экземпляр всех правил:
+
+        "targets": [{"name": "left", "window": {...}}, {"name": "right", "region": [960, 0, 960, 1080]}]
     """
-    Ищет кнопку на экране (в указанной области) и кликает по ней
-    
-    Args:
-        button_image_path: Путь к изображению кнопки
-        confidence: Точность поиска (0.0-1.0)
-        region: Область поиска (x, y, width, height) или None для всего экрана
-    
-    Returns:
-        tuple: (найдено: bool, координаты: tuple или None)
+    path = path or RULES_PATH
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f).get("targets")
+    if not config:
+        return [Target(None, RuleEngine(load_rules(path)), load_window_locator(path))]
+
+    targets = []
+    names = set()
+    for i, target_config in enumerate(config):
+        name = target_config.get("name")
+        if not name:
+            raise ValueError(f"{path}: цель #{i + 1}: не указано поле 'name'")
+        if name in names:
+            raise ValueError(f"{path}: повторяется имя цели {name!r}")
+        names.add(name)
+        if not target_config.get("window") and not target_config.get("region"):
+            raise ValueError(f"{path}: цель {name}: нужна window или region")
+        locator = _window_locator(target_config["window"], f"{path}: цель {name}") if target_config.get("window") else None
+        rect = tuple(target_config["region"]) if target_config.get("region") else None
+        targets.append(Target(name, RuleEngine(load_rules(path, target=name)), locator, rect, exclusive=True))
+    return targets
+
+# Значения настроек из RELOADABLE_SETTINGS, заданные в коде: к ним возвращаемся,
+# если настройку убрали из секции "settings"
+DEFAULT_SETTINGS = {name: globals()[name] for name in RELOADABLE_SETTINGS}
+
+def load_settings(path: str = None) -> dict:
     """
-    try:
-        # Проверяем существование файла
-        if not os.path.exists(button_image_path):
-            print(f"[!] Файл изображения не найден: {button_image_path}")
-            return False, None
-        
-        # Ищем кнопку на экране (только в указанной области)
-        location = pyautogui.locateOnScreen(
-            button_image_path,
-            confidence=confidence,
-            region=region,  # Ограничиваем поиск правой половиной экрана
-            grayscale=grayscale  # grayscale=True иногда лучше ловит мелкие/шумные иконки
-        )
-        
-        if location:
-            # Находим центр кнопки
-            center = pyautogui.center(location)
-            x, y = center
-            
-            print(f"[OK] Кнопка найдена! Координаты: ({x}, {y})")
-            
-            # Сохраняем текущую позицию курсора
-            original_pos = pyautogui.position()
-            
-            # Мгновенный клик по кнопке
-            pyautogui.click(x, y)
-            time.sleep(CLICK_DELAY)
-            
-            # Возвращаем курсор точно на исходное место
-            pyautogui.moveTo(original_pos.x, original_pos.y)
-            
-            print(f"[CLICK] Клик выполнен, курсор возвращен на ({original_pos.x}, {original_pos.y})")
-            return True, (x, y)
+    Читает секцию "settings" файла правил и возвращает значения всех настроек
+    из RELOADABLE_SETTINGS (незаданные — по умолчанию):
+
+        "settings": {"confidence": 0.75, "check_interval": 0.05}
+    """
+    path = path or RULES_PATH
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f).get("settings") or {}
+
+    settings = dict(DEFAULT_SETTINGS)
+    for key, value in config.items():
+        name = key.upper()
+        if name not in RELOADABLE_SETTINGS:
+            raise ValueError(f"{path}: settings: неизвестная настройка {key!r}")
+        default = DEFAULT_SETTINGS[name]
+        if isinstance(default, bool) or isinstance(value, bool):
+            valid = isinstance(value, bool) and isinstance(default, bool)
+        elif isinstance(default, int):
+            valid = isinstance(value, int)
         else:
-            return False, None
-    
-    except pyautogui.ImageNotFoundException:
-        return False, None
-    except Exception as e:
-        print(f"[ERROR] Ошибка: {e}")
-        return False, None
+            valid = isinstance(value, (int, float))
+        if not valid:
+            raise ValueError(f"{path}: settings: {key} должно быть {type(default).__name__}, а не {value!r}")
+        settings[name] = value
+    return settings
 
-def find_and_double_click_button(button_image_path: str, confidence: float = 0.8, region: tuple = None):
+def load_tuning(path: str = None) -> dict:
     """
-    Ищет кнопку на экране (в указанной области) и выполняет двойной клик с задержкой
-    
-    Поведение: клик, пауза 1 секунда, еще один клик на том же месте
-    
-    Args:
-        button_image_path: Путь к изображению кнопки
-        confidence: Точность поиска (0.0-1.0)
-        region: Область поиска (x, y, width, height) или None для всего экрана
-    
-    Returns:
-        tuple: (найдено: bool, координаты: tuple или None)
+    Читает настройки, подобранные командой tune (по умолчанию TUNING_PATH).
+    Если файла нет — пустые настройки: шаблоны ищутся так, как задано в правилах.
     """
-    try:
-        # Проверяем существование файла
-        if not os.path.exists(button_image_path):
-            print(f"[!] Файл изображения не найден: {button_image_path}")
-            return False, None
-        
-        # Ищем кнопку на экране (только в указанной области)
-        location = pyautogui.locateOnScreen(
-            button_image_path,
-            confidence=confidence,
-            region=region,  # Ограничиваем поиск правой половиной экрана
-            grayscale=False  # Можно включить grayscale=True для ускорения
-        )
-        
-        if location:
-            # Находим центр кнопки
-            center = pyautogui.center(location)
-            x, y = center
-            
-            print(f"[OK] Кнопка 2 найдена! Координаты: ({x}, {y})")
-            
-            # Сохраняем текущую позицию курсора
-            original_pos = pyautogui.position()
-            
-            # Первый клик по кнопке
-            pyautogui.click(x, y)
-            print(f"[CLICK] Первый клик выполнен на ({x}, {y})")
-            
-            # Ждем 1 секунду
-            time.sleep(DOUBLE_CLICK_DELAY)
-            
-            # Второй клик на том же месте
-            pyautogui.click(x, y)
-            time.sleep(CLICK_DELAY)
-            
-            # Возвращаем курсор точно на исходное место
-            pyautogui.moveTo(original_pos.x, original_pos.y)
-            
-            print(f"[CLICK] Второй клик выполнен на ({x}, {y}), курсор возвращен на ({original_pos.x}, {original_pos.y})")
-            return True, (x, y)
-        else:
-            return False, None
-    
-    except pyautogui.ImageNotFoundException:
-        return False, None
-    except Exception as e:
-        print(f"[ERROR] Ошибка: {e}")
-        return False, None
+    path = TUNING_PATH if path is None else path
+    if not path or not os.path.exists(path):
+        return {"templates": {}, "rules": {}}
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    for section in ("templates", "rules"):
+        if not isinstance(config.get(section, {}), dict):
+            raise ValueError(f"{path}: секция {section!r} должна быть объектом")
+    return {"templates": config.get("templates", {}), "rules": config.get("rules", {})}
 
-def is_image_visible(
-    image_path: str,
-    confidence: float = 0.8,
-    region: tuple = None,
-    grayscale: bool = False,
-) -> bool:
-    """Проверяет, видна ли картинка на экране (в указанной области)."""
-    try:
-        if not os.path.exists(image_path):
-            print(f"[!] Файл изображения не найден: {image_path}")
-            return False
+def apply_settings(settings: dict) -> dict:
+    """Применяет настройки; возвращает прежние значения (чтобы можно было откатить)"""
+    previous = {name: globals()[name] for name in settings}
+    globals().update(settings)
+    return previous
 
-        location = pyautogui.locateOnScreen(
-            image_path,
-            confidence=confidence,
-            region=region,
-            grayscale=grayscale,
+class HotReloader:
+    """
+    Горячая перезагрузка правил, настроек и шаблонов без перезапуска цикла.
+
+    Раз в RELOAD_CHECK_INTERVAL секунд сравнивает время изменения и размер
+    файла правил, подобранных настроек (TUNING_PATH) и файлов шаблонов с запомненными. Если что-то изменилось,
+    новая конфигурация целиком собирается в стороне (цели, правила и заново
+    подготовленные шаблоны — только изменившиеся или новые) и подменяется
+    циклом между тиками. Счетчики и prev_visible правил (по имени), найденные
+    окна, память позиций и результаты сопоставления неизменившихся шаблонов
+    сохраняются. Если в новом файле ошибка — работаем со старой конфигурацией.
+    """
+
+    def __init__(self, path: str = None, interval: float = None):
+        self.path = path or RULES_PATH
+        self.interval = RELOAD_CHECK_INTERVAL if interval is None else interval
+        self.reloads = 0
+        self.errors = 0
+        self._checked = None
+        # Правила, которых нет в текущей конфигурации (выключены или удалены):
+        # если они вернутся, их счетчики продолжатся
+        self._retired: dict[str, Rule] = {}
+        self._config = [self.path, TUNING_PATH] if TUNING_PATH else [self.path]
+        self._watched = self._needed(targets)
+        self._stamps = {p: self._stamp(p) for p in [*self._config, *self._watched]}
+
+    @staticmethod
+    def _needed(active: list[Target]) -> list[str]:
+        return list(dict.fromkeys(t for target in active for t in target.templates()))
+
+    @staticmethod
+    def _stamp(path: str):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def check(self, now: float = None):
+        """
+        Вызывается циклом между тиками. Возвращает None, если ничего не
+        перезагружено, иначе множество шаблонов, подготовленных заново
+        (их результаты прошлого тика нужно забыть — см. MatchResult.discard).
+        """
+        now = time.monotonic() if now is None else now
+        if self._checked is not None and now - self._checked < self.interval:
+            return None
+        self._checked = now
+        stamps = {p: self._stamp(p) for p in self._stamps}
+        if stamps == self._stamps:
+            return None
+
+        changed = {p for p, stamp in stamps.items() if stamp != self._stamps[p]}
+        try:
+            reloaded = self.reload(bool(changed & set(self._config)), changed - set(self._config))
+        except (OSError, ValueError) as e:
+            self.errors += 1
+            log_event("reload", f"Не удалось перезагрузить конфигурацию, работаем со старой: {e}", level="error")
+            reloaded = None
+        # И после ошибки: следующая попытка — когда файлы изменятся снова (например, допишутся)
+        self._stamps = {p: stamps[p] if p in stamps else self._stamp(p) for p in [*self._config, *self._watched]}
+        return reloaded
+
+    def reload(self, rules_changed: bool = True, changed_templates: set = frozenset()) -> set:
+        """Собирает новую конфигурацию и подменяет ее; при ошибке все остается как было"""
+        global targets, TUNING
+        new_targets = None
+        previous_settings = previous_tuning = None
+        try:
+            if rules_changed:
+                previous_settings = apply_settings(load_settings(self.path))
+                previous_tuning, TUNING = TUNING, load_tuning()
+                new_targets = load_targets(self.path)
+            needed = self._needed(targets if new_targets is None else new_targets)
+            stale = [p for p in needed if p not in TEMPLATES or p in changed_templates]
+            fresh = load_templates(stale, registry={})
+        except (OSError, ValueError):
+            if previous_settings is not None:
+                apply_settings(previous_settings)
+            if previous_tuning is not None:
+                TUNING = previous_tuning
+            raise
+
+        # Все собрано — подменяем. Старые шаблоны остаются в реестре:
+        # их могут ждать клики, уже стоящие в очереди исполнителя
+        if new_targets is not None:
+            self._transfer(targets, new_targets)
+            targets = new_targets
+            LOCATION_MEMORY.history = LOCATION_HISTORY * len(targets)
+        TEMPLATES.update(fresh)
+        for path in fresh:
+            LOCATION_MEMORY.forget(path)
+        if MATCH_POOL == "process":
+            # У процессов-воркеров свои копии шаблонов и настроек — пул создастся заново
+            retire_match_pool()
+        self._watched = needed
+        self.reloads += 1
+
+        rules_total = sum(len(target.engine.rules) for target in targets)
+        names = ", ".join(Path(p).name for p in fresh) or "нет"
+        log_event(
+            "reload", f"Конфигурация перезагружена: правил {rules_total}, шаблонов подготовлено заново: {names}",
+            rules=rules_total, templates=list(fresh), rules_changed=rules_changed,
         )
-        return location is not None
-    except pyautogui.ImageNotFoundException:
-        return False
-    except Exception as e:
-        print(f"[ERROR] Ошибка: {e}")
-        return False
+        return set(fresh)
 
-def click_target_image(
-    target_image_path: str,
-    confidence: float = 0.8,
-    region: tuple = None,
-    grayscale: bool = False,
-):
-    """Ищет target-картинку и кликает по ней 1 раз, с возвратом курсора."""
-    return find_and_click_button(
-        target_image_path,
-        confidence=confidence,
-        region=region,
-        grayscale=grayscale,
+    def _transfer(self, old_targets: list[Target], new_targets: list[Target]):
+        """Переносит состояние правил (по имени), окон и счетчиков целей в новую конфигурацию"""
+        old_rules = dict(self._retired)
+        old_rules.update((rule.name, rule) for target in old_targets for rule in target.engine.rules)
+        old_by_name = {target.name: target for target in old_targets}
+        for target in new_targets:
+            old = old_by_name.get(target.name)
+            if old is not None:
+                target.fired = old.fired
+                target.calibrator = old.calibrator
+                if target.locator is not None and old.locator is not None and target.locator.key == old.locator.key:
+                    target.locator = old.locator
+            for rule in target.engine.rules:
+                old_rule = old_rules.pop(rule.name, None)
+                if old_rule is not None and type(old_rule) is type(rule):
+                    rule.prev_visible = old_rule.prev_visible
+                    rule.count = old_rule.count
+                    rule.failed = old_rule.failed
+                    rule.last_evaluated = old_rule.last_evaluated
+        self._retired = old_rules
+
+class StateStore:
+    """
+    Состояние между запусками в SQLite-файле (STATE_PATH).
+
+    - state — снимок: по строке на правило (счетчики, prev_visible, время
+      последнего клика для rate-limit) и на шаблон (память позиций). Восстановление
+      на старте — один SELECT небольшой таблицы, его время не зависит от длины истории.
+    - clicks — журнал кликов (время, правило, выполнен ли), только дописывается;
+      по нему строится число кликов по времени (throughput()).
+
+    Пишет фоновый поток раз в STATE_FLUSH_INTERVAL секунд одной транзакцией:
+    новые клики и те строки снимка, что изменились с прошлой записи.
+    Цикл и исполнитель кликов диск не ждут.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS clicks (ts REAL NOT NULL, rule TEXT NOT NULL, ok INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS clicks_ts ON clicks (ts)",
     )
 
-def click_any_target_image(
-    target_image_paths: list[str],
-    confidence: float = 0.8,
-    region: tuple = None,
-    grayscale: bool = False,
-):
-    """Пробует кликнуть по первой найденной картинке из списка."""
-    for p in target_image_paths:
-        found, coords = click_target_image(p, confidence=confidence, region=region, grayscale=grayscale)
-        if found:
-            return True, coords, p
-    return False, None, None
-
-def is_any_image_visible(
-    image_paths: list[str],
-    confidence: float = 0.8,
-    region: tuple = None,
-    grayscale: bool = False,
-) -> bool:
-    """True, если любая из картинок видна."""
-    for p in image_paths:
-        if is_image_visible(p, confidence=confidence, region=region, grayscale=grayscale):
-            return True
-    return False
+    def __init__(self, path: str = None, interval: float = None, snapshot: Callable = None):
+        self.path = path or STATE_PATH
+        self.interval = STATE_FLUSH_INTERVAL if interval is None else interval
+        self.snapshot = snapshot  # функция -> {ключ: значение}; вызывается в фоновом потоке
+        self.writes = 0  # сколько транзакций записано
+        self._clicks: list[tuple] = []
+        self._lock = threading.Lock()
+        self._written: dict = {}  # что уже лежит в таблице state
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5.0)
+        conn.execute("PRAGMA journal_mode=WAL")  # чтение (команда stats) не мешает записи
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def open(self):
+        """Создает таблицы и удаляет клики старше STATE_CLICK_RETENTION"""
+        conn = self._connect()
+        try:
+            with conn:
+                for statement in self.SCHEMA:
+                    conn.execute(statement)
+                conn.execute("DELETE FROM clicks WHERE ts < ?", (time.time() - STATE_CLICK_RETENTION,))
+        finally:
+            conn.close()
+        return self
+
+    def load(self) -> dict:
+        """Сохраненный снимок: ключ -> значение"""
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT key, value FROM state").fetchall()
+        finally:
+            conn.close()
+        state = {key: json.loads(value) for key, value in rows}
+        self._written.update(state)  # неизменившееся не переписываем
+        return state
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="state", daemon=True)
+            self._thread.start()
+        return self
+
+    def record_click(self, rule: str, ok: bool, ts: float = None):
+        """Добавляет клик в журнал (запишется фоновым потоком)"""
+        with self._lock:
+            self._clicks.append((time.time() if ts is None else ts, rule, int(bool(ok))))
 
-def run_btn9_sequence(confidence: float, region: tuple):
+    def close(self, timeout: float = 5.0):
+        """Записывает накопленное и останавливает фоновый поток"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        conn = self._connect()
+        try:
+            while not self._stop.wait(self.interval):
+                self._flush(conn)
+            self._flush(conn)
+        finally:
+            conn.close()
+
+    def _flush(self, conn: sqlite3.Connection):
+        # Одна неудачная запись (например, снимок, снятый во время перезагрузки правил)
+        # не должна останавливать поток: следующая попытка — через interval
+        try:
+            self._write(conn)
+        except Exception as e:
+            log_event("error", f"Ошибка при сохранении состояния: {e}", level="error")
+
+    def _write(self, conn: sqlite3.Connection):
+        state = self.snapshot() if self.snapshot is not None else {}  # до того, как забрать клики
+        with self._lock:
+            clicks, self._clicks = self._clicks, []
+        try:
+            changed = {key: value for key, value in state.items() if self._written.get(key) != value}
+            if not clicks and not changed:
+                return
+            now = time.time()
+            with conn:
+                conn.executemany("INSERT INTO clicks (ts, rule, ok) VALUES (?, ?, ?)", clicks)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO state (key, value, updated) VALUES (?, ?, ?)",
+                    [(key, json.dumps(value, ensure_ascii=False), now) for key, value in changed.items()],
+                )
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            log_event("error", f"Не удалось сохранить состояние в {self.path}: {e}", level="error")
+            return
+        self._written.update(changed)
+        self.writes += 1
+
+    def throughput(self, since: float = None, bucket: float = 60.0) -> list[tuple]:
+        """
+        Клики по интервалам в bucket секунд начиная с since (unix-время; по умолчанию за последний час):
+        список (начало интервала, всего кликов, выполнено)
+        """
+        since = time.time() - 3600 if since is None else since
+        conn = self._connect()
+        try:
+            return conn.execute(
+                "SELECT CAST(ts / ? AS INTEGER) * ? AS start, COUNT(*), SUM(ok) FROM clicks"
+                " WHERE ts >= ? GROUP BY start ORDER BY start",
+                (bucket, bucket, since),
+            ).fetchall()
+        finally:
+            conn.close()
+
+    def rule_totals(self, since: float = None) -> list[tuple]:
+        """Клики по правилам начиная с since: список (правило, всего, выполнено)"""
+        since = time.time() - 3600 if since is None else since
+        conn = self._connect()
+        try:
+            return conn.execute(
+                "SELECT rule, COUNT(*), SUM(ok) FROM clicks WHERE ts >= ? GROUP BY rule ORDER BY COUNT(*) DESC",
+                (since,),
+            ).fetchall()
+        finally:
+            conn.close()
+
+# Хранилище состояния (создается в main, если задан STATE_PATH)
+STATE_STORE = None
+
+def state_snapshot() -> dict:
+    """Текущее состояние для StateStore: по записи на правило и на шаблон"""
+    state = {}
+    # Вызывается из потока StateStore: HotReloader в это время может менять
+    # targets, правила и TEMPLATES, поэтому обходим копии
+    for target in list(targets):
+        for rule in list(target.engine.rules):
+            state[f"rule:{rule.name}"] = {
+                "count": rule.count,
+                "failed": rule.failed,
+                "prev_visible": rule.prev_visible,
+                "last_done": action_executor.last_done(rule.name) if action_executor is not None else 0.0,
+            }
+    counters = LOCATION_MEMORY.stats()["templates"]
+    for path in list(TEMPLATES):
+        hits = counters.get(path, {"hits": 0, "misses": 0})
+        state[f"template:{path}"] = {
+            "positions": [list(pos) for pos in LOCATION_MEMORY.positions(path)],
+            "hits": hits["hits"],
+            "misses": hits["misses"],
+        }
+    return state
+
+def restore_state(state: dict) -> int:
     """
-    Последовательность по триггеру btn9:
-    - кликнуть по btn10
-    - через 0.5 сек кликнуть по btn11
-    - через 0.5 сек кликнуть по btn12
+    Восстанавливает снимок StateStore: счетчики и prev_visible правил (кнопка,
+    видная при выходе, не нажмется повторно), время последнего клика — чтобы
+    rate-limit (btn13) продолжал отсчет, а не срабатывал сразу — и память позиций.
+    Возвращает, сколько записей применено.
     """
-    print("[INFO] Триггер 9 появился -> запускаю последовательность 10 -> 11 -> 12")
+    restored = 0
+    for target in targets:
+        for rule in target.engine.rules:
+            saved = state.get(f"rule:{rule.name}")
+            if saved is None:
+                continue
+            rule.count = saved.get("count", 0)
+            rule.failed = saved.get("failed", 0)
+            rule.prev_visible = saved.get("prev_visible", False)
+            if saved.get("last_done") and action_executor is not None:
+                action_executor.restore_last_done(rule.name, saved["last_done"])
+            restored += 1
+    for path in TEMPLATES:
+        saved = state.get(f"template:{path}")
+        if saved is None:
+            continue
+        LOCATION_MEMORY.restore(path, saved.get("positions", []), saved.get("hits", 0), saved.get("misses", 0))
+        restored += 1
+    return restored
 
-    found_10, _ = click_target_image(BUTTON10_IMAGE_PATH, confidence=confidence, region=region)
-    if not found_10:
-        print("[INFO] Шаг 1: btn10 не найден")
-        return False
+class PollScheduler:
+    """
+    Адаптивный интервал опроса вместо фиксированного sleep(CHECK_INTERVAL).
 
-    time.sleep(SEQ_CLICK_DELAY)
+    - Из интервала вычитается время, которое уже занял тик.
+    - Если экран не менялся IDLE_AFTER секунд — опрос замедляется до IDLE_CHECK_INTERVAL.
+    - После срабатывания правила BURST_DURATION секунд опрос идет с BURST_CHECK_INTERVAL,
+      чтобы быстро поймать следующую кнопку (например, шаги после btn9).
+    """
 
-    found_11, _ = click_target_image(BUTTON11_IMAGE_PATH, confidence=confidence, region=region)
-    if not found_11:
-        print("[INFO] Шаг 2: btn11 не найден")
-        return False
+    def __init__(self, interval: float = None, idle_interval: float = None, burst_interval: float = None):
+        self.interval = CHECK_INTERVAL if interval is None else interval
+        self.idle_interval = IDLE_CHECK_INTERVAL if idle_interval is None else idle_interval
+        self.burst_interval = BURST_CHECK_INTERVAL if burst_interval is None else burst_interval
+        now = time.monotonic()
+        self.last_change = now
+        self.burst_until = 0.0
+        self.missed_deadlines = 0  # тики, которые заняли больше своего интервала
 
-    time.sleep(SEQ_CLICK_DELAY)
+    def current_interval(self, now: float = None) -> float:
+        now = time.monotonic() if now is None else now
+        if now < self.burst_until:
+            return self.burst_interval
+        if now - self.last_change >= IDLE_AFTER:
+            return self.idle_interval
+        return self.interval
 
-    found_12, _ = click_target_image(BUTTON12_IMAGE_PATH, confidence=confidence, region=region)
-    if not found_12:
-        print("[INFO] Шаг 3: btn12 не найден")
-        return False
+    def burst(self, now: float = None):
+        now = time.monotonic() if now is None else now
+        self.burst_until = now + BURST_DURATION
+        self.last_change = now
 
-    print("[INFO] Последовательность 10 -> 11 -> 12 выполнена")
-    return True
+    def tick_done(self, changed: bool, fired: bool, now: float = None):
+        """Отмечает итог тика: менялся ли экран и сработало ли какое-то правило"""
+        now = time.monotonic() if now is None else now
+        if changed:
+            self.last_change = now
+        if fired:
+            self.burst(now)
+
+    def sleep(self, tick_start: float):
+        """Спит остаток интервала (время тика уже вычтено)"""
+        remaining = self.current_interval() - (time.monotonic() - tick_start)
+        if remaining > 0:
+            time.sleep(remaining)
+        else:
+            self.missed_deadlines += 1
+
+# Цели (клиенты игры) с их правилами и окнами, загруженные в main()
+targets: list[Target] = []
 
 def autoclicker_loop():
     """Основной цикл автокликера, работает в отдельном потоке"""
     global is_running
     
-    # Определяем область поиска (правая половина экрана)
-    search_region = get_search_region()
-    screen_width, screen_height = pyautogui.size()
+    # Области поиска для правил каждой цели: правая половина и все окно игры
+    # (или экрана, если окно не задано или не найдено — см. Target.regions)
+    layout = capture = None
     
-    click_count_1 = 0  # Счетчик кликов для первой кнопки
-    click_count_2 = 0  # Счетчик кликов для второй кнопки
-    click_count_4 = 0  # Счетчик кликов по картинке 4 (по триггеру 3)
-    trigger3_prev_visible = False  # чтобы нажимать btn4 только по появлению btn3
-    trigger5_prev_visible = False  # чтобы нажимать btn5 только по появлению
-    trigger6_prev_visible = False  # чтобы нажимать btn6 только по появлению
-    trigger7_prev_visible = False  # чтобы нажимать btn8 только по появлению btn7
-    trigger9_prev_visible = False  # чтобы запускать последовательность только по появлению btn9
-    click_count_5 = 0
-    click_count_6 = 0
-    click_count_8 = 0
-    seq9_count = 0
-    click_count_13 = 0
-    btn13_last_click_ts = 0.0
+    frame_diff = FrameDiff()  # карта изменений экрана между тиками
+    matches = {}  # имя цели -> результат сопоставления ее прошлого тика
+    scheduler = PollScheduler()  # адаптивный интервал опроса
+    reloader = HotReloader() if HOT_RELOAD else None  # подхватывает правки правил и шаблонов
+    
+    # Профилирование первых PROFILE_TICKS активных тиков (cProfile только для этого потока)
+    profiler = cProfile.Profile() if PROFILE_TICKS > 0 else None
+    profiled_ticks = 0
     
     try:
         while True:
@@ -316,152 +3502,80 @@ def autoclicker_loop():
                 time.sleep(CHECK_INTERVAL)
                 continue
             
-            # Проверяем первую кнопку (обычный клик)
-            found_1, coords_1 = find_and_click_button(
-                BUTTON_IMAGE_PATH, 
-                CONFIDENCE, 
-                region=search_region  # Поиск только в правой половине экрана
-            )
+            # Один снимок экрана на тик для всех целей и по проходу сопоставления
+            # на цель (в ее рабочем масштабе) — правила дальше только ищут в результате
+            # (в неизменившихся частях экрана берется результат прошлого тика).
+            # Клики не выполняются здесь, а ставятся в очередь action_executor,
+            # поэтому паузы между кликами не останавливают распознавание.
+            # Проверяются только правила, которым пора (poll_interval).
+            if profiler is not None:
+                profiler.enable()
             
-            if found_1:
-                click_count_1 += 1
-                print(f"[STATS] Кнопка 1 - всего кликов: {click_count_1}\n")
+            tick_start = time.monotonic()
+            if reloader is not None:
+                reloaded = reloader.check(tick_start)
+                if reloaded is not None:
+                    # Между тиками подменились цели/правила/шаблоны: область захвата
+                    # пересчитывается, результаты перезагруженных шаблонов забываются
+                    layout = None
+                    for previous in matches.values():
+                        previous.discard(reloaded)
+                    scheduler.interval = CHECK_INTERVAL
+                    scheduler.idle_interval = IDLE_CHECK_INTERVAL
+                    scheduler.burst_interval = BURST_CHECK_INTERVAL
+            active = []
+            for target in targets:
+                regions = target.regions(tick_start)
+                if regions is not None:
+                    active.append((target, regions))
+            if not active:
+                # Ни одного окна не найдено — ждем (окна ищутся в Target.regions)
+                if profiler is not None:
+                    profiler.disable()
+                time.sleep(IDLE_CHECK_INTERVAL)
+                continue
+            current = [regions for _target, regions in active]
+            if current != layout:
+                # Окно сдвинулось/нашлось/потерялось: снимается только то, что нужно правилам всех целей
+                layout = current
+                capture = union_regions(target.engine.capture_region(regions) for target, regions in active)
+            frame = grab_frame(capture)
+            dirty = frame_diff.update(frame)
+            captured = time.monotonic()
+            due = [(target, regions, target.engine.due_rules(tick_start, action_executor)) for target, regions in active]
+            for target, regions, rules in due:
+                specs = list(dict.fromkeys(target.engine.compile(regions, rules)))
+                matches[target.name] = match_templates(
+                    frame, specs, previous=matches.get(target.name), dirty=dirty, calibrator=target.calibrator,
+                )
+            matched = time.monotonic()
+            fired = False
+            for target, regions, rules in due:
+                if target.engine.evaluate(matches[target.name], action_executor, regions, rules, now=tick_start):
+                    target.fired += 1
+                    fired = True
+            evaluated = time.monotonic()
             
-            # Проверяем вторую кнопку (двойной клик с задержкой)
-            found_2, coords_2 = find_and_double_click_button(
-                BUTTON2_IMAGE_PATH, 
-                CONFIDENCE, 
-                region=search_region  # Поиск только в правой половине экрана
-            )
+            METRICS.observe("stage", "capture", captured - tick_start)
+            METRICS.observe("stage", "match", matched - captured)
+            METRICS.observe("stage", "rules", evaluated - matched)
             
-            if found_2:
-                click_count_2 += 1
-                print(f"[STATS] Кнопка 2 - всего двойных кликов: {click_count_2}\n")
-
-            # Триггер: если появилась картинка 3 — нажать картинку 4 (один раз на появление)
-            trigger3_visible = is_image_visible(
-                BUTTON3_IMAGE_PATH,
-                CONFIDENCE,
-                region=search_region,
-            )
-
-            if trigger3_visible and not trigger3_prev_visible:
-                print("[INFO] Триггер 3 появился -> пытаюсь нажать кнопку 4")
-                found_4, _coords_4 = click_target_image(
-                    BUTTON4_IMAGE_PATH,
-                    CONFIDENCE,
-                    region=search_region,
-                )
-                if found_4:
-                    click_count_4 += 1
-                    print(f"[STATS] Кнопка 4 - всего кликов: {click_count_4}\n")
-                else:
-                    print("[INFO] Кнопка 4 не найдена, хотя триггер 3 виден")
-
-            trigger3_prev_visible = trigger3_visible
-
-            # Кнопка 5: кликнуть по появлению.
-            # Поддерживаем два шаблона (btn5.png и bt5.2.png).
-            # Для них используем отдельные настройки (пониже confidence + grayscale),
-            # и при необходимости делаем fallback-поиск по всему экрану.
-            btn5_templates = [BUTTON5_IMAGE_PATH, BUTTON5_ALT_IMAGE_PATH]
-            trigger5_visible = is_any_image_visible(
-                btn5_templates,
-                BTN5_CONFIDENCE,
-                region=search_region,
-                grayscale=BTN5_GRAYSCALE,
-            )
-            if (not trigger5_visible) and BTN5_FALLBACK_FULL_SCREEN:
-                trigger5_visible = is_any_image_visible(
-                    btn5_templates,
-                    BTN5_CONFIDENCE,
-                    region=None,
-                    grayscale=BTN5_GRAYSCALE,
-                )
-            if trigger5_visible and not trigger5_prev_visible:
-                print("[INFO] Кнопка 5 появилась -> кликаю по ней")
-                found_5, _coords_5, matched = click_any_target_image(
-                    btn5_templates,
-                    BTN5_CONFIDENCE,
-                    region=search_region,
-                    grayscale=BTN5_GRAYSCALE,
-                )
-                if (not found_5) and BTN5_FALLBACK_FULL_SCREEN:
-                    found_5, _coords_5, matched = click_any_target_image(
-                        btn5_templates,
-                        BTN5_CONFIDENCE,
-                        region=None,
-                        grayscale=BTN5_GRAYSCALE,
-                    )
-                if found_5:
-                    click_count_5 += 1
-                    print(f"[STATS] Кнопка 5 - всего кликов: {click_count_5} (шаблон: {matched})\n")
-            trigger5_prev_visible = trigger5_visible
-
-            # Кнопка 6: кликнуть по появлению (в правой части экрана)
-            trigger6_visible = is_image_visible(
-                BUTTON6_IMAGE_PATH,
-                CONFIDENCE,
-                region=search_region,
-            )
-            if trigger6_visible and not trigger6_prev_visible:
-                print("[INFO] Кнопка 6 появилась -> кликаю по ней")
-                found_6, _ = click_target_image(BUTTON6_IMAGE_PATH, CONFIDENCE, region=search_region)
-                if found_6:
-                    click_count_6 += 1
-                    print(f"[STATS] Кнопка 6 - всего кликов: {click_count_6}\n")
-            trigger6_prev_visible = trigger6_visible
-
-            # Триггер 7: по всему экрану. Если появился btn7 -> нажать btn8 (один раз на появление)
-            trigger7_visible = is_image_visible(
-                BUTTON7_IMAGE_PATH,
-                CONFIDENCE,
-                region=None,  # весь экран
-            )
-            if trigger7_visible and not trigger7_prev_visible:
-                print("[INFO] Триггер 7 появился (весь экран) -> пытаюсь нажать кнопку 8")
-                found_8, _ = click_target_image(BUTTON8_IMAGE_PATH, CONFIDENCE, region=None)
-                if found_8:
-                    click_count_8 += 1
-                    print(f"[STATS] Кнопка 8 - всего кликов (по триггеру 7): {click_count_8}\n")
-                else:
-                    print("[INFO] Кнопка 8 не найдена, хотя триггер 7 виден")
-            trigger7_prev_visible = trigger7_visible
-
-            # Триггер 9: если появился btn9 -> последовательность btn10 -> btn11 -> btn12 (в правой части экрана)
-            trigger9_visible = is_image_visible(
-                BUTTON9_IMAGE_PATH,
-                CONFIDENCE,
-                region=search_region,
-            )
-            if trigger9_visible and not trigger9_prev_visible:
-                ok = run_btn9_sequence(CONFIDENCE, region=search_region)
-                if ok:
-                    seq9_count += 1
-                    print(f"[STATS] Последовательность по триггеру 9 - выполнено раз: {seq9_count}\n")
-            trigger9_prev_visible = trigger9_visible
-
-            # Кнопка 13: если видна — кликнуть, но не чаще 1 раза в 30 сек
-            btn13_visible = is_image_visible(
-                BUTTON13_IMAGE_PATH,
-                CONFIDENCE,
-                region=search_region,
-            )
-            if btn13_visible:
-                now_ts = time.time()
-                if (now_ts - btn13_last_click_ts) >= BTN13_MIN_INTERVAL:
-                    print("[INFO] Кнопка 13 видна -> кликаю (rate-limit 30 сек)")
-                    found_13, _ = click_target_image(BUTTON13_IMAGE_PATH, CONFIDENCE, region=search_region)
-                    if found_13:
-                        btn13_last_click_ts = now_ts
-                        click_count_13 += 1
-                        print(f"[STATS] Кнопка 13 - всего кликов: {click_count_13}\n")
+            if profiler is not None:
+                profiler.disable()
+                profiled_ticks += 1
+                if profiled_ticks >= PROFILE_TICKS:
+                    profiler.dump_stats(PROFILE_OUTPUT)
+                    log_event("profile", f"Профиль {profiled_ticks} тиков сохранен в {PROFILE_OUTPUT}")
+                    profiler = None
             
-            # Небольшая задержка перед следующей проверкой
-            time.sleep(CHECK_INTERVAL)
+            # Пауза до следующей проверки: зависит от активности экрана и срабатываний
+            scheduler.tick_done(changed=dirty.changed_fraction > 0, fired=fired)
+            scheduler.sleep(tick_start)
+            METRICS.observe("stage", "sleep", time.monotonic() - evaluated)
+            METRICS.tick(missed_deadlines=scheduler.missed_deadlines)
     
     except Exception as e:
-        print(f"[ERROR] Ошибка в цикле автокликера: {e}")
+        log_event("error", f"Ошибка в цикле автокликера: {e}", level="error")
 
 def toggle_autoclicker(icon, item):
     """Обработчик переключения состояния автокликера"""
@@ -469,7 +3583,11 @@ def toggle_autoclicker(icon, item):
     
     is_running = not is_running
     status = "включен" if is_running else "выключен"
-    print(f"[INFO] Автокликер {status}")
+    log_event("toggle", f"Автокликер {status}", running=is_running)
+    
+    # При выключении отменяем клики, которые еще не успели выполниться
+    if not is_running and action_executor is not None:
+        action_executor.clear()
     
     # Обновляем иконку
     icon.icon = create_tray_icon(is_running)
@@ -480,7 +3598,7 @@ def quit_app(icon, item):
     """Обработчик выхода из программы"""
     global is_running, tray_icon, autoclicker_thread
     
-    print("[INFO] Завершение работы...")
+    log_event("quit", "Завершение работы...")
     is_running = False
     
     # Останавливаем иконку трея
@@ -488,6 +3606,15 @@ def quit_app(icon, item):
     
     # Программа завершится автоматически, так как поток daemon
 
+def show_metrics(icon, item):
+    """Обработчик пункта меню «Статистика»: сводка метрик в консоль и уведомление"""
+    summary = METRICS.summary()
+    print(f"[STATS] {summary}\n")
+    try:
+        icon.notify(summary, "Автокликер")
+    except Exception:
+        pass  # не все бэкенды pystray поддерживают уведомления
+
 def get_toggle_text(item):
     """Возвращает текст для пункта меню переключения"""
     return "Выключить" if is_running else "Включить"
@@ -499,6 +3626,7 @@ def setup_tray():
     # Создаем меню
     menu = pystray.Menu(
         pystray.MenuItem(get_toggle_text, toggle_autoclicker),
+        pystray.MenuItem("Статистика", show_metrics),
         pystray.MenuItem("Выход", quit_app)
     )
     
@@ -508,33 +3636,584 @@ def setup_tray():
     
     return tray_icon
 
-def main():
+class ReplayScreenSource(CaptureBackend):
+    """
+    Источник кадров из записанных скриншотов: grab_frame() возвращает текущий
+    кадр (область — как view без копирования). С frames каждый next_frame()
+    переключает на следующий кадр по кругу.
+    """
+
+    name = "replay"
+
+    def __init__(self, frames: list[Frame] = None):
+        super().__init__()
+        self.frames = list(frames or [])
+        self.current = self.frames[0] if self.frames else None
+        self._index = 0
+
+    def next_frame(self) -> Frame:
+        self._index = (self._index + 1) % len(self.frames)
+        self.current = self.frames[self._index]
+        return self.current
+
+    def screen_size(self) -> tuple:
+        return self.current.width, self.current.height
+
+    def grab(self, region: tuple = None) -> Frame:
+        if region is None:
+            return self.current
+        view, (left, top) = self.current.crop(self._clip(region))
+        return Frame(view, left, top)
+
+def load_recorded_frames(directory: str) -> list[tuple[str, Frame, dict]]:
+    """
+    Загружает записанные кадры (*.png / *.npz) и ожидаемые позиции кнопок.
+
+    Разметка лежит в labels.json рядом с кадрами:
+        {"frame001.png": {"btn.png": [[x, y], ...], ...}, ...}
+    где [x, y] — центр кнопки на экране. Шаблон, которого нет в разметке
+    кадра, на этом кадре виден быть не должен. В .npz кадр хранится в
+    массиве "frame" (BGR или BGRA).
+    """
+    directory = Path(directory)
+    labels_path = directory / "labels.json"
+    labels = {}
+    if labels_path.exists():
+        with open(labels_path, encoding="utf-8") as f:
+            labels = json.load(f)
+
+    frames = []
+    for path in sorted(directory.iterdir()):
+        if path.suffix.lower() == ".png":
+            image = load_image_bgr(str(path))
+        elif path.suffix.lower() == ".npz":
+            with np.load(path) as data:
+                image = data["frame"] if "frame" in data else data[data.files[0]]
+            if image.ndim == 3 and image.shape[2] == 4:
+                image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+        else:
+            continue
+        expected = {t: [tuple(p) for p in points] for t, points in labels.get(path.name, {}).items()}
+        frames.append((path.name, Frame(np.ascontiguousarray(image)), expected))
+    if not frames:
+        raise ValueError(f"В {directory} нет кадров (*.png / *.npz)")
+    return frames
+
+def _percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"p50": 0.0, "p90": 0.0, "p99": 0.0, "max": 0.0}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {"p50": float(p50), "p90": float(p90), "p99": float(p99), "max": float(max(values))}
+
+def _on_target(match: Match, points: list) -> bool:
+    """Попал ли центр ожидаемой кнопки в рамку совпадения"""
+    return match is not None and any(
+        abs(match.center[0] - x) <= match.box[2] / 2 and abs(match.center[1] - y) <= match.box[3] / 2
+        for x, y in points
+    )
+
+def _score_detections(detections: list, confidence: float) -> dict:
+    """
+    Precision/recall для одного порога. detections — список
+    (оценка, попал ли центр в ожидаемую позицию, была ли кнопка в разметке).
+    """
+    tp = fp = fn = 0
+    for score, on_target, expected in detections:
+        visible = score >= confidence
+        if visible and on_target:
+            tp += 1
+        elif visible:
+            fp += 1
+            if expected:
+                fn += 1
+        elif expected:
+            fn += 1
+    precision = tp / (tp + fp) if tp + fp else 1.0
+    recall = tp / (tp + fn) if tp + fn else 1.0
+    return {"precision": precision, "recall": recall, "tp": tp, "fp": fp, "fn": fn}
+
+def run_benchmark(frames_dir: str, rules_path: str = None, confidences: list[float] = None, repeat: int = 1) -> dict:
+    """
+    Прогоняет записанные кадры через тот же путь распознавания, что и цикл,
+    без экрана и без кликов (ReplayScreenSource + RecordingInput).
+
+    Returns:
+        dict: задержки по шаблонам (перцентили, мс), кадры в секунду для
+        полного тика, precision/recall по порогам и пиковая память.
+    """
+    global screen_source, input_backend
+
+    engine = RuleEngine(load_rules(rules_path))
+    load_templates(engine.templates())
+    frames = load_recorded_frames(frames_dir)
+    confidences = sorted(confidences or [0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95])
+
+    source = ReplayScreenSource()
+    saved_source, saved_input = screen_source, input_backend
+    screen_source, input_backend = source, RecordingInput()
+    tracemalloc.start()
+    try:
+        latencies = {}  # шаблон -> [мс]
+        detections = {}  # шаблон -> [(оценка, в цели, ожидался)]
+        tick_times = []
+
+        for _ in range(repeat):
+            LOCATION_MEMORY.forget()
+            calibrator = ScaleCalibration()
+            frame_diff = FrameDiff()
+            matches = None
+            for _name, frame, expected in frames:
+                source.current = frame
+                regions = {REGION_SEARCH: get_search_region((frame.width, frame.height)), REGION_FULL: None}
+                specs = engine.compile(regions)
+                capture = engine.capture_region(regions)
+
+                # Полный тик: как в autoclicker_loop (с переиспользованием прошлого кадра)
+                start = time.perf_counter()
+                grabbed = grab_frame(capture)
+                matches = match_templates(
+                    grabbed, specs, previous=matches, dirty=frame_diff.update(grabbed), calibrator=calibrator,
+                )
+                tick_times.append(time.perf_counter() - start)
+
+                # Отдельные проверки через is_image_visible — задержка по шаблонам
+                for spec in specs:
+                    start = time.perf_counter()
+                    is_image_visible(spec.template, spec.confidence, spec.region, spec.grayscale, scale=matches.scale)
+                    latencies.setdefault(spec.template, []).append((time.perf_counter() - start) * 1000)
+
+                    match = matches.best(spec.template, spec.region, spec.grayscale)
+                    points = expected.get(spec.template, [])
+                    score = match.score if match else 0.0
+                    detections.setdefault(spec.template, []).append((score, _on_target(match, points), bool(points)))
+
+        _current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        screen_source, input_backend = saved_source, saved_input
+
+    total = sum(tick_times)
+    report = {
+        "frames": len(frames) * repeat,
+        "fps": len(tick_times) / total if total else 0.0,
+        "tick_ms": _percentiles([t * 1000 for t in tick_times]),
+        "peak_memory_mb": peak / 1024 / 1024,
+        "templates": {},
+    }
+    if resource is not None:
+        report["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    for template, values in latencies.items():
+        report["templates"][template] = {
+            "latency_ms": _percentiles(values),
+            "accuracy": {str(c): _score_detections(detections[template], c) for c in confidences},
+        }
+    return report
+
+def print_benchmark_report(report: dict):
+    """Печатает отчет run_benchmark в консоль"""
+    tick = report["tick_ms"]
+    print(f"[BENCH] Кадров: {report['frames']}, {report['fps']:.1f} кадр/с")
+    print(f"[BENCH] Тик: p50 {tick['p50']:.1f} мс, p90 {tick['p90']:.1f} мс, p99 {tick['p99']:.1f} мс")
+    memory = f"[BENCH] Пиковая память (tracemalloc): {report['peak_memory_mb']:.1f} МБ"
+    if "max_rss_mb" in report:
+        memory += f", max RSS: {report['max_rss_mb']:.1f} МБ"
+    print(memory)
+    for template, data in report["templates"].items():
+        lat = data["latency_ms"]
+        print(f"[BENCH] {template}: p50 {lat['p50']:.1f} мс, p90 {lat['p90']:.1f} мс, p99 {lat['p99']:.1f} мс")
+        for confidence, acc in data["accuracy"].items():
+            print(f"    confidence {confidence}: precision {acc['precision']:.2f}, recall {acc['recall']:.2f}"
+                  f" (tp {acc['tp']}, fp {acc['fp']}, fn {acc['fn']})")
+
+def bench_command(args) -> int:
+    """Команда bench: отчет и код возврата 1, если тик медленнее --max-p90-ms"""
+    global TUNING
+    TUNING = load_tuning(args.tuning)
+    report = run_benchmark(args.frames_dir, args.rules, args.confidence, args.repeat)
+    print_benchmark_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.max_p90_ms is not None and report["tick_ms"]["p90"] > args.max_p90_ms:
+        print(f"[BENCH] Регрессия: p90 тика {report['tick_ms']['p90']:.1f} мс > {args.max_p90_ms} мс")
+        return 1
+    return 0
+
+def _bench_regions(frame: Frame) -> dict:
+    """Области правил для записанного кадра (окна нет — кадр и есть экран)"""
+    return {REGION_SEARCH: get_search_region((frame.width, frame.height)), REGION_FULL: None}
+
+def _tune_run(frames: list, template: Template, region, grayscale: bool, confidence: float,
+              scale: float, coarse_scale: float) -> tuple:
+    """
+    Ищет шаблон с заданными настройками на всех кадрах (полный поиск, без памяти позиций).
+    Возвращает (среднее время поиска в мс, совпадение на каждом кадре).
+    """
+    matches = []
+    elapsed = 0.0
+    for _name, frame, _expected in frames:
+        area = resolve_region(region, _bench_regions(frame))
+        start = time.perf_counter()
+        matches.append(_search_template(frame, template, area, grayscale, confidence, scale, coarse_scale))
+        elapsed += time.perf_counter() - start
+    return elapsed * 1000 / len(frames), matches
+
+def _tune_detections(frames: list, path: str, matches: list) -> list:
+    return [
+        (match.score if match else 0.0, _on_target(match, expected.get(path, [])), bool(expected.get(path)))
+        for (_name, _frame, expected), match in zip(frames, matches)
+    ]
+
+def _label_region(frames: list, path: str, size: tuple):
+    """Наименьшая область, в которой лежат все размеченные кнопки шаблона (с запасом TUNE_REGION_PADDING)"""
+    points = [point for _name, _frame, expected in frames for point in expected.get(path, [])]
+    if not points:
+        return None
+    width, height = size
+    pad = TUNE_REGION_PADDING
+    x0 = min(x for x, _y in points) - width // 2 - pad
+    y0 = min(y for _x, y in points) - height // 2 - pad
+    x1 = max(x for x, _y in points) + width - width // 2 + pad
+    y1 = max(y for _x, y in points) + height - height // 2 + pad
+    frame = frames[0][1]
+    return intersect_regions((x0, y0, x1 - x0, y1 - y0), (frame.left, frame.top, frame.width, frame.height))
+
+def _tune_template(frames: list, path: str, region, grayscale: bool, scale: float,
+                   recall: float, precision: float, confidences: list[float]) -> dict:
+    """
+    Самые дешевые настройки шаблона, при которых на кадрах достигаются recall и precision.
+
+    Перебирает область (размеченная или из правила), grayscale и уменьшение кадра
+    для грубого поиска (TUNE_COARSE_SCALES или полное разрешение); кандидаты
+    проверяются от самого быстрого, порог берется из середины подходящих.
+    Возвращает настройки (со статистикой) или None, если шаблон не размечен.
+    """
+    template = TEMPLATES[path]
+    size = template.size(scale)
+    label_region = _label_region(frames, path, size)
+    if label_region is None:
+        return None
+
+    def meets(accuracy):
+        return accuracy["recall"] >= recall and accuracy["precision"] >= precision
+
+    # Грубый поиск имеет смысл, только пока уменьшенный шаблон не меньше, чем допускает COARSE_MIN_TEMPLATE_SIDE
+    coarse_scales = [c for c in TUNE_COARSE_SCALES if min(size) * c >= COARSE_MIN_TEMPLATE_SIDE * COARSE_SCALE]
+    default_coarse = _coarse_scale(template, scale)
+    baseline_ms = None
+    candidates = []
+    for area in (list(label_region), region):
+        for gray in (True, False):
+            for coarse in [*coarse_scales, 0.0]:
+                cost, matches = _tune_run(frames, template, area, gray, min(confidences), scale, coarse)
+                if area is region and gray == grayscale and coarse == default_coarse:
+                    baseline_ms = cost
+                detections = _tune_detections(frames, path, matches)
+                passing = [c for c in confidences if meets(_score_detections(detections, c))]
+                if passing:
+                    candidates.append((cost, area, gray, coarse, passing))
+    if baseline_ms is None:
+        baseline_ms, _matches = _tune_run(frames, template, region, grayscale, min(confidences), scale, default_coarse)
+
+    for cost, area, gray, coarse, passing in sorted(candidates, key=lambda candidate: candidate[0]):
+        # Грубый поиск отбрасывает кандидатов ниже порога — проверяем с тем порогом, что пойдет в цикл
+        confidence = passing[len(passing) // 2]
+        _cost, matches = _tune_run(frames, template, area, gray, confidence, scale, coarse)
+        accuracy = _score_detections(_tune_detections(frames, path, matches), confidence)
+        if meets(accuracy):
+            tuned = {"grayscale": gray, "coarse_scale": coarse, "confidence": confidence}
+            if area is not region:
+                tuned["region"] = area
+            tuned.update(
+                cost_ms=round(cost, 3), baseline_ms=round(baseline_ms, 3),
+                recall=accuracy["recall"], precision=accuracy["precision"],
+            )
+            return tuned
+    return {"baseline_ms": round(baseline_ms, 3), "unreachable": True}
+
+def _tune_variants(frames: list, rule: Rule, templates: list[str], region, tuned: dict, scale: float,
+                   recall: float, precision: float):
+    """
+    Нужны ли запасные варианты шаблона (например, btn5.png и bt5.2.png): самый
+    короткий префикс списка, который находит кнопку с нужными recall/precision,
+    или None, если нужны все варианты.
+    """
+    visible = {}
+    for path in templates:
+        template = TEMPLATES[path]
+        settings = tuned.get(path, {})
+        confidence = settings.get("confidence", rule.confidence)
+        _cost, matches = _tune_run(
+            frames, template, settings.get("region", region), settings.get("grayscale", rule.grayscale),
+            confidence, scale, settings.get("coarse_scale", _coarse_scale(template, scale)),
+        )
+        visible[path] = [match if match is not None and match.score >= confidence else None for match in matches]
+
+    for k in range(1, len(templates)):
+        detections = []
+        for i, (_name, _frame, expected) in enumerate(frames):
+            points = [point for path in templates for point in expected.get(path, [])]
+            match = next((visible[path][i] for path in templates[:k] if visible[path][i] is not None), None)
+            detections.append((1.0 if match else 0.0, _on_target(match, points), bool(points)))
+        accuracy = _score_detections(detections, 0.5)
+        if accuracy["recall"] >= recall and accuracy["precision"] >= precision:
+            return templates[:k]
+    return None
+
+def run_tuning(frames_dir: str, rules_path: str = None, recall: float = None, precision: float = None,
+               confidences: list[float] = None) -> dict:
+    """
+    Подбирает для каждого размеченного шаблона самые дешевые настройки поиска
+    (уменьшение кадра, grayscale, область, порог), при которых на записанных
+    кадрах достигаются recall и precision, и проверяет, нужны ли правилам
+    запасные варианты шаблонов. Ищет так же, как цикл, но без памяти позиций —
+    то есть оценивает худший случай (полный поиск).
+
+    Returns:
+        dict: конфигурация для TUNING_PATH ("templates", "rules") со статистикой.
+    """
+    global TUNING
+    recall = TUNE_RECALL if recall is None else recall
+    precision = TUNE_PRECISION if precision is None else precision
+    confidences = sorted(confidences or [0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95])
+
+    # Подбор всегда начинается с настроек из правил, а не с прошлого результата
+    saved_tuning, TUNING = TUNING, {"templates": {}, "rules": {}}
+    try:
+        rules = load_rules(rules_path)
+        load_templates(list(dict.fromkeys(t for rule in rules for t in rule.templates())))
+        frames = load_recorded_frames(frames_dir)
+
+        # Рабочий масштаб — как у цикла: по первому уверенному совпадению
+        calibrator = ScaleCalibration()
+        engine = RuleEngine(rules)
+        for _name, frame, _expected in frames:
+            if calibrator.calibrate(frame, match_templates(frame, engine.compile(_bench_regions(frame)))):
+                break
+        scale = calibrator.scale if SCALE_CALIBRATION else 1.0
+        LOCATION_MEMORY.forget()
+
+        templates = {}
+        for rule in rules:
+            for paths, region in rule.lookups().values():
+                for path in paths:
+                    if path not in templates:
+                        templates[path] = _tune_template(
+                            frames, path, region, rule.grayscale, scale, recall, precision, confidences,
+                        )
+
+        tuned = {path: settings for path, settings in templates.items()
+                 if settings is not None and not settings.get("unreachable")}
+        rule_overrides = {}
+        for rule in rules:
+            for key, (paths, region) in rule.lookups().items():
+                if len(paths) < 2 or not any(expected.get(p) for _n, _f, expected in frames for p in paths):
+                    continue
+                needed = _tune_variants(frames, rule, paths, region, tuned, scale, recall, precision)
+                if needed is not None:
+                    rule_overrides.setdefault(rule.name, {})[key] = needed
+    finally:
+        TUNING = saved_tuning
+
+    return {
+        "frames": len(frames),
+        "scale": scale,
+        "recall": recall,
+        "precision": precision,
+        "templates": tuned,
+        "rules": rule_overrides,
+        "skipped": {path: "unreachable" if settings else "unlabelled"
+                    for path, settings in templates.items() if path not in tuned},
+    }
+
+def print_tuning_report(report: dict):
+    """Печатает результат run_tuning в консоль"""
+    print(f"[TUNE] Кадров: {report['frames']}, масштаб {report['scale']:g}, "
+          f"цель: recall >= {report['recall']:g}, precision >= {report['precision']:g}")
+    for path, settings in report["templates"].items():
+        coarse = f"грубый поиск x{settings['coarse_scale']:g}" if settings["coarse_scale"] else "полное разрешение"
+        region = "область [{}, {}, {}, {}]".format(*settings["region"]) if "region" in settings else "область правила"
+        print(f"[TUNE] {path}: {settings['baseline_ms']:.1f} мс -> {settings['cost_ms']:.1f} мс "
+              f"({region}, {'grayscale' if settings['grayscale'] else 'цвет'}, {coarse}, порог {settings['confidence']:g}; "
+              f"recall {settings['recall']:.2f}, precision {settings['precision']:.2f})")
+    for path, reason in report["skipped"].items():
+        why = "нет разметки" if reason == "unlabelled" else "цель недостижима"
+        print(f"[TUNE] {path}: {why} — остается как в правилах")
+    for name, fields in report["rules"].items():
+        for key, paths in fields.items():
+            print(f"[TUNE] {name}: достаточно {', '.join(paths)} ({key}) — запасные варианты не нужны")
+
+def tune_command(args) -> int:
+    """Команда tune: подбирает настройки шаблонов и записывает их в файл, который загружает цикл"""
+    report = run_tuning(args.frames_dir, args.rules, args.recall, args.precision, args.confidence)
+    print_tuning_report(report)
+    config = {key: report[key] for key in ("frames", "scale", "recall", "precision", "templates", "rules")}
+    # Через временный файл: горячая перезагрузка не должна увидеть файл наполовину записанным
+    tmp_path = args.output + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, args.output)
+    print(f"[TUNE] Настройки сохранены в {args.output}")
+    return 0
+
+def stats_command(args) -> int:
+    """Команда stats: клики по времени из журнала StateStore (без разбора вывода консоли)"""
+    if not os.path.exists(args.state):
+        print(f"[ERROR] Файл состояния не найден: {args.state}")
+        return 1
+    store = StateStore(args.state)
+    since = time.time() - args.since
+    start = time.perf_counter()
+    buckets = store.throughput(since, args.bucket)
+    totals = store.rule_totals(since)
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"[STATS] Клики за последние {args.since:g} сек по {args.bucket:g} сек (запрос: {elapsed:.1f} мс)")
+    for bucket_start, total, ok in buckets:
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(bucket_start))
+        print(f"[STATS] {when}: кликов {total} ({total / args.bucket * 60:.1f}/мин), не выполнено {total - ok}")
+    for rule, total, ok in totals:
+        print(f"[STATS] {rule}: кликов {total}, не выполнено {total - ok}")
+    if not buckets:
+        print("[STATS] Кликов за этот период нет")
+    return 0
+
+def parse_args(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description="Автокликер для игры")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Порт HTTP-эндпоинта метрик на 127.0.0.1 (/metrics, /metrics.json)")
+    parser.add_argument("--profile-ticks", type=int, default=PROFILE_TICKS,
+                        help="Профилировать первые N тиков через cProfile")
+    parser.add_argument("--profile-output", default=PROFILE_OUTPUT, help="Файл для профиля cProfile")
+    parser.add_argument("--capture", default=CAPTURE_BACKEND, choices=["auto", *CAPTURE_BACKENDS],
+                        help="Способ захвата экрана (auto — самый быстрый из доступных)")
+    parser.add_argument("--input", default=INPUT_BACKEND, choices=["auto", *INPUT_BACKENDS],
+                        help="Способ нажатия (win32 — сообщения в окно без движения курсора)")
+    parser.add_argument("--state", default=STATE_PATH,
+                        help="Файл состояния между запусками (\"\" — не сохранять)")
+    commands = parser.add_subparsers(dest="command")
+
+    bench = commands.add_parser("bench", help="Бенчмарк распознавания на записанных кадрах (без экрана)")
+    bench.add_argument("frames_dir", help="Папка с кадрами (*.png / *.npz) и labels.json")
+    bench.add_argument("--rules", default=None, help=f"Файл правил (по умолчанию {RULES_PATH})")
+    bench.add_argument("--confidence", type=float, nargs="+", help="Пороги для precision/recall")
+    bench.add_argument("--repeat", type=int, default=1, help="Сколько раз прогнать все кадры")
+    bench.add_argument("--json", help="Сохранить отчет в JSON-файл")
+    bench.add_argument("--max-p90-ms", type=float, help="Завершиться с кодом 1, если p90 тика больше")
+    bench.add_argument("--tuning", default=None,
+                       help=f"Файл подобранных настроек (по умолчанию {TUNING_PATH}, \"\" — без него)")
+
+    tune = commands.add_parser("tune", help="Подбор самых дешевых настроек шаблонов на размеченных кадрах")
+    tune.add_argument("frames_dir", help="Папка с кадрами (*.png / *.npz) и labels.json")
+    tune.add_argument("--rules", default=None, help=f"Файл правил (по умолчанию {RULES_PATH})")
+    tune.add_argument("--recall", type=float, default=TUNE_RECALL, help="Нужная доля найденных кнопок")
+    tune.add_argument("--precision", type=float, default=TUNE_PRECISION, help="Нужная доля верных срабатываний")
+    tune.add_argument("--confidence", type=float, nargs="+", help="Пороги, среди которых выбирать")
+    tune.add_argument("--output", default=TUNING_PATH, help="Куда записать настройки (их загружает цикл)")
+
+    stats = commands.add_parser("stats", help="Клики по времени из файла состояния")
+    stats.add_argument("--since", type=float, default=3600, help="За сколько последних секунд")
+    stats.add_argument("--bucket", type=float, default=60, help="Шаг разбивки в секундах")
+
+    return parser.parse_args(argv)
+
+def main(argv: list[str] = None):
     """Основная функция - запускает трей и поток автокликера"""
-    global autoclicker_thread, tray_icon
+    global autoclicker_thread, tray_icon, action_executor, targets, screen_source, input_backend
+    global PROFILE_TICKS, PROFILE_OUTPUT, TUNING, STATE_STORE
+    
+    args = parse_args(argv)
+    if args.command == "bench":
+        raise SystemExit(bench_command(args))
+    if args.command == "tune":
+        raise SystemExit(tune_command(args))
+    if args.command == "stats":
+        raise SystemExit(stats_command(args))
+    PROFILE_TICKS, PROFILE_OUTPUT = args.profile_ticks, args.profile_output
     
     print("[START] Автокликер запущен!")
-    print(f"[INFO] Ищу кнопку 1: {BUTTON_IMAGE_PATH}")
-    print(f"[INFO] Ищу кнопку 2: {BUTTON2_IMAGE_PATH}")
-    print(f"[INFO] Триггер 3: {BUTTON3_IMAGE_PATH} -> нажать: {BUTTON4_IMAGE_PATH}")
-    print(f"[INFO] Кнопка 5: {BUTTON5_IMAGE_PATH} (клик по появлению)")
-    print(f"[INFO] Кнопка 6: {BUTTON6_IMAGE_PATH} (клик по появлению)")
-    print(f"[INFO] Триггер 7 (весь экран): {BUTTON7_IMAGE_PATH} -> нажать: {BUTTON8_IMAGE_PATH}")
-    print(f"[INFO] Триггер 9: {BUTTON9_IMAGE_PATH} -> {BUTTON10_IMAGE_PATH} -> {BUTTON11_IMAGE_PATH} -> {BUTTON12_IMAGE_PATH}")
-    print(f"[INFO] Кнопка 13: {BUTTON13_IMAGE_PATH} (не чаще 1 раза в {BTN13_MIN_INTERVAL} сек)")
-    print(f"[INFO] Интервал проверки: {CHECK_INTERVAL} сек")
+    
+    # Загружаем правила и подготавливаем все нужные им шаблоны один раз
+    # (без файлов работать нет смысла)
+    try:
+        apply_settings(load_settings())
+        TUNING = load_tuning()
+        targets = load_targets()
+        # Кэш шаблонов общий для всех целей
+        load_templates(list(dict.fromkeys(t for target in targets for t in target.templates())))
+    except (OSError, ValueError) as e:
+        print(f"[ERROR] {e}")
+        raise SystemExit(1)
+    rules_total = sum(len(target.engine.rules) for target in targets)
+    print(f"[INFO] Правил: {rules_total} (файл {RULES_PATH}), шаблонов: {len(TEMPLATES)}")
+    if TUNING["templates"] or TUNING["rules"]:
+        print(f"[INFO] Подобранные настройки ({TUNING_PATH}): шаблонов {len(TUNING['templates'])}, правил {len(TUNING['rules'])}")
+    
+    for rule in targets[0].engine.rules:
+        print(f"[INFO] {rule.describe()}")
+    for target in targets:
+        print(f"[INFO] {target.describe()}")
+    # Память позиций общая: в ней помещается история для каждой цели
+    LOCATION_MEMORY.history = LOCATION_HISTORY * len(targets)
+    print(f"[INFO] Интервал проверки: {CHECK_INTERVAL} сек (простой: {IDLE_CHECK_INTERVAL} сек, после срабатывания: {BURST_CHECK_INTERVAL} сек)")
     print(f"[INFO] Точность поиска: {CONFIDENCE * 100}%")
+    if MATCH_POOL != "none" and MATCH_WORKERS > 1:
+        print(f"[INFO] Параллельное сопоставление: {MATCH_WORKERS} воркеров ({MATCH_POOL})")
     
     screen_width, screen_height = pyautogui.size()
     print(f"[INFO] Область поиска: правая половина экрана ({screen_width // 2}x{screen_height})")
+    
+    # Выбираем самый быстрый способ захвата для области, которая нужна правилам
+    capture = union_regions(
+        target.engine.capture_region(regions) for target in targets
+        if (regions := target.regions()) is not None
+    )
+    try:
+        screen_source, throughput = select_capture_backend(capture, args.capture)
+    except (OSError, ValueError) as e:
+        print(f"[ERROR] {e}")
+        raise SystemExit(1)
+    width, height = (screen_width, screen_height) if capture is None else capture[2:]
+    measured = ", ".join(f"{name}: {fps:.0f} кадр/с" for name, fps in throughput.items())
+    print(f"[INFO] Захват экрана: {screen_source.name}, область {width}x{height} ({measured})")
+    try:
+        input_backend = select_input_backend(args.input)
+    except (OSError, ValueError) as e:
+        print(f"[ERROR] {e}")
+        raise SystemExit(1)
+    print(f"[INFO] Нажатия: {input_backend.name}")
     print("\n[INFO] Программа работает в системном трее. Кликните правой кнопкой по иконке для управления.\n")
     
-    # Запускаем поток с основным циклом автокликера
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    
+    # Запускаем исполнитель кликов и поток с основным циклом автокликера
+    action_executor = ActionExecutor().start()
+    
+    # Восстанавливаем состояние прошлого запуска (счетчики, rate-limit, prev_visible, позиции)
+    if args.state:
+        try:
+            STATE_STORE = StateStore(args.state, snapshot=state_snapshot).open()
+            restored = restore_state(STATE_STORE.load())
+        except (sqlite3.Error, ValueError) as e:
+            print(f"[ERROR] Файл состояния {args.state} недоступен, состояние не сохраняется: {e}")
+            STATE_STORE = None
+        else:
+            print(f"[INFO] Состояние: {args.state} (восстановлено записей: {restored})")
+            STATE_STORE.start()
+    
     autoclicker_thread = threading.Thread(target=autoclicker_loop, daemon=True)
     autoclicker_thread.start()
     
     # Настраиваем и запускаем трей
     icon = setup_tray()
     icon.run()  # Блокирующий вызов - программа будет работать пока не закроют трей
+    
+    shutdown_match_pool()
+    screen_source.close()
+    input_backend.close()
+    if STATE_STORE is not None:
+        STATE_STORE.close()
+    EVENT_LOG.flush()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,74 @@
+"""
+Общие фикстуры тестов: синтетические кадры (шаблоны кнопок, вклеенные в шумный
+фон), файл правил во временной папке и изоляция глобального состояния модуля.
+Экран и мышь не нужны — кадры подаются через ReplayScreenSource, клики
+записывает RecordingInput.
+"""
+
+import json
+import sys
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import autoclicker as ac  # noqa: E402
+
+# Журнал событий тестов в файл не пишем
+ac.EVENT_LOG.path = ""
+
+SCREEN_SIZE = (1280, 720)
+
+
+def make_frame(places: dict, seed: int = 0, size: tuple = SCREEN_SIZE) -> np.ndarray:
+    """
+    Кадр BGR: плавный шум (похож на фон игры, без случайных совпадений)
+    и вклеенные шаблоны {путь: (x, y)} — левый верхний угол кнопки.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size
+    noise = rng.integers(0, 255, (height // 8, width // 8, 3), dtype=np.uint8)
+    image = cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+    for path, (x, y) in places.items():
+        paste(image, path, x, y)
+    return image
+
+
+def paste(image: np.ndarray, path: str, x: int, y: int):
+    template = ac.load_image_bgr(str(ROOT / path))
+    height, width = template.shape[:2]
+    image[y:y + height, x:x + width] = template
+
+
+def center(path: str, x: int, y: int) -> tuple:
+    """Центр вклеенной кнопки — туда должен прийтись клик"""
+    height, width = ac.load_image_bgr(str(ROOT / path)).shape[:2]
+    return ac.box_center((x, y, width, height))
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch):
+    """Пути шаблонов в правилах — относительно корня репозитория; глобальное состояние — свое на тест"""
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setattr(ac, "MATCH_POOL", "none")
+    monkeypatch.setattr(ac, "CONFIRM_CLICKS", False)
+    monkeypatch.setattr(ac, "CLICK_DELAY", 0.0)
+    monkeypatch.setattr(ac, "TUNING", {"templates": {}, "rules": {}})
+    monkeypatch.setattr(ac, "STATE_STORE", None)
+    ac.LOCATION_MEMORY.forget()
+    yield
+    ac.LOCATION_MEMORY.forget()
+
+
+@pytest.fixture
+def rules_file(tmp_path):
+    """Записывает правила во временный rules.json и возвращает путь к нему"""
+    def write(rules: list) -> str:
+        path = tmp_path / "rules.json"
+        path.write_text(json.dumps({"rules": rules}, ensure_ascii=False), encoding="utf-8")
+        return str(path)
+    return write
@@ -0,0 +1,65 @@
+"""Бенчмарк на записанных кадрах: precision/recall и код возврата при регрессии"""
+
+import json
+
+import cv2
+import pytest
+
+import autoclicker as ac
+from conftest import center, make_frame
+
+RULES = [
+    {"name": "btn1", "type": "click", "templates": ["btn.png"], "region": "search"},
+    {"name": "btn2", "type": "click", "templates": ["btn2.png"], "region": "search"},
+]
+
+
+@pytest.fixture
+def frames_dir(tmp_path):
+    """
+    Три кадра с разметкой: btn.png, btn2.png и кадр, где btn.png есть,
+    но в разметке его нет (ложное срабатывание для precision)
+    """
+    directory = tmp_path / "frames"
+    directory.mkdir()
+    frames = {
+        "frame1.png": {"btn.png": (900, 200)},
+        "frame2.png": {"btn2.png": (1000, 400)},
+        "frame3.png": {"btn.png": (700, 500)},
+    }
+    labels = {}
+    for i, (name, places) in enumerate(frames.items()):
+        cv2.imwrite(str(directory / name), make_frame(places, seed=i))
+        if name != "frame3.png":
+            labels[name] = {path: [center(path, x, y)] for path, (x, y) in places.items()}
+    (directory / "labels.json").write_text(json.dumps(labels), encoding="utf-8")
+    return str(directory)
+
+
+def test_benchmark_precision_recall(frames_dir, rules_file):
+    report = ac.run_benchmark(frames_dir, rules_file(RULES), confidences=[0.8])
+
+    assert report["frames"] == 3
+    btn = report["templates"]["btn.png"]["accuracy"]["0.8"]
+    assert (btn["tp"], btn["fp"], btn["fn"]) == (1, 1, 0)
+    assert btn["precision"] == 0.5
+    assert btn["recall"] == 1.0
+    btn2 = report["templates"]["btn2.png"]["accuracy"]["0.8"]
+    assert (btn2["tp"], btn2["fp"], btn2["fn"]) == (1, 0, 0)
+    assert btn2["precision"] == btn2["recall"] == 1.0
+
+
+def test_benchmark_misses_below_threshold(frames_dir, rules_file):
+    # Порог выше любой оценки — ничего не найдено, recall падает до нуля
+    report = ac.run_benchmark(frames_dir, rules_file(RULES), confidences=[1.01])
+    btn = report["templates"]["btn.png"]["accuracy"]["1.01"]
+    assert (btn["tp"], btn["fp"], btn["fn"]) == (0, 0, 1)
+    assert btn["recall"] == 0.0
+
+
+@pytest.mark.parametrize("max_p90_ms, code", [(0.001, 1), (1e6, 0)])
+def test_bench_exit_code(frames_dir, rules_file, max_p90_ms, code):
+    argv = ["bench", frames_dir, "--rules", rules_file(RULES), "--tuning", "", "--max-p90-ms", str(max_p90_ms)]
+    with pytest.raises(SystemExit) as exit_info:
+        ac.main(argv)
+    assert exit_info.value.code == code
@@ -0,0 +1,49 @@
+"""Сопоставление с переиспользованием неизменившихся тайлов дает тот же результат, что и полный проход"""
+
+import numpy as np
+
+import autoclicker as ac
+from conftest import make_frame
+
+TEMPLATES = ["btn.png", "btn2.png", "btn3.png", "btn6.png", "btn9.png"]
+
+
+def hits(result: ac.MatchResult) -> list:
+    return sorted((match.template, match.box) for match in result.hits())
+
+
+def test_dirty_reuse_matches_full_scan():
+    ac.load_templates(TEMPLATES)
+    region = ac.get_search_region((1280, 720))
+    specs = [ac.MatchSpec(path, region, False, 0.8) for path in TEMPLATES]
+
+    animated = np.random.default_rng(7)
+    scenes = [
+        {"btn.png": (900, 100)},
+        {"btn.png": (900, 100)},  # ничего не изменилось
+        {"btn.png": (900, 100), "btn9.png": (700, 400)},  # появилась кнопка
+        {"btn9.png": (700, 400)},  # пропала кнопка
+        {"btn9.png": (700, 400), "btn.png": (1100, 50)},  # кнопка в новом месте
+        {"btn9.png": (700, 400), "btn.png": (1100, 50)},  # анимация рядом с кнопками
+        {},
+    ]
+    frame_diff = ac.FrameDiff()
+    previous = None
+    stats = {"full": 0, "partial": 0, "reused": 0}
+    for i, places in enumerate(scenes):
+        image = make_frame(places)
+        if i == 5:
+            image[600:680, 1000:1150] = animated.integers(0, 255, (80, 150, 3), dtype=np.uint8)
+        frame = ac.Frame(image)
+        result = ac.match_templates(frame, specs, previous=previous, dirty=frame_diff.update(frame))
+        full = ac.match_templates(ac.Frame(image.copy()), specs)
+        assert hits(result) == hits(full), f"кадр {i}"
+        assert {path for path, _box in hits(result)} == set(places), f"кадр {i}"
+        if i:
+            for key in stats:
+                stats[key] += result.stats[key]
+        previous = result
+
+    # Проверяем, что путь с переиспользованием действительно сработал
+    assert stats["reused"] > 0
+    assert stats["partial"] > 0
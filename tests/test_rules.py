@@ -0,0 +1,131 @@
+"""Тик движка правил: какие клики уходят в способ нажатия"""
+
+import time
+
+import pytest
+
+import autoclicker as ac
+from conftest import center, make_frame
+
+RULES = [
+    {"name": "btn1", "type": "click", "on_appear": True, "templates": ["btn.png"], "region": "search"},
+    {"name": "trigger3", "type": "trigger", "trigger": ["btn3.png"], "target": ["btn4.png"], "region": "search"},
+    {"name": "btn6", "type": "click", "templates": ["btn6.png"], "region": "search"},
+]
+
+
+@pytest.fixture
+def recorder(monkeypatch):
+    """Кадры из ReplayScreenSource, клики — в RecordingInput, исполнитель кликов — свой"""
+    source = ac.ReplayScreenSource()
+    recording = ac.RecordingInput()
+    monkeypatch.setattr(ac, "screen_source", source)
+    monkeypatch.setattr(ac, "input_backend", recording)
+    executor = ac.ActionExecutor().start()
+    monkeypatch.setattr(ac, "action_executor", executor)
+    return source, recording, executor
+
+
+def tick(engine: ac.RuleEngine, source: ac.ReplayScreenSource, executor: ac.ActionExecutor, image):
+    """Один тик как в autoclicker_loop: снимок, проход сопоставления, правила; ждет клики"""
+    source.current = ac.Frame(image)
+    regions = {ac.REGION_SEARCH: ac.get_search_region((source.current.width, source.current.height)),
+               ac.REGION_FULL: None}
+    frame = ac.grab_frame(engine.capture_region(regions))
+    fired = engine.evaluate(ac.match_templates(frame, engine.compile(regions)), executor, regions)
+    executor.join()
+    return fired
+
+
+def clicks(recording: ac.RecordingInput) -> list:
+    return [(x, y) for _time, x, y, _batch in recording.events]
+
+
+def test_tick_clicks_visible_buttons(recorder, rules_file):
+    source, recording, executor = recorder
+    engine = ac.RuleEngine(ac.load_rules(rules_file(RULES)))
+    ac.load_templates(engine.templates())
+
+    places = {"btn.png": (900, 100), "btn3.png": (700, 300), "btn4.png": (1100, 500)}
+    assert tick(engine, source, executor, make_frame(places))
+    assert sorted(clicks(recording)) == sorted([center("btn.png", 900, 100), center("btn4.png", 1100, 500)])
+
+
+def test_tick_fires_on_appear_once(recorder, rules_file):
+    source, recording, executor = recorder
+    engine = ac.RuleEngine(ac.load_rules(rules_file(RULES)))
+    ac.load_templates(engine.templates())
+
+    image = make_frame({"btn.png": (900, 100), "btn3.png": (700, 300), "btn4.png": (1100, 500)})
+    tick(engine, source, executor, image)
+    recording.events.clear()
+
+    # Кнопки не пропадали — on_appear и trigger второй раз не срабатывают
+    assert not tick(engine, source, executor, image)
+    assert clicks(recording) == []
+
+    # Обычный click нажимается, пока кнопка видна
+    image = make_frame({"btn.png": (900, 100), "btn6.png": (1000, 600)})
+    tick(engine, source, executor, image)
+    time.sleep(ac.CLICK_REPEAT_INTERVAL)
+    tick(engine, source, executor, image)
+    assert clicks(recording) == [center("btn6.png", 1000, 600)] * 2
+
+
+def test_tick_ignores_buttons_outside_region(recorder, rules_file):
+    source, recording, executor = recorder
+    engine = ac.RuleEngine(ac.load_rules(rules_file(RULES)))
+    ac.load_templates(engine.templates())
+
+    # "search" — правая половина кадра: кнопка слева не нажимается
+    assert not tick(engine, source, executor, make_frame({"btn.png": (100, 100)}))
+    assert recording.events == []
+
+
+def test_visible_button_not_reclicked_within_interval(recorder, rules_file):
+    source, recording, executor = recorder
+    rules = [{"name": "btn6", "type": "click", "templates": ["btn6.png"], "region": "search", "min_interval": 60}]
+    engine = ac.RuleEngine(ac.load_rules(rules_file(rules)))
+    ac.load_templates(engine.templates())
+
+    # Частые тики после срабатывания (BURST_CHECK_INTERVAL): кнопка не пропала,
+    # но повторного клика нет, пока не прошел min_interval правила
+    image = make_frame({"btn6.png": (1000, 600)})
+    assert tick(engine, source, executor, image)
+    for _ in range(3):
+        assert not tick(engine, source, executor, image)
+    assert clicks(recording) == [center("btn6.png", 1000, 600)]
+
+
+def test_delayed_click_rechecks_button(recorder, rules_file):
+    source, recording, executor = recorder
+    engine = ac.RuleEngine(ac.load_rules(rules_file(RULES)))
+    ac.load_templates(engine.templates())
+    regions = {ac.REGION_SEARCH: ac.get_search_region((1280, 720)), ac.REGION_FULL: None}
+
+    # Исполнитель занят (например, последовательностью): клик ждет в очереди дольше CLICK_MAX_AGE
+    for places, expected in [({"btn6.png": (1000, 600)}, [center("btn6.png", 1000, 600)]), ({}, [])]:
+        recording.events.clear()
+        source.current = ac.Frame(make_frame({"btn6.png": (1000, 600)}))
+        executor.submit("busy", time.sleep, ac.CLICK_MAX_AGE * 3)
+        assert engine.evaluate(ac.match_templates(ac.grab_frame(), engine.compile(regions)), executor, regions)
+        # Пока клик ждал, кнопка осталась на месте или пропала
+        source.current = ac.Frame(make_frame(places))
+        executor.join()
+        assert clicks(recording) == expected
+
+
+def test_on_appear_waits_for_busy_rule(recorder, rules_file):
+    source, recording, executor = recorder
+    engine = ac.RuleEngine(ac.load_rules(rules_file(RULES)))
+    ac.load_templates(engine.templates())
+
+    # Прошлый клик правила еще выполняется — появление не теряется, а обрабатывается на следующем тике
+    image = make_frame({"btn.png": (900, 100)})
+    executor.submit("btn1", time.sleep, 0.2)
+    source.current = ac.Frame(image)
+    regions = {ac.REGION_SEARCH: ac.get_search_region((1280, 720)), ac.REGION_FULL: None}
+    assert not engine.evaluate(ac.match_templates(ac.grab_frame(), engine.compile(regions)), executor, regions)
+    executor.join()
+    assert tick(engine, source, executor, image)
+    assert clicks(recording) == [center("btn.png", 900, 100)]